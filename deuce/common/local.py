@@ -15,6 +15,7 @@
 
 """Local storage of variables using weak references"""
 
+import functools
 import threading
 import weakref
 
@@ -43,3 +44,24 @@ store = WeakLocal()
 # of scope.
 weak_store = WeakLocal()
 strong_store = threading.local()
+
+# The per-request deuce.context. A single instance is shared by every
+# request so that concurrent requests each see only their own thread's
+# attributes instead of replacing one another's context object.
+request_context = threading.local()
+
+
+def bind_request_context(func):
+    """Returns a wrapper that runs func with the request context of the
+    calling thread, so that work handed to another thread still sees
+    the same deuce.context"""
+    attrs = dict(request_context.__dict__)
+
+    @functools.wraps(func)
+    def wrap(*args, **kwargs):
+        request_context.__dict__.update(attrs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            request_context.__dict__.clear()
+    return wrap
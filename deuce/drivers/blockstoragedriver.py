@@ -17,6 +17,10 @@ class BlockStorageDriver(object):
     of files (files exist only as a notion in the metadata layer).
     """
 
+    # Whether the blocks of a download are worth fetching ahead of the
+    # one being sent
+    prefetch = True
+
     @abstractmethod
     def block_exists(self, vault_id, storage_block_id):
         """Determines if the specified block exists in the vault.
@@ -82,6 +86,21 @@ class BlockStorageDriver(object):
                     (True/False), and the storage id of the block"""
         raise NotImplementedError
 
+    def store_block_stream(self, vault_id, metadata_block_id, chunks):
+        """Stores a block whose data arrives as an iterable of chunks
+
+        Drivers that can write incrementally should override this. An
+        exception raised while iterating the chunks must propagate
+        after discarding whatever was written, and nothing may be
+        left behind under the returned storage id.
+
+        :param metadata_block_id: The Metadata ID of the block
+        :param chunks: An iterable of bytes
+        :returns: A tuple containing the status of saving the block to storage
+                    (True/False), and the storage id of the block"""
+        return self.store_block(vault_id, metadata_block_id,
+                                b''.join(chunks))
+
     @abstractmethod
     def store_async_block(self, vault_id, metadata_block_ids, block_datas):
         """Stores blocks asynchronously into the specified vault
@@ -89,7 +108,11 @@ class BlockStorageDriver(object):
         :param vault_id: The IDs of the vault
         :param metadata_block_ids: The Metadata IDs of the blocks
         :param block_datas: The content of the blocks
-        """
+        :returns: A tuple containing whether every block was stored
+                    (True/False), and the storage ids of the blocks in
+                    the order given. The storage id of a block that
+                    failed to be stored is None; the list is empty if
+                    it is not known which blocks were stored."""
         raise NotImplementedError
 
     @abstractmethod
@@ -244,6 +244,14 @@ CQL_GET_BLOCK_STATUS = '''
     AND blockid = %(blockid)s
 '''
 
+CQL_GET_BLOCK_INFO = '''
+    SELECT storageid, blocksize, reftime, isinvalid
+    FROM blocks
+    WHERE projectid = %(projectid)s
+    AND vaultid = %(vaultid)s
+    AND blockid = %(blockid)s
+'''
+
 CQL_HEALTH_CHECK = '''
     SELECT cluster_name
     FROM system.local
@@ -398,6 +406,28 @@ class CassandraStorageDriver(MetadataStorageDriver):
         except IndexError:
             return None
 
+    def get_block_storage_ids(self, vault_id, block_ids):
+        futures = []
+
+        for block_id in block_ids:
+            args = dict(
+                projectid=deuce.context.project_id,
+                vaultid=vault_id,
+                blockid=block_id
+            )
+
+            futures.append(self._session.execute_async(CQL_GET_STORAGE_ID,
+                                                       args))
+
+        storage_ids = []
+        for future in futures:
+            try:
+                storage_ids.append(str(future.result()[0][0]))
+            except IndexError:
+                storage_ids.append(None)
+
+        return storage_ids
+
     def get_block_metadata_id(self, vault_id, storage_id):
         """Retrieve block id for a given storage id"""
         args = dict(
@@ -777,6 +807,10 @@ class CassandraStorageDriver(MetadataStorageDriver):
 
             res = self._session.execute(CQL_REGISTER_BLOCK, args)
 
+    def register_blocks(self, vault_id, block_ids, storage_ids, sizes):
+        for block_id, storage_id, size in zip(block_ids, storage_ids, sizes):
+            self.register_block(vault_id, block_id, storage_id, size)
+
     def unregister_block(self, vault_id, block_id):
 
         self._require_no_block_refs(vault_id, block_id)
@@ -902,6 +936,41 @@ class CassandraStorageDriver(MetadataStorageDriver):
         except IndexError:
             return 0
 
+    def get_block_info(self, vault_id, block_id):
+
+        args = dict(
+            projectid=deuce.context.project_id,
+            vaultid=vault_id,
+            blockid=block_id
+        )
+
+        # The reference count lives in its own counter table, so both
+        # rows are fetched concurrently
+        block_future = self._session.execute_async(CQL_GET_BLOCK_INFO, args)
+        refcount_future = self._session.execute_async(
+            CQL_GET_BLOCK_REF_COUNT, args)
+
+        block_res = block_future.result()
+        refcount_res = refcount_future.result()
+
+        try:
+            storageid, blocksize, reftime, isinvalid = block_res[0]
+        except IndexError:
+            return None
+
+        try:
+            refcount = refcount_res[0][0]
+        except IndexError:
+            refcount = 0
+
+        return dict(
+            storageid=str(storageid),
+            blocksize=blocksize,
+            refcount=refcount,
+            reftime=reftime,
+            isinvalid=bool(isinvalid)
+        )
+
     def get_health(self):
         try:
             args = ()
@@ -1,7 +1,17 @@
+import bisect
+from concurrent import futures
+import contextlib
+import fcntl
+import heapq
 import io
+import itertools
+import json
 import os
 import os.path
 import shutil
+import tempfile
+import threading
+import time
 
 import deuce
 from deuce import conf
@@ -24,8 +34,22 @@ class DiskStorageDriver(BlockStorageDriver):
     vault_permission = 0o750
     block_permission = 0o640
 
+    # Blocks are files that are streamed straight off disk, in bounded
+    # chunks, faster than they could be buffered ahead
+    prefetch = False
+
+    # Characters of the storage id used to name each level of shards
+    shard_width = 2
+
     def __init__(self):
         self._path = conf.block_storage_driver.options.path
+        self._shard_depth = conf.block_storage_driver.options.shard_depth
+        self._stats_rescan_interval = \
+            conf.block_storage_driver.options.stats_rescan_interval
+        self._durability = conf.block_storage_driver.options.durability
+        self._io_threads = conf.block_storage_driver.options.io_threads
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     def _get_project_path(self):
         return os.path.join(self._path, str(deuce.context.project_id))
@@ -33,10 +57,230 @@ class DiskStorageDriver(BlockStorageDriver):
     def _get_vault_path(self, vault_id):
         return os.path.join(self._get_project_path(), vault_id)
 
+    def _get_shards(self, storage_block_id):
+        """Returns the names of the nested shard directories a block
+        lives in, taken from the leading characters of its storage id
+        so that walking the shards in order lists the blocks in order"""
+        width = DiskStorageDriver.shard_width
+        key = str(storage_block_id).ljust(self._shard_depth * width, '_')
+        return [key[level * width:(level + 1) * width]
+                for level in range(self._shard_depth)]
+
     def _get_block_path(self, vault_id, storage_block_id):
+        vault_path = self._get_vault_path(vault_id)
+        return os.path.join(vault_path,
+                            *(self._get_shards(storage_block_id) +
+                              [str(storage_block_id)]))
+
+    def _get_flat_block_path(self, vault_id, storage_block_id):
         vault_path = self._get_vault_path(vault_id)
         return os.path.join(vault_path, str(storage_block_id))
 
+    def _find_block_path(self, vault_id, storage_block_id):
+        """Returns the path of an existing block, or None
+
+        Blocks still in the flat layout of an unmigrated vault are found
+        too. The sharded path is checked again last as the block may be
+        moved by migrate_vault() while we look."""
+        path = self._get_block_path(vault_id, storage_block_id)
+        if os.path.exists(path):
+            return path
+
+        if self._shard_depth:
+            flat_path = self._get_flat_block_path(vault_id, storage_block_id)
+            if os.path.exists(flat_path):
+                return flat_path
+
+            if os.path.exists(path):
+                return path
+
+        return None
+
+    def _make_block_path(self, vault_id, storage_block_id, changed=None):
+        """Returns the path for a new block, creating its shard
+        directories as needed. The vault itself is not created.
+
+        The parent of every directory created is added to changed."""
+        path = self._get_vault_path(vault_id)
+        for shard in self._get_shards(storage_block_id):
+            parent, path = path, os.path.join(path, shard)
+            try:
+                os.mkdir(path, DiskStorageDriver.vault_permission)
+                if changed is not None:
+                    changed.add(parent)
+            except FileExistsError:
+                pass
+
+        return os.path.join(path, str(storage_block_id))
+
+    def _iter_shard(self, path, depth, marker):
+        """Yields, in order, the blocks at or after marker below a
+        shard directory that has depth levels of shards beneath it"""
+        names = sorted(os.listdir(path))
+
+        if depth == 0:
+            start = bisect.bisect_left(names, marker) if marker else 0
+            for name in names[start:]:
+                yield name
+            return
+
+        marker_shard = None
+        if marker:
+            marker_shard = self._get_shards(marker)[-depth]
+
+        for name in names:
+            if marker_shard is not None and name < marker_shard:
+                continue
+
+            # Past the marker's shard every block sorts after the marker
+            yield from self._iter_shard(
+                os.path.join(path, name), depth - 1,
+                marker if name == marker_shard else None)
+
+    def _iter_vault_blocks(self, vault_id, marker=None):
+        """Yields the storage ids of a vault's blocks in order, starting
+        at marker, without listing more of the vault than it must"""
+        path = self._get_vault_path(vault_id)
+
+        if not self._shard_depth:
+            yield from self._iter_shard(path, 0, marker)
+            return
+
+        # Until a vault is migrated its top level holds both shard
+        # directories and blocks in the flat layout.
+        shards = []
+        flat = []
+        for name in sorted(os.listdir(path)):
+            if os.path.isdir(os.path.join(path, name)):
+                shards.append(name)
+            elif not marker or name >= marker:
+                flat.append(name)
+
+        marker_shard = self._get_shards(marker)[0] if marker else None
+
+        def iter_shards():
+            for name in shards:
+                if marker_shard is not None and name < marker_shard:
+                    continue
+                yield from self._iter_shard(
+                    os.path.join(path, name), self._shard_depth - 1,
+                    marker if name == marker_shard else None)
+
+        yield from heapq.merge(flat, iter_shards())
+
+    def migrate_vault(self, vault_id):
+        """Moves the blocks of a vault from the flat layout into their
+        shards. Blocks stay readable throughout, so this can run against
+        a live vault. Returns the number of blocks moved."""
+        path = self._get_vault_path(vault_id)
+        moved = 0
+
+        if not self._shard_depth or not os.path.exists(path):
+            return moved
+
+        for name in os.listdir(path):
+            flat_path = os.path.join(path, name)
+            if os.path.isdir(flat_path):
+                continue
+
+            os.rename(flat_path, self._make_block_path(vault_id, name))
+            moved += 1
+
+        return moved
+
+    def _get_stats_path(self, vault_id):
+        # Vault ids cannot contain a '.' so this never names a vault
+        return os.path.join(self._get_project_path(),
+                            '.stats-{0}.json'.format(vault_id))
+
+    @contextlib.contextmanager
+    def _lock_vault(self, vault_id):
+        """Serializes updates of a vault's statistics between threads
+        and worker processes"""
+        fd = os.open(self._get_vault_path(vault_id), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _read_stats(self, vault_id):
+        """Returns the recorded statistics of a vault, or None if there
+        are none or they cannot be trusted"""
+        try:
+            with open(self._get_stats_path(vault_id), 'r') as infile:
+                stats = json.load(infile)
+
+            return {key: int(stats[key])
+                    for key in ('block-count', 'total-size', 'rescanned')}
+
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+
+    def _write_stats(self, vault_id, stats):
+        """Replaces the recorded statistics of a vault in one rename,
+        so a crash leaves either the old or the new record behind"""
+        fd, temp_path = tempfile.mkstemp(prefix='.stats-',
+                                         dir=self._get_project_path())
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(stats, outfile)
+            os.rename(temp_path, self._get_stats_path(vault_id))
+
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _scan_stats(self, vault_id):
+        total_size = 0
+        object_count = 0
+        for root, dirs, files in os.walk(self._get_vault_path(vault_id)):
+            total_size = total_size + sum(
+                os.path.getsize(
+                    os.path.join(root, name)) for name in files)
+            object_count = object_count + len(files)
+
+        return {'block-count': object_count,
+                'total-size': total_size,
+                'rescanned': int(time.time())}
+
+    def _update_stats(self, vault_id, block_count, total_size):
+        """Adds to the block count and total size of a vault"""
+        if not block_count:
+            return
+
+        try:
+            with self._lock_vault(vault_id):
+                stats = self._read_stats(vault_id)
+
+                if stats is None:
+                    # The blocks just changed are already on disk
+                    stats = self._scan_stats(vault_id)
+                else:
+                    stats['block-count'] += block_count
+                    stats['total-size'] += total_size
+
+                self._write_stats(vault_id, stats)
+
+        except Exception:
+            # Have the next reader rebuild them rather than trust them
+            logger.exception('Failed to update statistics of vault {0}'
+                             .format(vault_id))
+            try:
+                os.remove(self._get_stats_path(vault_id))
+            except OSError:  # pragma: no cover
+                pass
+
+    def rescan_vault_statistics(self, vault_id):
+        """Rebuilds the statistics of a vault from what is on disk,
+        correcting any drift, e.g. from a crash between writing a block
+        and recording it. Returns the new statistics."""
+        with self._lock_vault(vault_id):
+            stats = self._scan_stats(vault_id)
+            self._write_stats(vault_id, stats)
+
+        return stats
+
     def create_vault(self, vault_id):
         path = self._get_vault_path(vault_id)
 
@@ -45,6 +289,7 @@ class DiskStorageDriver(BlockStorageDriver):
             os.chmod(self._get_project_path(),
                      DiskStorageDriver.vault_permission)
             os.chmod(path, DiskStorageDriver.vault_permission)
+            self.rescan_vault_statistics(vault_id)
 
     def vault_exists(self, vault_id):
         path = self._get_vault_path(vault_id)
@@ -54,16 +299,8 @@ class DiskStorageDriver(BlockStorageDriver):
 
         path = self._get_vault_path(vault_id)
         if os.path.exists(path):
-            total_contents = os.listdir(path)
-            total_contents.sort()
-            if marker:
-                try:
-                    index = total_contents.index(marker)
-                    return total_contents[index:(index + limit)]
-                except ValueError:
-                    return []
-            else:
-                return total_contents[:limit]
+            return list(itertools.islice(
+                self._iter_vault_blocks(vault_id, marker), limit))
 
         else:
             return None
@@ -80,16 +317,16 @@ class DiskStorageDriver(BlockStorageDriver):
 
         path = self._get_vault_path(vault_id)
 
-        total_size = 0
-        object_count = 0
-        for root, dirs, files in os.walk(path):
-            total_size = total_size + sum(
-                os.path.getsize(
-                    os.path.join(root, name)) for name in files)
-            object_count = object_count + len(files)
+        if os.path.exists(path):
+            stats = self._read_stats(vault_id)
 
-        statistics['total-size'] = total_size
-        statistics['block-count'] = object_count
+            interval = self._stats_rescan_interval
+            if stats is None or (
+                    interval and time.time() - stats['rescanned'] >= interval):
+                stats = self.rescan_vault_statistics(vault_id)
+
+            statistics['total-size'] = stats['total-size']
+            statistics['block-count'] = stats['block-count']
 
         return statistics
 
@@ -98,10 +335,12 @@ class DiskStorageDriver(BlockStorageDriver):
         try:
             if os.path.exists(path):
 
-                if os.listdir(path) == []:
-                    # There's nothing in the vault.
+                if not any(files for _, _, files in os.walk(path)):
+                    # There's nothing in the vault, at most empty shards.
                     # It's safe to delete
                     shutil.rmtree(path)
+                    if os.path.exists(self._get_stats_path(vault_id)):
+                        os.remove(self._get_stats_path(vault_id))
                     return True
 
                 else:
@@ -116,77 +355,174 @@ class DiskStorageDriver(BlockStorageDriver):
             # An error occurred
             return False
 
+    def _get_pool(self):
+        # Created lazily so no thread exists before a pre-fork
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = futures.ThreadPoolExecutor(
+                    max_workers=self._io_threads)
+            return self._pool
+
+    def _write_temp(self, chunks, temp_dir):
+        """Writes a block to a new temporary file in temp_dir. Returns
+        its path and size.
+
+        Unless durability is 'none' the data is on disk before this
+        returns, so the block can never be seen torn once renamed into
+        place."""
+        fd, temp_path = tempfile.mkstemp(prefix='.upload-', dir=temp_dir)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                for chunk in chunks:
+                    outfile.write(chunk)
+                    size += len(chunk)
+
+                if self._durability != 'none':
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+
+            os.chmod(temp_path, DiskStorageDriver.block_permission)
+
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        return temp_path, size
+
+    def _sync_dirs(self, paths):
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _place_blocks(self, vault_id, blocks):
+        """Renames written blocks, (temp_path, size, storage_id) tuples,
+        into place. Returns whether each block was placed; the temporary
+        file of a block that was not is removed.
+
+        With 'directory' durability the directories are synced
+        afterwards, once each however many blocks went into them, so a
+        batch pays for its directories rather than for every block. If
+        that fails none of the blocks can be relied upon, so the placed
+        blocks are removed again before the error is raised."""
+        changed = set()
+        placed = []
+        placed_paths = []
+        placed_size = 0
+        try:
+            for temp_path, size, storage_id in blocks:
+                try:
+                    path = self._make_block_path(vault_id, storage_id,
+                                                 changed)
+                    os.rename(temp_path, path)
+
+                except Exception:
+                    logger.exception('Failed to store block {0}'
+                                     .format(storage_id))
+                    os.remove(temp_path)
+                    placed.append(False)
+                    continue
+
+                changed.add(os.path.dirname(path))
+                placed.append(True)
+                placed_paths.append(path)
+                placed_size += size
+
+            if self._durability == 'directory':
+                self._sync_dirs(sorted(changed))
+
+        except Exception:
+            for path in placed_paths:
+                try:
+                    os.remove(path)
+
+                except OSError:
+                    logger.exception('Failed to remove block {0}'
+                                     .format(path))
+            raise
+
+        self._update_stats(vault_id, len(placed_paths), placed_size)
+
+        return placed
+
     def store_block(self, vault_id, metadata_block_id, blockdata):
-        storage_id = self.storage_id(metadata_block_id)
-        path = self._get_block_path(vault_id, storage_id)
+        return self.store_block_stream(vault_id, metadata_block_id,
+                                       [blockdata])
 
-        returnValue = False
-        returnStorageId = ''
-        outfile = None
+    def store_block_stream(self, vault_id, metadata_block_id, chunks):
+        storage_id = self.storage_id(metadata_block_id)
 
+        # The data is spooled into a temporary file next to the vault so
+        # a partial or rejected upload never shows up as a block.
         try:
-            # (BenjamenMeyer) - Using a open() in a context will
-            # oddly result in the exiting of the context being
-            # not covered even though the success and failure
-            # paths can be proven to be covered.
-            outfile = open(path, 'wb')
-            outfile.write(blockdata)
-            outfile.flush()
+            temp_path, size = self._write_temp(chunks,
+                                               self._get_project_path())
+            placed = self._place_blocks(vault_id,
+                                        [(temp_path, size, storage_id)])
 
-            returnValue = True
-            returnStorageId = storage_id
+        except (ValueError, BufferError):
+            raise
 
-        except:
-            returnValue = False
-            returnStorageId = ''
+        except Exception:
+            logger.exception('Failed to store block {0}'
+                             .format(metadata_block_id))
+            return (False, '')
 
-        finally:  # pragma: no cover
-            if outfile is not None:
-                if not outfile.closed:
-                    outfile.close()
-                os.chmod(path, DiskStorageDriver.block_permission)
+        if not placed[0]:
+            return (False, '')
 
-        return (returnValue, returnStorageId)
+        return (True, storage_id)
 
     def store_async_block(self, vault_id, metadata_block_ids, blockdatas):
         storage_ids = [self.storage_id(metadata_block_id)
                        for metadata_block_id in metadata_block_ids]
-        try:
-            for storage_id, blockdata in zip(storage_ids, blockdatas):
-                path = self._get_block_path(vault_id, storage_id)
-
-                # (BenjamenMeyer) - Using a open() in a context will
-                # oddly result in the exiting of the context being
-                # not covered even though the success and failure
-                # paths can be proven to be covered.
-                try:
-                    outfile = open(path, 'wb')
-                    outfile.write(blockdata)
-                    outfile.flush()
 
-                except:
-                    pass
+        # File writes release the GIL, so the blocks are written in
+        # parallel. Every block is written before any is renamed into
+        # place, so the directory syncs can be shared by the batch.
+        temp_dir = self._get_project_path()
+        pending = [self._get_pool().submit(self._write_temp, [blockdata],
+                                           temp_dir)
+                   for blockdata in blockdatas]
 
-                finally:
-                    if outfile is not None:  # pragma: no cover
-                        if not outfile.closed:
-                            outfile.close()
-                        os.chmod(path, DiskStorageDriver.block_permission)
+        written = []
+        for storage_id, future in zip(storage_ids, pending):
+            try:
+                temp_path, size = future.result()
+                written.append((temp_path, size, storage_id))
 
-            return (True, storage_ids)
+            except Exception:
+                logger.exception('Failed to store block {0}'
+                                 .format(storage_id))
 
-        except:
+        try:
+            placed = set(storage_id for (_, _, storage_id), ok
+                         in zip(written, self._place_blocks(vault_id,
+                                                            written))
+                         if ok)
+
+        except Exception:
+            logger.exception('Failed to store blocks in vault {0}'
+                             .format(vault_id))
             return (False, [])
 
+        return (len(placed) == len(storage_ids),
+                [storage_id if storage_id in placed else None
+                 for storage_id in storage_ids])
+
     def block_exists(self, vault_id, storage_block_id):
-        path = self._get_block_path(vault_id, storage_block_id)
-        return os.path.exists(path)
+        return self._find_block_path(vault_id, storage_block_id) is not None
 
     def delete_block(self, vault_id, storage_block_id):
-        path = self._get_block_path(vault_id, storage_block_id)
+        path = self._find_block_path(vault_id, storage_block_id)
 
-        if os.path.exists(path):
+        if path is not None:
+            size = os.path.getsize(path)
             os.remove(path)
+            self._update_stats(vault_id, -1, -size)
             return True
         else:
             return False
@@ -196,18 +532,18 @@ class DiskStorageDriver(BlockStorageDriver):
         block data. If the object cannot be retrieved, the list
         of objects should be returned
         """
-        path = self._get_block_path(vault_id, storage_block_id)
+        path = self._find_block_path(vault_id, storage_block_id)
 
-        if not os.path.exists(path):
+        if path is None:
             return None
 
         return open(path, 'rb')
 
     def get_block_object_length(self, vault_id, storage_block_id):
         """Returns the length of an object"""
-        path = self._get_block_path(vault_id, storage_block_id)
+        path = self._find_block_path(vault_id, storage_block_id)
 
-        if not os.path.exists(path):
+        if path is None:
             return 0
 
         return os.path.getsize(path)
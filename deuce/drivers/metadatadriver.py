@@ -86,6 +86,29 @@ class ConstraintError(Exception):
         Exception.__init__(self, msg)
 
 
+class BlockWriteError(Exception):
+    """BlockWriteError is raised when some of a batch of
+    writes about blocks failed. The writes of the other blocks
+    in the batch went ahead."""
+    def __init__(self, project_id, vault_id, errors):
+        """Creates a new BlockWriteError Exception
+
+        :param vault_id: The vault containing the blocks
+        :param errors: A dict of the ID of each block whose write
+                       failed to a description of why
+        """
+        self.project_id = project_id
+        self.vault_id = vault_id
+        self.errors = errors
+
+        msg = "[{0}/{1}] Failed to write {2} blocks: {3}".format(
+            project_id, vault_id, len(errors),
+            '; '.join('{0}: {1}'.format(block_id, error)
+                      for block_id, error in sorted(errors.items())))
+
+        Exception.__init__(self, msg)
+
+
 @six.add_metaclass(ABCMeta)
 class MetadataStorageDriver(object):
     """MetadataStorageDriver is an abstract base class that
@@ -244,7 +267,8 @@ class MetadataStorageDriver(object):
         :param vault_id: The vault containing the file
         :param file_id: The ID of the file
         :param block_ids: The IDs of the blocks being assigned to the file
-        :param offsets: The positions of the blocks"""
+        :param offsets: The positions of the blocks
+        :raises BlockWriteError: if some of the blocks were not assigned"""
         raise NotImplementedError
 
     @abstractmethod
@@ -252,11 +276,34 @@ class MetadataStorageDriver(object):
         """Registers a block in the metadata driver."""
         raise NotImplementedError
 
+    @abstractmethod
+    def register_blocks(self, vault_id, block_ids, storage_ids, sizes):
+        """Registers many blocks in the metadata driver. Blocks that
+        are already registered are left as they are.
+
+        :param vault_id: The vault containing the blocks
+        :param block_ids: The IDs of the blocks
+        :param storage_ids: The storage IDs of the blocks
+        :param sizes: The sizes of the blocks
+        :raises BlockWriteError: if some of the blocks were not
+            registered"""
+        raise NotImplementedError
+
     @abstractmethod
     def get_block_storage_id(self, vault_id, block_id):
         """Retrieve storage id for a given block id"""
         raise NotImplementedError
 
+    @abstractmethod
+    def get_block_storage_ids(self, vault_id, block_ids):
+        """Retrieve the storage ids of many blocks at once
+
+        :param vault_id: ID of the vault
+        :param block_ids: list of block_id
+        :returns: list of the storage ids, in the order of block_ids,
+            with None for each block that is not registered"""
+        raise NotImplementedError
+
     @abstractmethod
     def get_block_metadata_id(self, vault_id, storage_id):
         """Retrieve block id for a given storage id"""
@@ -295,6 +342,19 @@ class MetadataStorageDriver(object):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def get_block_info(self, vault_id, block_id):
+        """Returns everything the metadata store knows about a block,
+        gathered in as few queries as the backend allows.
+
+        :param vault_id: The ID of the vault containing the block
+        :param block_id: The ID the block to describe
+        :returns: None if the block is not registered, otherwise a dict
+            with the keys storageid, blocksize, refcount, reftime (as
+            returned by get_block_ref_modified) and isinvalid
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def get_health(self):
         """Check the meta driver health status"""
@@ -10,9 +10,39 @@ import atexit
 import datetime
 
 
+import collections
 import itertools
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from deuce.drivers.metadatadriver import MetadataStorageDriver, \
-    GapError, OverlapError, ConstraintError
+    GapError, OverlapError, ConstraintError, BlockWriteError
+from deuce.util import log
+
+logger = log.getLogger(__name__)
+
+# Most requests sent to the server in one bulk write
+BULK_WRITE_SIZE = 1000
+
+# The indexes of each collection, ordered in pymongo.ASCENDING. They are
+# created once, when the driver is constructed, rather than checked for
+# before each query.
+INDEXES = {
+    'vaults': [
+        [('projectid', 1), ('vaultid', 1)]
+    ],
+    'files': [
+        [('projectid', 1), ('vaultid', 1), ('fileid', 1)]
+    ],
+    'blocks': [
+        [('projectid', 1), ('vaultid', 1), ('blockid', 1)],
+        [('projectid', 1), ('vaultid', 1), ('storageid', 1)]
+    ],
+    'fileblocks': [
+        [('projectid', 1), ('vaultid', 1), ('fileid', 1), ('offset', 1)],
+        [('projectid', 1), ('vaultid', 1), ('fileid', 1), ('blockid', 1)],
+        [('projectid', 1), ('vaultid', 1), ('blockid', 1)]
+    ]
+}
 
 
 class MongoDbStorageDriver(MetadataStorageDriver):
@@ -35,6 +65,15 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         # Maintain the document size less than the system maximun.
         self._docnum = int(conf.metadata_driver.mongodb.maxFileBlockSegNum)
 
+        self.create_indexes()
+
+    def create_indexes(self):
+        """Creates the indexes of every collection that do not exist
+        yet"""
+        for collection, indexes in sorted(INDEXES.items()):
+            for index in indexes:
+                self._db[collection].create_index(index)
+
     def create_vaults_generator(self, marker=None, limit=None):
         """Creates and returns a generator that will return
         the vault IDs.
@@ -42,8 +81,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         :param marker: The vault_id to start of the list
         :param limit: Number of returned items
         """
-        self._vaults.ensure_index([('projectid', 1),
-            ('vaultid', 1)])
         args = {'projectid': deuce.context.project_id}
         if marker is not None:
             args["vaultid"] = {"$gte": str(marker)}
@@ -63,8 +100,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def delete_vault(self, vault_id):
         """Deletes the vault from metadata."""
-        self._vaults.ensure_index([('projectid', 1),
-            ('vaultid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -83,8 +118,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         }
 
         def __stats_get_vault_file_count():
-            self._files.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('fileid', 1)])
             result = self._files.find(args)
             if result is None:
                 return 0  # pragma: no cover
@@ -92,8 +125,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
                 return result.count()
 
         def __stats_get_vault_block_count():
-            self._blocks.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('blockid', 1)])
             result = self._blocks.find(args)
             if result is None:
                 return 0  # pragma: no cover
@@ -132,8 +163,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def file_length(self, vault_id, file_id):
         """Retrieve length the of the file."""
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -149,8 +178,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def get_block_storage_id(self, vault_id, block_id):
         """Retrieve storage id for a given block id"""
-        self._blocks.ensure_index([('projectid', 1),
-                                  ('vaultid', 1), ('blockid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -163,11 +190,22 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         else:
             return None
 
+    def get_block_storage_ids(self, vault_id, block_ids):
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': {'$in': [str(block_id) for block_id in block_ids]}
+        }
+
+        storage_ids = {
+            res['blockid']: str(res.get('storageid'))
+            for res in self._blocks.find(args, {'blockid': 1,
+                                                'storageid': 1})
+        }
+        return [storage_ids.get(str(block_id)) for block_id in block_ids]
+
     def get_block_metadata_id(self, vault_id, storage_id):
         """Retrieve block id for a given storage id"""
-        self._blocks.ensure_index([('projectid', 1),
-                                  ('vaultid', 1),
-                                  ('storageid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -181,8 +219,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             return None
 
     def has_file(self, vault_id, file_id):
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -196,8 +232,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         return True
 
     def is_finalized(self, vault_id, file_id):
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -210,40 +244,35 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         return False
 
     def delete_file(self, vault_id, file_id):
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
             'fileid': file_id
         }
 
-        results = self._fileblocks.find(args)
-        block_args = args.copy()
-        del block_args['fileid']
+        refs = collections.Counter(
+            result['blockid']
+            for result in self._fileblocks.find(args, {'blockid': 1}))
 
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
-
-        for result in results:
-            block_args['blockid'] = result['blockid']
-            update_args = {
-                '$set': {
-                    'reftime': int(datetime.datetime.utcnow().timestamp())
-                }
-            }
-            self._blocks.update(block_args, update_args, upsert=False)
+        _, errors = self._bulk_write(
+            self._blocks, self._block_ref_updates(
+                vault_id, dict((blockid, -count)
+                               for blockid, count in refs.items())))
 
         self._files.remove(args)
         self._fileblocks.remove(args)
 
+        # The file is gone regardless; recount_block_refs corrects the
+        # counts that could not be updated
+        for blockid, error in sorted(errors.items()):
+            logger.error('Failed to update the reference count of block '
+                         '{0} in vault {1}: {2}'.format(blockid, vault_id,
+                                                        error))
+
     def finalize_file(self, vault_id, file_id, file_size=None):
         """Updates FILES to set a file to finalized. This function
         makes no assumptions about whether or not the file record actually
         exists"""
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
-
         find_args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -258,20 +287,22 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
         # Check for gap and overlap.
         fileblocks_list = list(self._fileblocks.
-            find(find_args).sort('offset', 1))
+            find(find_args, {'blockid': 1, 'offset': 1}).sort('offset', 1))
+        blocksizes = self._get_block_sizes(
+            vault_id, list(set(item['blockid'] for item in fileblocks_list)))
         expected_offset = 0
 
         for item in fileblocks_list:
             offset = item['offset']
             blockid = item['blockid']
 
-            blockdata = self.get_block_data(vault_id, blockid)
+            blocksize = blocksizes.get(blockid)
 
-            if blockdata is None:
+            if blocksize is None:
                 continue
 
             if offset == expected_offset:
-                expected_offset += int(blockdata['blocksize'])
+                expected_offset += int(blocksize)
             elif offset < expected_offset:  # Overlap scenario
                 raise OverlapError(deuce.context.project_id, vault_id,
                     file_id, blockid, startpos=offset, endpos=expected_offset)
@@ -304,10 +335,30 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         },
             upsert=False)
 
+    def _get_block_sizes(self, vault_id, block_ids):
+        """Looks up the sizes of the blocks, a batch of them per query
+
+        :returns: A dict of the ID of each registered block to its size
+        """
+        blocksizes = {}
+
+        for start in range(0, len(block_ids), BULK_WRITE_SIZE):
+            args = {
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+                'blockid': {
+                    '$in': block_ids[start:start + BULK_WRITE_SIZE]
+                }
+            }
+            blocksizes.update(
+                (block['blockid'], block['blocksize'])
+                for block in self._blocks.find(args, {'blockid': 1,
+                                                      'blocksize': 1}))
+
+        return blocksizes
+
     def get_file_data(self, vault_id, file_id):
         """Returns a tuple representing data for this file"""
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -345,9 +396,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def has_block(self, vault_id, block_id, check_status=False):
         # Query BLOCKS for the block
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
-
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -364,9 +412,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         results = []
 
         for block_id in block_ids:
-            self._blocks.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('blockid', 1)])
-
             args = {
                 'projectid': deuce.context.project_id,
                 'vaultid': vault_id,
@@ -383,9 +428,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def get_block_data(self, vault_id, block_id):
         """Returns the blocksize for this block"""
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
-
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -395,8 +437,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         return self._blocks.find_one(args)
 
     def create_block_generator(self, vault_id, marker=None, limit=None):
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id
@@ -411,8 +451,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def create_file_generator(self, vault_id,
             marker=None, limit=None, finalized=True):
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         limit = self._determine_limit(limit)
 
         args = dict()
@@ -429,9 +467,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
     def create_file_block_generator(self, vault_id, file_id,
             offset=None, limit=None):
 
-        self._fileblocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1), ('offset', 1)])
-
         if limit is None:
             limit = 0
         else:
@@ -468,44 +503,88 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
         return ((res['blockid'], res['offset']) for res in resblocks)
 
-    def assign_block(self, vault_id, file_id, block_id, offset):
-        # TODO(jdp): tweak this to support multiple assignments
-        # TODO(jdp): check for overlaps in metadata
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
-        args = {
-            'projectid': deuce.context.project_id,
-            'vaultid': vault_id,
-            'fileid': file_id,
-            'blockid': block_id,
-            'offset': offset
-        }
+    def _bulk_write(self, collection, requests):
+        """Sends (key, request) pairs to the collection in unordered bulk
+        writes of up to BULK_WRITE_SIZE requests. A request that fails
+        does not stop the others.
+
+        :returns: A set of the keys of the requests that inserted a
+                  document, and a dict of the key of each request that
+                  failed to its error message
+        """
+        upserted = set()
+        errors = {}
+
+        for start in range(0, len(requests), BULK_WRITE_SIZE):
+            keys, chunk = zip(*requests[start:start + BULK_WRITE_SIZE])
+
+            try:
+                result = collection.bulk_write(list(chunk), ordered=False)
+                details = result.bulk_api_result
+            except BulkWriteError as ex:
+                details = ex.details
+
+            upserted.update(keys[item['index']]
+                            for item in details.get('upserted', []))
+            errors.update((keys[item['index']], item.get('errmsg'))
+                          for item in details.get('writeErrors', []))
 
-        self._fileblocks.update(args, args, upsert=True)
-        # Ordered in pymongo.ASCENDING.
-        self._fileblocks.ensure_index([('projectid', 1),
-            ('vaultid', 1),
-            ('fileid', 1),
-            ('blockid', 1)])
-
-        # Update the reftime
-        block_args = args.copy()
-        del block_args['fileid']
-        del block_args['offset']
+        return upserted, errors
+
+    def _block_ref_updates(self, vault_id, refs):
+        """Returns (block_id, request) pairs that update the reftime of
+        each block and add to its refcount
+
+        :param refs: A dict of each block ID to the number of references
+                     it gained, or lost if negative
+        """
         update_args = {
             '$set': {
                 'reftime': int(datetime.datetime.utcnow().timestamp())
             }
         }
 
-        self._blocks.update(block_args, update_args, upsert=False)
+        requests = []
+        for block_id, delta in refs.items():
+            args = {
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+                'blockid': str(block_id)
+            }
+
+            if not delta:
+                requests.append((block_id, UpdateOne(args, update_args)))
+                continue
+
+            # A block without a refcount has none to add to; its
+            # references are counted when asked for. The change of its
+            # references is recorded in refversion, so that
+            # register_blocks does not start a count that misses it.
+            count_update_args = dict(update_args, **{
+                '$inc': {
+                    'refcount': delta
+                }
+            })
+            version_update_args = dict(update_args, **{
+                '$inc': {
+                    'refversion': 1
+                }
+            })
+            requests.append((block_id, UpdateOne(
+                dict(args, refcount={'$exists': True}), count_update_args)))
+            requests.append((block_id, UpdateOne(
+                dict(args, refcount={'$exists': False}),
+                version_update_args)))
+
+        return requests
+
+    def assign_block(self, vault_id, file_id, block_id, offset):
+        self.assign_blocks(vault_id, file_id, [block_id], [offset])
 
     def assign_blocks(self, vault_id, file_id, block_ids, offsets):
-        # TODO(jdp): tweak this to support multiple assignments
         # TODO(jdp): check for overlaps in metadata
-        for block_id, offset in zip(block_ids, offsets):
-            self._files.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('fileid', 1)])
+        requests = []
+        for index, (block_id, offset) in enumerate(zip(block_ids, offsets)):
             args = {
                 'projectid': deuce.context.project_id,
                 'vaultid': vault_id,
@@ -513,47 +592,114 @@ class MongoDbStorageDriver(MetadataStorageDriver):
                 'blockid': block_id,
                 'offset': offset
             }
+            requests.append((index, UpdateOne(args, {'$setOnInsert': args},
+                                              upsert=True)))
 
-            self._fileblocks.update(args, args, upsert=True)
-            # Ordered in pymongo.ASCENDING.
-            self._fileblocks.ensure_index([('projectid', 1),
-                ('vaultid', 1),
-                ('fileid', 1),
-                ('blockid', 1)])
-
-            # Update the reftime
-            block_args = args.copy()
-            del block_args['fileid']
-            del block_args['offset']
-            update_args = {
-                '$set': {
-                    'reftime': int(datetime.datetime.utcnow().timestamp())
+        upserted, errors = self._bulk_write(self._fileblocks, requests)
+
+        # A block assigned again at the same offset gains no reference
+        refs = collections.Counter()
+        for index, block_id in enumerate(block_ids):
+            if index not in errors:
+                refs[block_id] += int(index in upserted)
+
+        _, ref_errors = self._bulk_write(
+            self._blocks, self._block_ref_updates(vault_id, refs))
+
+        errors = dict((block_ids[index], error)
+                      for index, error in errors.items())
+        errors.update(ref_errors)
+        if errors:
+            raise BlockWriteError(deuce.context.project_id, vault_id, errors)
+
+    def _count_blocks_refs(self, vault_id, block_ids):
+        """Counts the references to each of the blocks in the fileblocks
+        collection
+
+        :returns: A collections.Counter of the block IDs
+        """
+        refs = collections.Counter()
+
+        for start in range(0, len(block_ids), BULK_WRITE_SIZE):
+            args = {
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+                'blockid': {
+                    '$in': block_ids[start:start + BULK_WRITE_SIZE]
                 }
             }
+            refs.update(result['blockid'] for result in
+                        self._fileblocks.find(args, {'blockid': 1}))
 
-            self._blocks.update(block_args, update_args, upsert=False)
+        return refs
 
     def register_block(self, vault_id, block_id, storage_id, blocksize):
-        if not self.has_block(vault_id, block_id):
+        self.register_blocks(vault_id, [block_id], [storage_id], [blocksize])
+
+    def register_blocks(self, vault_id, block_ids, storage_ids, sizes):
+        # A block listed twice is registered once, as it is first listed
+        blocks = collections.OrderedDict()
+        for block_id, storage_id, size in zip(block_ids, storage_ids, sizes):
+            blocks.setdefault(str(block_id), (storage_id, size))
+
+        reftime = int(datetime.datetime.utcnow().timestamp())
+
+        # New blocks start out without a refcount, their references
+        # counted when asked for
+        requests = []
+        for block_id, (storage_id, size) in blocks.items():
             args = {
                 'projectid': deuce.context.project_id,
                 'vaultid': vault_id,
-                'blockid': str(block_id),
-                'storageid': storage_id,
-                'blocksize': blocksize,
-                'isinvalid': False,
-                'reftime': int(datetime.datetime.utcnow().timestamp())
+                'blockid': block_id
+            }
+            update_args = {
+                '$setOnInsert': {
+                    'storageid': storage_id,
+                    'blocksize': size,
+                    'isinvalid': False,
+                    'reftime': reftime,
+                    'refversion': 0
+                }
+            }
+            requests.append((block_id, UpdateOne(args, update_args,
+                                                 upsert=True)))
+
+        # Blocks that are already registered are matched and left as
+        # they are
+        inserted, errors = self._bulk_write(self._blocks, requests)
+
+        # A new block that no file refers to keeps count from 0 on,
+        # unless a reference was assigned or removed meanwhile, which
+        # the count may have missed. A count is never written over one
+        # that assignments add to; blocks the files already referred to
+        # are counted on request until recount_block_refs is run.
+        inserted = [block_id for block_id in blocks if block_id in inserted]
+        refs = self._count_blocks_refs(vault_id, inserted)
+        requests = []
+        for block_id in inserted:
+            if refs[block_id]:
+                continue
+            args = {
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+                'blockid': block_id,
+                'refcount': {'$exists': False},
+                'refversion': 0
             }
+            requests.append((block_id, UpdateOne(
+                args, {'$set': {'refcount': 0}})))
 
-            self._blocks.update(args, args, upsert=True)
+        # A block left without a count is still counted correctly
+        self._bulk_write(self._blocks, requests)
+
+        if errors:
+            raise BlockWriteError(deuce.context.project_id, vault_id, errors)
 
     def unregister_block(self, vault_id, block_id):
 
         self._require_no_block_refs(vault_id, block_id)
 
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
-
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -561,11 +707,26 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         }
         self._blocks.remove(args)
 
-    def get_block_ref_count(self, vault_id, block_id):
+    def _count_block_refs(self, vault_id, block_id):
+        """Counts the references to the block in the fileblocks
+        collection, which holds the blocks of every file; the block
+        lists embedded in file documents are never populated."""
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': str(block_id)
+        }
+
+        return self._fileblocks.find(args).count()
 
-        # Blocks can be in two places:
-        # 1) The fileblocks collection for unfinalized files
-        # 2) The files collection for finalized files
+    def _block_ref_count(self, vault_id, block):
+        # Blocks registered before reference counts were kept on them
+        # are counted until recount_block_refs has been run
+        if 'refcount' not in block:
+            return self._count_block_refs(vault_id, block['blockid'])
+        return block['refcount']
+
+    def get_block_ref_count(self, vault_id, block_id):
 
         args = {
             'projectid': deuce.context.project_id,
@@ -573,24 +734,41 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             'blockid': str(block_id)
         }
 
-        fileblocks_cnt = self._fileblocks.find(args).count()
+        block = self._blocks.find_one(args, {'blockid': 1, 'refcount': 1})
+        if block is None:
+            return 0
+
+        return self._block_ref_count(vault_id, block)
+
+    def recount_block_refs(self, vault_id):
+        """Counts the references to each block of the vault afresh and
+        corrects the reference counts kept on the blocks. Assigning a
+        block and counting the reference are separate updates, so a
+        count can drift if the server dies between the two. Blocks that
+        files referred to before they were registered are counted on
+        request until this stores their counts.
 
-        # TODO: we currently count all documents. Let's
-        # optimize this query later
+        :returns: The number of blocks whose count was corrected
+        """
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id
         }
 
-        res = self._files.find(args)
-
-        files_cnt = 0
+        refs = collections.Counter(
+            result['blockid']
+            for result in self._fileblocks.find(args, {'blockid': 1}))
 
-        for doc in res:
-            docgen = (rec['blockid'] for rec in doc['blocks'])
-            files_cnt += sum(1 for _ in docgen)
+        fixed = 0
+        for block in self._blocks.find(args, {'refcount': 1, 'blockid': 1}):
+            count = refs[block['blockid']]
+            if block.get('refcount') != count:
+                self._blocks.update({'_id': block['_id']},
+                                    {'$set': {'refcount': count}},
+                                    upsert=False)
+                fixed += 1
 
-        return files_cnt + fileblocks_cnt
+        return fixed
 
     def get_block_ref_modified(self, vault_id, block_id):
 
@@ -600,6 +778,26 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         except TypeError:
             return 0
 
+    def get_block_info(self, vault_id, block_id):
+
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': str(block_id)
+        }
+
+        block = self._blocks.find_one(args)
+        if block is None:
+            return None
+
+        return {
+            'storageid': str(block.get('storageid')),
+            'blocksize': block.get('blocksize'),
+            'refcount': self._block_ref_count(vault_id, block),
+            'reftime': block.get('reftime'),
+            'isinvalid': bool(block.get('isinvalid'))
+        }
+
     def get_health(self):
         status = ["mongo is active"] if self.client.alive() \
             else ["mongo is not active"]
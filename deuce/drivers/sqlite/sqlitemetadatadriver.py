@@ -1,8 +1,13 @@
+import contextlib
+import functools
 from functools import lru_cache
 
 from deuce import conf
 import deuce
 import importlib
+import os
+import threading
+import time
 
 
 from deuce.drivers.metadatadriver import MetadataStorageDriver,\
@@ -61,6 +66,62 @@ schemas.append([
     """
 ])  # Version 1
 
+schemas.append([
+    """
+    CREATE INDEX IF NOT EXISTS fileblocks_blockid
+    ON fileblocks (projectid, vaultid, blockid)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS fileblocks_offset
+    ON fileblocks (projectid, vaultid, fileid, offset, blockid)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS blocks_storageid
+    ON blocks (projectid, vaultid, storageid)
+    """
+])  # Version 2: block references, file manifests in order, storage ids
+
+# The reference count of a block is kept up to date by the triggers on
+# fileblocks, within the statement (and so the transaction) that adds or
+# removes the reference. A block assigned before it is registered counts
+# its references when it is registered.
+schemas.append([
+    """
+    ALTER TABLE blocks
+    ADD COLUMN refcount INTEGER NOT NULL DEFAULT 0
+    """,
+    """
+    UPDATE blocks
+    SET refcount = (SELECT count(*)
+    FROM fileblocks
+    WHERE fileblocks.projectid = blocks.projectid
+    AND fileblocks.vaultid = blocks.vaultid
+    AND fileblocks.blockid = blocks.blockid)
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS fileblocks_add_ref
+    AFTER INSERT ON fileblocks
+    BEGIN
+        UPDATE blocks
+        SET refcount = refcount + 1
+        WHERE projectid = new.projectid
+        AND vaultid = new.vaultid
+        AND blockid = new.blockid;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS fileblocks_remove_ref
+    AFTER DELETE ON fileblocks
+    BEGIN
+        UPDATE blocks
+        SET refcount = refcount - 1
+        WHERE projectid = old.projectid
+        AND vaultid = old.vaultid
+        AND blockid = old.blockid;
+    END
+    """
+])  # Version 3: block reference counts
+
 CURRENT_DB_VERSION = len(schemas)
 
 SQL_CREATE_VAULT = '''
@@ -184,6 +245,17 @@ SQL_GET_STORAGE_ID = '''
     AND blockid = :blockid
 '''
 
+SQL_GET_STORAGE_IDS = '''
+    SELECT blockid, storageid
+    FROM blocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid IN ({0})
+'''
+
+# Most block ids bound to one query; sqlite allows 999 parameters
+SQL_MAX_IN_PARAMS = 500
+
 SQL_GET_BLOCK_ID = '''
     SELECT blockid
     FROM blocks
@@ -222,6 +294,8 @@ SQL_CREATE_FILEBLOCK_LIST = '''
     SELECT blocks.blockid, fileblocks.offset, blocks.size
     FROM blocks, fileblocks
     WHERE fileblocks.blockid = blocks.blockid
+    AND blocks.projectid = fileblocks.projectid
+    AND blocks.vaultid = fileblocks.vaultid
     AND fileblocks.projectid = :projectid
     AND fileblocks.vaultid = :vaultid
     AND fileblocks.fileid = :fileid
@@ -236,22 +310,31 @@ SQL_FINALIZE_FILE = '''
     AND vaultid=:vaultid
 '''
 
+# NOTE: not INSERT OR REPLACE; a replaced row would not be taken off the
+# reference count of its block
 SQL_ASSIGN_BLOCK_TO_FILE = '''
-    INSERT OR REPLACE INTO fileblocks
+    INSERT OR IGNORE INTO fileblocks
     (projectid, vaultid, fileid, blockid, offset)
     VALUES (:projectid, :vaultid, :fileid, :blockid, :offset)
 '''
 
 SQL_REGISTER_BLOCK = '''
-    INSERT INTO blocks
-    (projectid, vaultid, blockid, storageid, size, reftime)
+    INSERT OR IGNORE INTO blocks
+    (projectid, vaultid, blockid, storageid, size, reftime, refcount)
     VALUES (:projectid, :vaultid, :blockid, :storageid, :blocksize,
-    strftime('%s', 'now'))
+    strftime('%s', 'now'),
+    (SELECT count(*)
+    FROM fileblocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid))
 '''
 
 SQL_UNREGISTER_BLOCK = '''
     DELETE FROM blocks
-    WHERE projectid=:projectid AND blockid=:blockid
+    WHERE projectid=:projectid
+    AND vaultid=:vaultid
+    AND blockid=:blockid
 '''
 
 SQL_MARK_BLOCK_AS_BAD = '''
@@ -270,14 +353,38 @@ SQL_GET_BLOCK_STATUS = '''
     AND vaultid = :vaultid
 '''
 
+SQL_GET_BLOCKS_STATUS = '''
+    SELECT blockid, isinvalid
+    FROM blocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid IN ({0})
+'''
+
 SQL_GET_BLOCK_REF_COUNT = '''
-    SELECT count(*)
-    FROM fileblocks
+    SELECT refcount
+    FROM blocks
     WHERE projectid = :projectid
     AND vaultid = :vaultid
     AND blockid = :blockid
 '''
 
+SQL_RECOUNT_BLOCK_REFS = '''
+    UPDATE blocks
+    SET refcount = (SELECT count(*)
+    FROM fileblocks
+    WHERE fileblocks.projectid = blocks.projectid
+    AND fileblocks.vaultid = blocks.vaultid
+    AND fileblocks.blockid = blocks.blockid)
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND refcount != (SELECT count(*)
+    FROM fileblocks
+    WHERE fileblocks.projectid = blocks.projectid
+    AND fileblocks.vaultid = blocks.vaultid
+    AND fileblocks.blockid = blocks.blockid)
+'''
+
 SQL_UPDATE_REF_TIME = '''
     UPDATE blocks
     SET reftime = strftime('%s', 'now')
@@ -294,6 +401,155 @@ SQL_GET_REF_TIME = '''
     AND blockid = :blockid
 '''
 
+SQL_GET_BLOCK_INFO = '''
+    SELECT storageid, size, reftime, isinvalid, refcount
+    FROM blocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
+'''
+
+
+class SerializedConnection(object):
+
+    """Shares one sqlite connection between request threads.
+
+    Each statement is executed, and its rows fetched, while holding a
+    lock so no two threads ever drive the connection at the same time.
+
+    The connection is in autocommit mode and transaction() begins and
+    ends transactions itself, as the sqlite3 module would otherwise
+    commit on its own before schema changes.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    def execute(self, *args):
+        with self._lock:
+            return iter(self._conn.execute(*args).fetchall())
+
+    def executemany(self, *args):
+        with self._lock:
+            self._conn.executemany(*args)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the statements of the with block as one transaction,
+        committed at the end of the block or rolled back if it raises.
+        Other threads' statements wait until it is over. A nested block
+        is part of the outermost one."""
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute('BEGIN')
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._depth == 1:
+                    self._conn.execute('ROLLBACK')
+                raise
+            else:
+                if self._depth == 1:
+                    self._conn.execute('COMMIT')
+            finally:
+                self._depth -= 1
+
+    def commit(self):
+        # Every statement outside of transaction() commits by itself
+        pass
+
+
+class ThreadLocalConnection(object):
+
+    """Gives each thread (of each process) its own connection to a
+    database file, so that with the WAL journal readers go ahead while
+    another thread writes.
+
+    Connections are in autocommit mode; transaction() takes the write
+    lock up front. A statement that finds the database locked for
+    longer than the busy timeout is retried a few times before the
+    error is raised.
+    """
+
+    def __init__(self, connect, options, errors):
+        """
+        :param connect: Opens a new connection to the database
+        :param options: The [[sqlite]] configuration
+        :param errors: The exception raised when the database is locked
+        """
+        self._connect = connect
+        self._options = options
+        self._errors = errors
+        self._local = threading.local()
+
+    def _open(self):
+        options = self._options
+        conn = self._connect(timeout=options.busy_timeout / 1000.0,
+                             isolation_level=None)
+
+        # NOTE: pragmas take no query parameters; these values have all
+        # been validated against the configspec
+        conn.execute('pragma journal_mode=%s' % options.journal_mode)
+        conn.execute('pragma synchronous=%s' % options.synchronous)
+        conn.execute('pragma mmap_size=%d' % options.mmap_size)
+        conn.execute('pragma cache_size=%d' % options.cache_size)
+        return conn
+
+    @property
+    def _conn(self):
+        # A connection must not be used across a fork
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.conn = self._open()
+            self._local.pid = pid
+        return self._local.conn
+
+    def _retry(self, func, *args):
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except self._errors as ex:
+                if 'locked' not in str(ex) or \
+                        attempt >= self._options.busy_retries:
+                    raise
+
+            attempt += 1
+            time.sleep(0.01 * 2 ** attempt)
+
+    def execute(self, *args):
+        return iter(self._retry(
+            lambda: self._conn.execute(*args).fetchall()))
+
+    def executemany(self, *args):
+        self._retry(self._conn.executemany, *args)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the statements of the with block as one transaction,
+        committed at the end of the block or rolled back if it raises.
+        A nested block is part of the outermost one."""
+        conn = self._conn
+        if conn.in_transaction:
+            yield self
+            return
+
+        self._retry(conn.execute, 'BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            self._retry(conn.execute, 'COMMIT')
+
+    def commit(self):
+        # Every statement outside of transaction() commits by itself
+        pass
+
 
 class SqliteStorageDriver(MetadataStorageDriver):
 
@@ -303,7 +559,17 @@ class SqliteStorageDriver(MetadataStorageDriver):
         # Load the driver module according to the configuration
         deuce.db_pack = importlib.import_module(
             conf.metadata_driver.sqlite.db_module)
-        self._conn = getattr(deuce.db_pack, 'Connection')(self._dbfile)
+        connect = functools.partial(getattr(deuce.db_pack, 'Connection'),
+                                    self._dbfile, check_same_thread=False)
+
+        # An in-memory database exists only within its one connection
+        if self._dbfile == ':memory:':
+            self._conn = SerializedConnection(
+                connect(isolation_level=None))
+        else:
+            self._conn = ThreadLocalConnection(
+                connect, conf.metadata_driver.sqlite,
+                getattr(deuce.db_pack, 'OperationalError'))
 
         self._do_migrate()
 
@@ -325,11 +591,13 @@ class SqliteStorageDriver(MetadataStorageDriver):
         for ver in range(db_ver, CURRENT_DB_VERSION):
             schema = schemas[db_ver]
 
-            for query in schema:
-                self._conn.execute(query)
+            # A version is either applied in full or not at all
+            with self._conn.transaction() as conn:
+                for query in schema:
+                    conn.execute(query)
 
-            db_ver = db_ver + 1
-            self._set_user_version(db_ver)
+                db_ver = db_ver + 1
+                self._set_user_version(db_ver)
 
     def _determine_marker(self, marker):
         """Determines the default marker to use if
@@ -461,6 +729,35 @@ class SqliteStorageDriver(MetadataStorageDriver):
         except StopIteration:
             return None
 
+    def _execute_in(self, query, vault_id, block_ids):
+        """Runs query, whose IN clause is left as {0}, for the block ids
+        a chunk at a time and yields the rows of every chunk"""
+        block_ids = list(block_ids)
+
+        for start in range(0, len(block_ids), SQL_MAX_IN_PARAMS):
+            chunk = block_ids[start:start + SQL_MAX_IN_PARAMS]
+
+            args = {
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+            }
+            args.update(('blockid{0}'.format(i), block_id)
+                        for i, block_id in enumerate(chunk))
+
+            in_clause = ', '.join(':blockid{0}'.format(i)
+                                  for i in range(len(chunk)))
+
+            for row in self._conn.execute(query.format(in_clause), args):
+                yield row
+
+    def get_block_storage_ids(self, vault_id, block_ids):
+        storage_ids = {
+            row[0]: str(row[1])
+            for row in self._execute_in(SQL_GET_STORAGE_IDS, vault_id,
+                                        set(block_ids))
+        }
+        return [storage_ids.get(block_id) for block_id in block_ids]
+
     def get_block_metadata_id(self, vault_id, storage_id):
         """Retrieve block id for a given storage id"""
         args = {
@@ -512,14 +809,10 @@ class SqliteStorageDriver(MetadataStorageDriver):
             'vaultid': vault_id,
             'fileid': file_id
         }
-        res = self._conn.execute(SQL_UPDATE_REF_TIME_BLOCKS_IN_FILE, args)
-        self._conn.commit()
-
-        res = self._conn.execute(SQL_DELETE_FILE, args)
-        self._conn.commit()
-
-        res = self._conn.execute(SQL_DELETE_FILE_BLOCKS_FOR_FILE, args)
-        self._conn.commit()
+        with self._conn.transaction() as conn:
+            conn.execute(SQL_UPDATE_REF_TIME_BLOCKS_IN_FILE, args)
+            conn.execute(SQL_DELETE_FILE, args)
+            conn.execute(SQL_DELETE_FILE_BLOCKS_FOR_FILE, args)
 
     def finalize_file(self, vault_id, file_id, file_size=None):
         """Updates the files table to set a file to finalized and record
@@ -644,21 +937,15 @@ class SqliteStorageDriver(MetadataStorageDriver):
         return SqliteStorageDriver._block_exists(res, check_status)
 
     def has_blocks(self, vault_id, block_ids, check_status=False):
-        results = []
-
-        for block_id in block_ids:
-            args = {
-                'projectid': deuce.context.project_id,
-                'vaultid': vault_id,
-                'blockid': block_id
-            }
-
-            res = list(self._conn.execute(SQL_GET_BLOCK_STATUS, args))
-
-            if SqliteStorageDriver._block_exists(res, check_status) is False:
-                results.append(block_id)
+        statuses = {
+            row[0]: [row[1:]]
+            for row in self._execute_in(SQL_GET_BLOCKS_STATUS, vault_id,
+                                        set(block_ids))
+        }
 
-        return results
+        return [block_id for block_id in block_ids
+                if SqliteStorageDriver._block_exists(
+                    statuses.get(block_id, []), check_status) is False]
 
     def create_block_generator(self, vault_id, marker=None,
             limit=None):
@@ -713,55 +1000,37 @@ class SqliteStorageDriver(MetadataStorageDriver):
         return [(row[0], row[1]) for row in query_res]
 
     def assign_block(self, vault_id, file_id, block_id, offset):
-        # TODO(jdp): tweak this to support multiple assignments
-        args = {
+        self.assign_blocks(vault_id, file_id, [block_id], [offset])
+
+    def assign_blocks(self, vault_id, file_id, block_ids, offsets):
+        rows = [{
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
             'fileid': file_id,
             'blockid': block_id,
             'offset': offset
-        }
-
-        self._conn.execute(SQL_ASSIGN_BLOCK_TO_FILE, args)
+        } for block_id, offset in zip(block_ids, offsets)]
 
-        del args['fileid']
-        del args['offset']
-        self._conn.execute(SQL_UPDATE_REF_TIME, args)
-
-        self._conn.commit()
-
-    def assign_blocks(self, vault_id, file_id, block_ids, offsets):
-        # TODO(jdp): tweak this to support multiple assignments
-
-        for block_id, offset in zip(block_ids, offsets):
-            args = {
-                'projectid': deuce.context.project_id,
-                'vaultid': vault_id,
-                'fileid': file_id,
-                'blockid': block_id,
-                'offset': offset
-            }
-
-            self._conn.execute(SQL_ASSIGN_BLOCK_TO_FILE, args)
-
-            del args['fileid']
-            del args['offset']
-            self._conn.execute(SQL_UPDATE_REF_TIME, args)
-
-            self._conn.commit()
+        # Either every block is assigned or, on failure, none is
+        with self._conn.transaction() as conn:
+            conn.executemany(SQL_ASSIGN_BLOCK_TO_FILE, rows)
+            conn.executemany(SQL_UPDATE_REF_TIME, rows)
 
     def register_block(self, vault_id, block_id, storage_id, blocksize):
-        if not self.has_block(vault_id, block_id):
-            args = {
-                'projectid': deuce.context.project_id,
-                'vaultid': vault_id,
-                'blockid': block_id,
-                'blocksize': int(blocksize),
-                'storageid': storage_id
-            }
+        self.register_blocks(vault_id, [block_id], [storage_id], [blocksize])
 
-            self._conn.execute(SQL_REGISTER_BLOCK, args)
-            self._conn.commit()
+    def register_blocks(self, vault_id, block_ids, storage_ids, sizes):
+        rows = [{
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': block_id,
+            'blocksize': int(size),
+            'storageid': storage_id
+        } for block_id, storage_id, size in zip(block_ids, storage_ids,
+                                                sizes)]
+
+        with self._conn.transaction() as conn:
+            conn.executemany(SQL_REGISTER_BLOCK, rows)
 
     def unregister_block(self, vault_id, block_id):
 
@@ -786,9 +1055,26 @@ class SqliteStorageDriver(MetadataStorageDriver):
 
         query_res = self._conn.execute(SQL_GET_BLOCK_REF_COUNT, args)
 
-        count = next(query_res)[0]
+        try:
+            return next(query_res)[0]
+        except StopIteration:
+            return 0
 
-        return count if not None else 0
+    def recount_block_refs(self, vault_id):
+        """Counts the references to each block of the vault afresh and
+        corrects the reference counts kept on the blocks, should they
+        have drifted (e.g. after the database was edited by hand)
+
+        :returns: The number of blocks whose count was corrected
+        """
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id
+        }
+
+        with self._conn.transaction() as conn:
+            conn.execute(SQL_RECOUNT_BLOCK_REFS, args)
+            return next(conn.execute('SELECT changes()'))[0]
 
     def get_block_ref_modified(self, vault_id, block_id):
 
@@ -805,6 +1091,29 @@ class SqliteStorageDriver(MetadataStorageDriver):
         except:
             return 0
 
+    def get_block_info(self, vault_id, block_id):
+
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': block_id
+        }
+
+        query_res = self._conn.execute(SQL_GET_BLOCK_INFO, args)
+
+        try:
+            storageid, size, reftime, isinvalid, refcount = next(query_res)
+        except StopIteration:
+            return None
+
+        return {
+            'storageid': str(storageid),
+            'blocksize': size,
+            'refcount': refcount,
+            'reftime': reftime,
+            'isinvalid': bool(isinvalid)
+        }
+
     def get_health(self):
         try:
             # TODO: Collect more system statistics.
@@ -11,8 +11,6 @@ from deuce.util import log
 logger = log.getLogger(__name__)
 from swiftclient.exceptions import ClientException
 
-from six import BytesIO
-
 import deuce
 
 
@@ -149,7 +147,18 @@ class SwiftStorageDriver(BlockStorageDriver):
                 contents=blockdatas,
                 etag=True,
                 response_dict=response)
-            return (response['status'] == 201, storage_ids)
+
+            if response['status'] == 201:
+                return (True, storage_ids)
+
+            # Report the objects that made it, if we know which did
+            statuses = response.get('statuses')
+            if statuses is None:
+                return (False, [])
+
+            return (False, [storage_id if status == 201 else None
+                            for storage_id, status
+                            in zip(storage_ids, statuses)])
         except ClientException:
             return (False, [])
 
@@ -183,43 +192,27 @@ class SwiftStorageDriver(BlockStorageDriver):
             return False
 
     def get_block_obj(self, vault_id, storage_block_id):
-
+        """Returns a file-like object that streams the block as it is
+        downloaded, or None if the block cannot be retrieved"""
         try:
-            buff = BytesIO()
-            response = dict()
-            # NOTE(TheSriram): block is a tuple of
-            # headers and response body.
-            block = self.Conn.get_object(
+            return self.Conn.get_object_stream(
                 url=deuce.context.openstack.swift.storage_url,
                 token=deuce.context.openstack.auth_token,
                 container=vault_id,
-                name=str(storage_block_id),
-                response_dict=response)
-
-            if block[1]:
-                buff.write(block[1])
-                buff.seek(0)
-                return buff
-            else:
-                return None
+                name=str(storage_block_id))
         except ClientException:
             return None
 
     def get_block_object_length(self, vault_id, storage_block_id):
         """Returns the length of an object"""
-        response = dict()
         try:
-            # NOTE(TheSriram): block is a tuple of
-            # headers and response body
-            block = \
-                self.Conn.get_object(
-                    url=deuce.context.openstack.swift.storage_url,
-                    token=deuce.context.openstack.auth_token,
-                    container=vault_id,
-                    name=str(storage_block_id),
-                    response_dict=response)
-
-            return len(block[1])
+            headers = self.Conn.head_object(
+                url=deuce.context.openstack.swift.storage_url,
+                token=deuce.context.openstack.auth_token,
+                container=vault_id,
+                name=str(storage_block_id))
+
+            return int(headers['content-length'])
 
         except ClientException:
             return 0
@@ -10,11 +10,12 @@ logger = logging.getLogger(__name__)
 class Block(object):
 
     def __init__(self, vault_id, metadata_block_id, obj=None,
-            storage_block_id=None):
+            storage_block_id=None, info=None):
         self.vault_id = vault_id
         self.metadata_block_id = metadata_block_id
         self.storage_block_id = storage_block_id
         self._fileobj = obj
+        self._info = info
 
     def get_obj(self):
         """Returns a file-like object that can be used for
@@ -23,21 +24,42 @@ class Block(object):
         """
         return self._fileobj
 
+    def get_info(self):
+        """Returns the metadata of this block as described by
+        MetadataStorageDriver.get_block_info. It is fetched once
+        and reused by the other getters.
+        """
+        if self._info is None and self.metadata_block_id is not None:
+            self._info = deuce.metadata_driver.get_block_info(
+                self.vault_id, self.metadata_block_id)
+        return self._info
+
     def get_ref_count(self):
         """Returns the number of references to this block
         """
+        info = self.get_info()
+        if info is not None:
+            return info['refcount']
+
+        # Blocks can be referenced by files before they are registered
         return deuce.metadata_driver.get_block_ref_count(
             self.vault_id, self.metadata_block_id)
 
     def get_ref_modified(self):
         """Returns the last modification time of this block
         """
-        return deuce.metadata_driver.get_block_ref_modified(
-            self.vault_id, self.metadata_block_id)
+        info = self.get_info()
+        return info['reftime'] if info is not None else 0
 
     def get_block_length(self):
-        """Returns the length of this block from storage
+        """Returns the length of this block, as recorded in metadata
+        when it was registered or else as found in storage
         """
+        if self.metadata_block_id is not None:
+            info = self.get_info()
+            if info is not None:
+                return info['blocksize']
+
         storage_id = self.get_storage_id()
         return deuce.storage_driver.get_block_object_length(
             self.vault_id, storage_id)
@@ -45,7 +67,7 @@ class Block(object):
     def get_storage_id(self):
         """Returns the storage id for a given block"""
         if self.metadata_block_id is not None:
-            return deuce.metadata_driver.get_block_storage_id(
-                self.vault_id, self.metadata_block_id)
+            info = self.get_info()
+            return info['storageid'] if info is not None else None
         else:
             return self.storage_block_id
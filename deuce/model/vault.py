@@ -1,11 +1,22 @@
 from deuce.model.block import Block
 from deuce.model.file import File
 from deuce.model.exceptions import ConsistencyError
+from deuce.drivers.metadatadriver import BlockWriteError
+from deuce.common import local
+from deuce.util import BlockStream
+from deuce.util import LRUCache
 from deuce.util import log as logging
+from deuce.util.readahead import readahead
 
+from concurrent import futures
+from deuce import conf
 import deuce
+import functools
+import io
+import threading
 import uuid
 import hashlib
+import itertools
 
 
 logger = logging.getLogger(__name__)
@@ -13,10 +24,33 @@ logger = logging.getLogger(__name__)
 
 class Vault(object):
 
+    # Number of blocks from a multi-block upload that are held in memory
+    # and stored together
+    async_batch_size = 16
+
+    # Vaults known to exist, keyed by (project_id, vault_id). Only
+    # existence is cached so that a vault created by another process
+    # is never reported missing.
+    cache = LRUCache(conf.api_configuration.vault_cache_size,
+                     conf.api_configuration.vault_cache_ttl)
+
+    # Threads that fetch the blocks of every download ahead of the one
+    # being sent
+    _prefetch_pool = None
+    _prefetch_lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(vault_id):
+        return (deuce.context.project_id, vault_id)
+
     @staticmethod
     def get(vault_id):
 
+        if Vault.cache.get(Vault._cache_key(vault_id)):
+            return Vault(vault_id)
+
         if deuce.storage_driver.vault_exists(vault_id):
+            Vault.cache.set(Vault._cache_key(vault_id), True)
             return Vault(vault_id)
 
         return None
@@ -31,6 +65,7 @@ class Vault(object):
         """Creates the vault with the specified vault_id"""
         deuce.storage_driver.create_vault(vault_id)
         deuce.metadata_driver.create_vault(vault_id)
+        Vault.cache.set(Vault._cache_key(vault_id), True)
         return Vault(vault_id)
 
     def __init__(self, vault_id):
@@ -57,21 +92,20 @@ class Vault(object):
 
         return vault_stats
 
-    def put_block(self, block_id, blockdata, data_len):
+    def put_block(self, block_id, stream, data_len):
+        """Streams a block from a file-like object into block storage
 
-        # Validate the hash of the block data against block_id
-        if hashlib.sha1(blockdata).hexdigest() != block_id:
-            raise ValueError('Invalid Hash Value in the block ID')
+        The data is hashed and counted as it is stored; the block is only
+        registered if it matches both block_id and data_len.
 
-        actual_block_length = len(blockdata)
-        if actual_block_length != data_len:
-            raise BufferError(
-                'Specified block length ({0}) does not match '
-                'actual block length ({1})'.format(
-                    data_len, actual_block_length))
+        :raises ValueError: The data does not hash to block_id
+        :raises BufferError: The data is not data_len bytes long
+        """
+        if data_len is None:
+            raise BufferError('Block length was not specified')
 
-        retval, storage_id = deuce.storage_driver.store_block(
-            self.id, block_id, blockdata)
+        retval, storage_id = deuce.storage_driver.store_block_stream(
+            self.id, block_id, BlockStream(stream, block_id, data_len))
 
         if retval:
             deuce.metadata_driver.register_block(
@@ -93,47 +127,92 @@ class Vault(object):
             block_ids,
             blockdatas)
 
-        retblocks = []
-
         # (BenjamenMeyer): If we fail to upload any one block then we
-        # let the Validation and Clean-Up Service remove any uploaded blocks
-        # and fail out the request as a whole
-        if retval:
-            # Note: zip() will produce a list of the shortest combination.
-            # That is, if a = (1, 2, 3) and b = (a, b) then
-            # zip(a, b) = ((1, a), (2, b)). If 'a' is the storage id for '2'
-            # because '1' failed to be stored, then the entire list is
-            # improperly shifted and we incorrectly report which blocks were
-            # saved, thus corrupting the data
-            for block_id, storageid, blockdata, block_size in zip(block_ids,
-                                                                  storage_ids,
-                                                                  blockdatas,
-                                                                  block_sizes):
-                logger.info('Project {0}, Vault {1}: Associating metadata '
-                            'block {2} with storage block {3}'
-                            .format(deuce.context.project_id,
-                                    self.id,
-                                    block_id,
-                                    storageid))
-                deuce.metadata_driver.register_block(
-                    self.id,
-                    block_id,
-                    storageid,
-                    block_size)
-                retblocks.append((block_id, storageid))
+        # fail out the request as a whole. The blocks that did land are
+        # still registered; the driver reports a storage id of None for
+        # those that did not, keeping the list in step with block_ids.
+        stored = [(block_id, storageid, block_size)
+                  for block_id, storageid, block_size in zip(block_ids,
+                                                             storage_ids,
+                                                             block_sizes)
+                  if storageid is not None]
+
+        for block_id, storageid, _ in stored:
+            logger.info('Project {0}, Vault {1}: Associating metadata '
+                        'block {2} with storage block {3}'
+                        .format(deuce.context.project_id,
+                                self.id,
+                                block_id,
+                                storageid))
+
+        if stored:
+            try:
+                deuce.metadata_driver.register_blocks(self.id, *zip(*stored))
+            except BlockWriteError as ex:
+                # The blocks that could not be registered failed as well
+                logger.error(str(ex))
+                retval = False
+                stored = [block for block in stored
+                          if block[0] not in ex.errors]
+
+        retblocks = [(block_id, storageid)
+                     for block_id, storageid, _ in stored]
 
         return (retval, retblocks)
 
+    def put_async_block_stream(self, blocks, batch_size=None):
+        """Stores (block_id, block_data) pairs as they are produced
+
+        At most batch_size blocks are held and stored at a time, so the
+        memory needed does not grow with the number of blocks.
+
+        Each batch is stored and registered before the next is read.
+        Should reading the blocks (or storing a batch) fail part way,
+        the batches before stay stored and registered; like any block
+        no file refers to, they are left for the client to retry into
+        or to be cleaned up.
+
+        :returns: A tuple of the overall status and a list of
+                  (block_id, storage_id) for every block stored
+        """
+        batch_size = batch_size or self.async_batch_size
+        blocks = iter(blocks)
+        retblocks = []
+
+        while True:
+            batch = list(itertools.islice(blocks, batch_size))
+            if not batch:
+                break
+
+            block_ids, blockdatas = zip(*batch)
+            retval, stored = self.put_async_block(block_ids, blockdatas)
+            retblocks.extend(stored)
+
+            if not retval:
+                return (False, retblocks)
+
+        return (True, retblocks)
+
     def get_blocks(self, marker, limit):
         gen = deuce.metadata_driver.create_block_generator(
             self.id, marker=marker, limit=limit)
 
         return (Block(self.id, bid) for bid in gen)
 
-    def has_block(self, block_id, check_storage=False):
-        if self._meta_has_block(block_id):
+    def has_block(self, block_id, check_storage=False, info=None):
+        """Returns whether the block is known to metadata, and if
+        check_storage is set raises ConsistencyError if it is missing
+        from storage.
+
+        :param info: The metadata of the block, if the caller already
+                     has it; otherwise it is looked up
+        """
+        if info is None:
+            info = deuce.metadata_driver.get_block_info(self.id, block_id)
+        if info is not None:
             if check_storage:
-                if not self._storage_has_block(block_id):
+                if not deuce.storage_driver.block_exists(
+                        self.id, info['storageid']):
 
                     # Record in metadata that the block is bad
                     deuce.metadata_driver.mark_block_as_bad(
@@ -147,24 +226,57 @@ class Vault(object):
         else:
             return False
 
-    def _storage_has_block(self, block_id):
-        return deuce.storage_driver.block_exists(self.id,
-            self._get_storage_id(block_id))
+    def get_block(self, block_id):
+        info = deuce.metadata_driver.get_block_info(self.id, block_id)
+        if info is None:
+            return None
 
-    def _meta_has_block(self, block_id):
-        return deuce.metadata_driver.has_block(self.id, block_id)
+        obj = deuce.storage_driver.get_block_obj(self.id, info['storageid'])
 
-    def get_block(self, block_id):
-        storage_id = self._get_storage_id(block_id)
-        obj = deuce.storage_driver.get_block_obj(self.id, storage_id)
+        return Block(self.id, block_id, obj, info=info) if obj else None
 
-        return Block(self.id, block_id, obj) if obj else None
+    def get_blocks_generator(self, block_ids, sizes=None):
+        """Returns a generator of file-like objects over the blocks,
+        in order.
 
-    def get_blocks_generator(self, block_ids):
-        storage_ids = [
-            self._get_storage_id(block_id) for block_id in block_ids]
-        return deuce.storage_driver.create_blocks_generator(
-            self.id, storage_ids)
+        When the size of each block is given and the storage driver
+        benefits from it, the blocks are fetched from storage ahead of
+        the consumer, up to prefetch_blocks blocks or prefetch_bytes
+        bytes at a time, in the pool shared by every download.
+        """
+        storage_ids = deuce.metadata_driver.get_block_storage_ids(
+            self.id, block_ids)
+
+        depth = conf.api_configuration.prefetch_blocks
+        if sizes is None or not depth or \
+                not deuce.storage_driver.prefetch:
+            return deuce.storage_driver.create_blocks_generator(
+                self.id, storage_ids)
+
+        fetch = local.bind_request_context(self._fetch_block)
+        jobs = ((size, functools.partial(fetch, storage_id))
+                for size, storage_id in zip(sizes, storage_ids))
+        return readahead(jobs, depth, conf.api_configuration.prefetch_bytes,
+                         self._get_prefetch_pool())
+
+    @staticmethod
+    def _get_prefetch_pool():
+        # Created lazily so no thread exists before a pre-fork
+        with Vault._prefetch_lock:
+            if Vault._prefetch_pool is None:
+                Vault._prefetch_pool = futures.ThreadPoolExecutor(
+                    max_workers=conf.api_configuration.prefetch_threads)
+            return Vault._prefetch_pool
+
+    def _fetch_block(self, storage_id):
+        obj = deuce.storage_driver.get_block_obj(self.id, storage_id)
+        if obj is None:
+            return None
+
+        try:
+            return io.BytesIO(obj.read())
+        finally:
+            obj.close()
 
     def delete_block(self, vault_id, block_id):
         storage_id = self._get_storage_id(block_id)
@@ -204,6 +316,7 @@ class Vault(object):
     def delete(self):
         succ = deuce.storage_driver.delete_vault(self.id)
         if succ:
+            Vault.cache.invalidate(Vault._cache_key(self.id))
             deuce.metadata_driver.delete_vault(self.id)
         return succ
 
@@ -11,6 +11,7 @@ import six
 from six.moves.urllib.parse import urlparse, parse_qs
 
 import deuce
+from deuce.common import local
 from deuce.transport.wsgi import v1_0
 from deuce.transport.wsgi.driver import Driver
 import deuce.util.log as logging
@@ -78,6 +79,7 @@ class TestBase(unittest.TestCase):
         super(TestBase, self).tearDown()
         import deuce
         deuce.context = None
+        local.request_context.__dict__.clear()
 
     def create_auth_token(self):
         """Create a dummy Auth Token."""
@@ -5,7 +5,10 @@
 #
 # Or from a mocking package...
 
+from mongomock import Collection
 from mongomock.connection import Connection
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
 
 
 class Mock_Connection(Connection):
@@ -21,5 +24,51 @@ class Mock_Connection(Connection):
         return True
 
 
+def bulk_write(self, requests, ordered=True):
+    """mongomock has no bulk writes; this runs the UpdateOne requests
+    one at a time and reports on them the way the server does. A
+    request that raises is reported as a write error."""
+    result = {
+        'writeErrors': [],
+        'writeConcernErrors': [],
+        'nInserted': 0,
+        'nUpserted': 0,
+        'nMatched': 0,
+        'nModified': 0,
+        'nRemoved': 0,
+        'upserted': []
+    }
+
+    for index, request in enumerate(requests):
+        try:
+            res = self.update(request._filter, request._doc,
+                              upsert=request._upsert)
+        except Exception as ex:
+            result['writeErrors'].append({
+                'index': index,
+                'code': 2,
+                'errmsg': str(ex),
+                'op': request._doc
+            })
+            if ordered:
+                break
+            continue
+
+        if res.get('updatedExisting'):
+            result['nMatched'] += res['n']
+            result['nModified'] += res['n']
+        elif res.get('n'):
+            result['nUpserted'] += 1
+            result['upserted'].append({'index': index, '_id': None})
+
+    if result['writeErrors']:
+        raise BulkWriteError(result)
+    return BulkWriteResult(result, True)
+
+
+if not hasattr(Collection, 'bulk_write'):
+    Collection.bulk_write = bulk_write
+
+
 def MongoClient(url):
     return Mock_Connection()
@@ -213,6 +213,7 @@ def put_async_object(url,
         mdhash = hashlib.md5()
         etags.append(mdhash.update(content))
     response_dict['status'] = 201
+    response_dict['statuses'] = [201] * len(etags)
     return etags
 
 
@@ -225,7 +226,11 @@ def head_object(url,
     path = _get_block_path(container, name)
     if not os.path.exists(path):
         raise ClientException('mocking')
-    return 'mocking_ret'
+
+    hdrs = {}
+    hdrs['content-length'] = str(os.path.getsize(path))
+    hdrs['last-modified'] = os.path.getmtime(path)
+    return hdrs
 
 
 # Delete Block
@@ -278,3 +283,17 @@ def get_keystoneclient_2_0(auth_url,
     if user == 'failing_auth_hook':
         raise ClientException('mocking auth failure')
     return 'mocking_project_id', 'mocking_project_token'
+
+
+# Stream Block
+def get_object_stream(url,
+            token,
+            container,
+            name):
+
+    path = _get_block_path(container, name)
+
+    if not os.path.exists(path):
+        raise ClientException('mocking')
+
+    return open(path, 'rb')
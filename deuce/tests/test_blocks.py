@@ -1,3 +1,4 @@
+import collections
 import hashlib
 import json
 import os
@@ -10,7 +11,9 @@ from mock import patch
 import msgpack
 from six.moves.urllib.parse import urlparse, parse_qs
 
+import deuce
 from deuce import conf
+from deuce.model import Vault
 from deuce.util.misc import set_qs, relative_uri
 from deuce.tests import ControllerTest
 
@@ -68,11 +71,10 @@ class TestBlocksController(ControllerTest):
 
     def test_get_inconsistent_metadata_block_id(self):
         block_list = self.helper_create_blocks(1, async=True)[0]
-        data = os.urandom(100)
-        block_id = self.calc_sha1(data)
+        block_id = block_list[0]
 
-        from deuce.model import Vault
-        with patch.object(Vault, '_meta_has_block', return_value=True):
+        with patch.object(deuce.storage_driver, 'get_block_obj',
+                          return_value=None):
             path = self.get_block_path(self.vault_name, block_id)
             self.simulate_get(path, headers=self._hdrs)
             self.assertEqual(self.srmock.status, falcon.HTTP_410)
@@ -94,12 +96,16 @@ class TestBlocksController(ControllerTest):
         self.assertEqual(self.srmock.status, falcon.HTTP_404)
 
     def test_head_inconsistent_metadata_block_id(self):
-        from deuce.model import Vault
-        with patch.object(Vault, '_storage_has_block', return_value=False):
+        driver = deuce.metadata_driver
+        with patch.object(deuce.storage_driver, 'block_exists',
+                          return_value=False):
             block_list = self.helper_create_blocks(1, async=True)[0]
             path = self.get_block_path(self.vault_name, block_list[0])
-            self.simulate_head(path, headers=self._hdrs)
+            with patch.object(driver, 'get_block_info',
+                              wraps=driver.get_block_info) as get_info:
+                self.simulate_head(path, headers=self._hdrs)
             self.assertEqual(self.srmock.status, falcon.HTTP_410)
+            self.assertEqual(get_info.call_count, 1)
             self.assertIn('x-block-id', str(self.srmock.headers))
             self.assertIn('x-storage-id', str(self.srmock.headers))
             self.assertIn('x-ref-modified', str(self.srmock.headers))
@@ -113,8 +119,14 @@ class TestBlocksController(ControllerTest):
     def test_head_block(self):
         block_list = self.helper_create_blocks(1, async=True)[0]
         path = self.get_block_path(self.vault_name, block_list[0])
-        self.simulate_head(path, headers=self._hdrs)
+
+        # One metadata lookup serves the check and every header
+        driver = deuce.metadata_driver
+        with patch.object(driver, 'get_block_info',
+                          wraps=driver.get_block_info) as get_info:
+            self.simulate_head(path, headers=self._hdrs)
         self.assertEqual(self.srmock.status, falcon.HTTP_204)
+        self.assertEqual(get_info.call_count, 1)
         self.assertIn('x-block-reference-count', str(self.srmock.headers))
         self.assertIn('x-ref-modified', str(self.srmock.headers))
         self.assertIn('x-storage-id', str(self.srmock.headers))
@@ -159,11 +171,15 @@ class TestBlocksController(ControllerTest):
         self.assertEqual(self.srmock.status, falcon.HTTP_412)
 
     def test_put_happy_case(self):
-
-        block_list = self.helper_create_blocks(num_blocks=1)[0]
+        # The reference headers come from metadata alone
+        with patch.object(deuce.storage_driver, 'get_block_obj',
+                          side_effect=AssertionError):
+            block_list = self.helper_create_blocks(num_blocks=1)[0]
         self.assertEqual(len(block_list), 1)
 
         self.assertEqual(self.srmock.status, falcon.HTTP_201)
+        self.assertEqual(self.srmock.headers_dict['x-block-reference-count'],
+                         '0')
         self.assertIn('x-storage-id', self.srmock.headers_dict)
         self.assertIn('x-block-id', self.srmock.headers_dict)
         self.assertEqual(block_list[0], self.srmock.headers_dict['x-block-id'])
@@ -216,6 +232,81 @@ class TestBlocksController(ControllerTest):
                                       body='non-msgpack')
         self.assertEqual(self.srmock.status, falcon.HTTP_400)
 
+    def test_post_many_blocks(self):
+        # More blocks than are stored in one batch
+        num_blocks = Vault.async_batch_size * 2 + 3
+        block_list, response = self.helper_create_blocks(num_blocks,
+                                                         async=True)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        stored = json.loads(response[0].decode())
+        self.assertEqual(sorted(stored.keys()), sorted(block_list))
+
+        for block_id, storage_id in stored.items():
+            self.assertTrue(storage_id.startswith(block_id))
+
+    def test_post_malformed_stream(self):
+        path = self.get_blocks_path(self.vault_name)
+
+        headers = {
+            "Content-Type": "application/msgpack",
+        }
+        headers.update(self._hdrs)
+        data = [os.urandom(x) for x in range(1, 4)]
+        block_list = [self.calc_sha1(d) for d in data]
+        request_body = msgpack.packb(dict(zip(block_list, data)))
+
+        bodies = [
+            # Truncated in the middle of a block
+            request_body[:-1],
+            # Trailing garbage after the map
+            request_body + msgpack.packb(1),
+            # Block data that is not binary
+            msgpack.packb({block_list[0]: 1}),
+        ]
+
+        for body in bodies:
+            response = self.simulate_post(path, headers=headers, body=body)
+            self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+    def test_post_partial_commit(self):
+        path = self.get_blocks_path(self.vault_name)
+        headers = {
+            "Content-Type": "application/msgpack",
+        }
+        headers.update(self._hdrs)
+
+        def registered(block_ids):
+            statuses = []
+            for block_id in block_ids:
+                self.simulate_head(self.get_block_path(self.vault_name,
+                                                       block_id),
+                                   headers=self._hdrs)
+                statuses.append(self.srmock.status == falcon.HTTP_204)
+            return statuses
+
+        batch_size = Vault.async_batch_size
+
+        # Blocks are committed a batch at a time as the body is read; a
+        # fault after the first batch leaves that batch registered
+        for fault in ('tail', 'hash'):
+            data = [os.urandom(10) for _ in range(batch_size + 2)]
+            block_list = [self.calc_sha1(d) for d in data]
+            contents = collections.OrderedDict(zip(block_list, data))
+
+            if fault == 'tail':
+                body = msgpack.packb(contents)[:-1]
+                status = falcon.HTTP_400
+            else:
+                contents[block_list[-1]] = b'mock'
+                body = msgpack.packb(contents)
+                status = falcon.HTTP_412
+
+            self.simulate_post(path, headers=headers, body=body)
+            self.assertEqual(self.srmock.status, status)
+            self.assertEqual(registered(block_list),
+                             [True] * batch_size + [False] * 2)
+
     def test_post_invalid_endpoint(self):
         path = self.get_blocks_path(self.vault_name)
 
@@ -424,7 +515,7 @@ class TestBlocksController(ControllerTest):
         from deuce.model import Vault
 
         with patch.object(deuce.storage_driver,
-                          'store_block',
+                          'store_block_stream',
                           return_value=(False, '')):
             self.helper_create_blocks(1, async=False)
             self.assertEqual(self.srmock.status, falcon.HTTP_500)
@@ -553,7 +644,7 @@ class TestBlocksController(ControllerTest):
             # was returned should match the original
             # sha1
             z = hashlib.sha1()
-            z.update(response.read())
+            z.update(b''.join(response))
             self.assertEqual(z.hexdigest(), sha1)
 
     def helper_exam_block_metadata(self, block_list, upload_response):
@@ -577,5 +668,5 @@ class TestBlocksController(ControllerTest):
             # was returned should match the original
             # sha1
             z = hashlib.sha1()
-            z.update(response.read())
+            z.update(b''.join(response))
             self.assertEqual(z.hexdigest(), sha1)
@@ -2,11 +2,14 @@ from hashlib import md5
 import mock
 import os
 import random
+import shutil
+import time
 
 from deuce.tests import V1Base
 from deuce.drivers.blockstoragedriver import BlockStorageDriver
 from deuce.drivers.disk import DiskStorageDriver
 from deuce.tests.util import MockFile
+from deuce.util import BlockStream
 
 
 # TODO: Make this test generic -- it should not konw
@@ -73,6 +76,84 @@ class DiskStorageDriverTest(V1Base):
             assert key in statistics.keys()
             assert statistics[key] == 0
 
+    def test_vault_statistics_counters(self):
+        if self.__class__ != DiskStorageDriverTest:
+            self.skipTest('Test only applies to DiskStorageDriverTest')
+
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+
+        def stats():
+            # Kept up to date as blocks change, not walked for
+            with mock.patch('os.walk', side_effect=AssertionError):
+                statistics = driver.get_vault_statistics(vault_id)
+            return statistics['block-count'], statistics['total-size']
+
+        self.assertEqual(stats(), (0, 0))
+
+        block_data = MockFile(100)
+        status, storage_id = driver.store_block(vault_id, block_data.sha1(),
+                                                block_data.read())
+        self.assertEqual(stats(), (1, 100))
+
+        block_data = MockFile(200)
+        block_id = block_data.sha1()
+        driver.store_block_stream(vault_id, block_id,
+                                  BlockStream(block_data, block_id, 200))
+        self.assertEqual(stats(), (2, 300))
+
+        block_datas = [os.urandom(10), os.urandom(20)]
+        driver.store_async_block(
+            vault_id, [self.create_block_id(data) for data in block_datas],
+            block_datas)
+        self.assertEqual(stats(), (4, 330))
+
+        self.assertTrue(driver.delete_block(vault_id, storage_id))
+        self.assertFalse(driver.delete_block(vault_id, storage_id))
+        self.assertEqual(stats(), (3, 230))
+
+        # Drift, e.g. from a crash, is corrected by a rescan
+        with open(driver._make_block_path(vault_id, 'stray'), 'wb') as f:
+            f.write(b'x' * 5)
+        self.assertEqual(stats(), (3, 230))
+        statistics = driver.rescan_vault_statistics(vault_id)
+        self.assertEqual(statistics['block-count'], 4)
+        self.assertEqual(stats(), (4, 235))
+
+        # So are damaged or missing counters, on the next read or update
+        with open(driver._get_stats_path(vault_id), 'w') as f:
+            f.write('{"block-count": ')
+        self.assertEqual(
+            driver.get_vault_statistics(vault_id)['total-size'], 235)
+
+        os.remove(driver._get_stats_path(vault_id))
+        driver.delete_block(vault_id, 'stray')
+        self.assertEqual(stats(), (3, 230))
+
+        # Counters that failed to update are dropped rather than trusted
+        with mock.patch.object(driver, '_write_stats',
+                               side_effect=OSError('mock')):
+            driver.store_block(vault_id, 'mock', b'x')
+        self.assertFalse(os.path.exists(driver._get_stats_path(vault_id)))
+        self.assertEqual(
+            driver.get_vault_statistics(vault_id)['block-count'], 4)
+
+        # Counters older than the rescan interval are rebuilt
+        driver._stats_rescan_interval = 60
+        self.assertEqual(stats(), (4, 231))
+        with mock.patch('time.time', return_value=time.time() + 60):
+            self.assertEqual(
+                driver.get_vault_statistics(vault_id)['block-count'], 4)
+
+        for storage_id in driver.get_vault_block_list(vault_id, 100):
+            driver.delete_block(vault_id, storage_id)
+        self.assertTrue(driver.delete_vault(vault_id))
+        self.assertFalse(os.path.exists(driver._get_stats_path(vault_id)))
+        self.assertEqual(
+            driver.get_vault_statistics(vault_id)['block-count'], 0)
+
     def test_vault_block_list(self):
         driver = self.create_driver()
 
@@ -183,6 +264,72 @@ class DiskStorageDriverTest(V1Base):
             assert None == driver.get_block_obj(vault_id, 'invalid_block_id')
         assert driver.delete_vault(vault_id)
 
+    def test_block_stream(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+
+        block_data = MockFile(3000)
+        block_id = block_data.sha1()
+
+        chunks = BlockStream(block_data, block_id, 3000, chunk_size=1000)
+        status, storage_id = driver.store_block_stream(vault_id, block_id,
+                                                       chunks)
+        self.assertTrue(status)
+        self.assertEqual(chunks.bytes_read, 3000)
+        self.assertEqual(driver.get_block_obj(vault_id, storage_id).read(),
+                         block_data._content)
+
+        driver.delete_block(vault_id, storage_id)
+
+        # Neither a bad hash nor a short body may leave a block behind
+        for length in (3000, 4000):
+            block_data.seek(0)
+            chunks = BlockStream(block_data, 'f' * 40, length)
+            self.assertRaises((ValueError, BufferError),
+                              driver.store_block_stream,
+                              vault_id, block_id, chunks)
+
+            self.assertEqual(
+                driver.get_vault_statistics(vault_id)['block-count'], 0)
+
+        assert driver.delete_vault(vault_id)
+
+    def test_block_stream_failure(self):
+        if self.__class__ != DiskStorageDriverTest:
+            self.skipTest('Test only applies to DiskStorageDriverTest')
+
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+
+        block_data = MockFile(100)
+        block_id = block_data.sha1()
+
+        with mock.patch('os.rename', side_effect=OSError('mock')):
+            status, storage_id = driver.store_block_stream(
+                vault_id, block_id, BlockStream(block_data, block_id, 100))
+
+        self.assertFalse(status)
+        self.assertEqual(storage_id, '')
+
+        # No temporary file is left behind either
+        self.assertEqual([name for name in
+                          os.listdir(driver._get_project_path())
+                          if name.startswith('.upload-')], [])
+
+        # Nor when the vault does not exist at all
+        status, storage_id = driver.store_block_stream(
+            self.create_vault_id(), block_id, [])
+        self.assertFalse(status)
+
+        with mock.patch('tempfile.mkstemp', side_effect=OSError('mock')):
+            status, storage_id = driver.store_block_stream(
+                vault_id, block_id, [])
+        self.assertFalse(status)
+
     def test_block_generator(self):
         driver = self.create_driver()
 
@@ -232,6 +379,14 @@ class DiskStorageDriverTest(V1Base):
             driver.delete_block(vault_id, storage_id)
         assert driver.delete_vault(vault_id)
 
+    def assert_nothing_stored(self, driver, vault_id):
+        self.assertEqual(driver.get_vault_block_list(vault_id, 100), [])
+        self.assertEqual(
+            driver.get_vault_statistics(vault_id)['block-count'], 0)
+        self.assertEqual([name for name in
+                          os.listdir(driver._get_project_path())
+                          if name.startswith('.upload-')], [])
+
     def test_storage_block_failure(self):
         # (BenjamenMeyer) Success cases are taken care of elsewhere
         # we're only concerned about the failure case that explicitly
@@ -245,41 +400,19 @@ class DiskStorageDriverTest(V1Base):
         vault_id = self.create_vault_id()
         driver.create_vault(vault_id)
 
-        # (BenjamenMeyer) We do two tests here so that we
-        # can test both the failure to open the file and
-        # the failure to write to the file
-        count = 2
-
-        block_sizes = [random.randint(0, 100) for _ in range(count)]
-        block_datas = [os.urandom(x) for x in block_sizes]
-        block_ids = [self.create_block_id(y) for y in block_datas]
+        block_data = os.urandom(100)
+        block_id = self.create_block_id(block_data)
 
-        # Make the last eone generate a side-effect
-        open_values = [mock.mock_open() for _ in range(count)]
-        for ov in open_values:
-            ov.write = mock.MagicMock()
-
-        # Failure in writing data
-        open_values[0].write.side_effect = Exception('mocking open failure')
-        # Failure in opening file
-        open_values[1].side_effect = Exception('mocking open failure')
-
-        with mock.patch(
-                'builtins.open', open_values, create=True):
-
-            # since store_block() only makes one open() call we have
-            # to loop over it to call our of our mock_open() configurations
-            # in the list
-            # Note: that len(open_values) == len(block_id) == count
-            #       therefore we only need to loop over the zip() of the data
-            for block_size, block_data, block_id in zip(block_sizes,
-                                                        block_datas,
-                                                        block_ids):
+        # Failure in opening the file, in getting the data to disk and
+        # in moving it into place
+        for target in ('tempfile.mkstemp', 'os.fsync', 'os.rename'):
+            with mock.patch(target, side_effect=OSError('mock')):
                 retVal, storage_id = driver.store_block(vault_id,
                                                         block_id,
                                                         block_data)
-                self.assertFalse(retVal)
-                self.assertEqual(storage_id, '')
+            self.assertFalse(retVal)
+            self.assertEqual(storage_id, '')
+            self.assert_nothing_stored(driver, vault_id)
 
     def test_storage_block_async_failure(self):
         # (BenjamenMeyer) Success cases are taken care of elsewhere
@@ -300,26 +433,195 @@ class DiskStorageDriverTest(V1Base):
         block_datas = [os.urandom(x) for x in block_sizes]
         block_ids = [self.create_block_id(y) for y in block_datas]
 
-        # Make the last eone generate a side-effect
-        open_values = [mock.mock_open() for _ in range(count)]
-        for ov in open_values:
-            ov.write = mock.MagicMock()
+        # Failure in writing the third block and in moving the last one
+        # into place; the rest still land and are reported
+        write_temp = driver._write_temp
+        rename = os.rename
 
-        # Failure in writing data
-        open_values[2].write.side_effect = Exception('mocking open failure')
-        # Failure in opening file
-        open_values[-1].side_effect = Exception('mocking open failure')
+        def failing_write_temp(chunks, temp_dir):
+            if chunks[0] is block_datas[2]:
+                raise OSError('mock')
+            return write_temp(chunks, temp_dir)
 
-        with mock.patch(
-                'builtins.open', open_values, create=True):
+        def failing_rename(src, dst):
+            if os.path.basename(dst).startswith(block_ids[-1]):
+                raise OSError('mock')
+            return rename(src, dst)
 
-            # Unlike store_block(), store_async_block() makes multiple
-            # open() calls so there is no need for a loop.
-            # Note: len(open_values) == len(block_id) == count
-            #       therefore the single store_async_block() utilizes
-            #       all the values in open_values.
+        with mock.patch.object(driver, '_write_temp',
+                               side_effect=failing_write_temp), \
+                mock.patch('os.rename', side_effect=failing_rename):
             retVal, retList = driver.store_async_block(vault_id,
                                                        block_ids,
                                                        block_datas)
         self.assertFalse(retVal)
-        self.assertEqual(retList, [])
+        self.assertEqual(len(retList), count)
+        self.assertIsNone(retList[2])
+        self.assertIsNone(retList[-1])
+
+        stored = [storage_id for storage_id in retList if storage_id]
+        self.assertEqual(len(stored), 3)
+        self.assertEqual(driver.get_vault_block_list(vault_id, 100),
+                         sorted(stored))
+        for storage_id in stored:
+            self.assertTrue(driver.delete_block(vault_id, storage_id))
+        self.assert_nothing_stored(driver, vault_id)
+
+        # Nothing can be relied upon if the directories cannot be synced
+        driver._durability = 'directory'
+        with mock.patch.object(driver, '_sync_dirs',
+                               side_effect=OSError('mock')):
+            retVal, retList = driver.store_async_block(vault_id,
+                                                       block_ids,
+                                                       block_datas)
+            self.assertFalse(retVal)
+            self.assertEqual(retList, [])
+            self.assert_nothing_stored(driver, vault_id)
+
+            self.assertEqual(driver.store_block(vault_id, block_ids[0],
+                                                block_datas[0]),
+                             (False, ''))
+            self.assert_nothing_stored(driver, vault_id)
+
+    def test_durability(self):
+        if self.__class__ != DiskStorageDriverTest:
+            self.skipTest('Test only applies to DiskStorageDriverTest')
+
+        driver = self.create_driver()
+        driver._shard_depth = 1
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+        vault_path = driver._get_vault_path(vault_id)
+
+        block_datas = [os.urandom(10) for _ in range(4)]
+        block_ids = ['aa' + str(i) for i in range(3)] + ['bb']
+
+        def synced(durability):
+            driver._durability = durability
+            with mock.patch('os.fsync', wraps=os.fsync) as fsync, \
+                    mock.patch.object(driver, '_sync_dirs',
+                                      wraps=driver._sync_dirs) as sync_dirs:
+                status, storage_ids = driver.store_async_block(
+                    vault_id, block_ids, block_datas)
+            self.assertTrue(status)
+
+            for storage_id in storage_ids:
+                self.assertTrue(driver.block_exists(vault_id, storage_id))
+
+            dirs = [sorted(call[0][0]) for call in sync_dirs.call_args_list]
+            return fsync.call_count, dirs
+
+        self.assertEqual(synced('none'), (0, []))
+        self.assertEqual(synced('data'), (4, []))
+
+        # One sync per directory for the whole batch, and the vault only
+        # when a shard had to be created
+        self.assertEqual(synced('directory'), (6, [[
+            os.path.join(vault_path, 'aa'),
+            os.path.join(vault_path, 'bb')]]))
+        shutil.rmtree(os.path.join(vault_path, 'bb'))
+        self.assertEqual(synced('directory'), (7, [[
+            vault_path,
+            os.path.join(vault_path, 'aa'),
+            os.path.join(vault_path, 'bb')]]))
+
+    def test_sharded_layout(self):
+        if self.__class__ != DiskStorageDriverTest:
+            self.skipTest('Test only applies to DiskStorageDriverTest')
+
+        driver = self.create_driver()
+        driver._shard_depth = 2
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+
+        block_datas = [MockFile(10) for _ in range(30)]
+        block_ids = [block_data.sha1() for block_data in block_datas]
+        status, storage_ids = driver.store_async_block(
+            vault_id, block_ids,
+            [block_data.read() for block_data in block_datas])
+        self.assertTrue(status)
+
+        storage_id = storage_ids[0]
+        self.assertTrue(os.path.exists(os.path.join(
+            driver._get_vault_path(vault_id),
+            storage_id[0:2], storage_id[2:4], storage_id)))
+        self.assertTrue(driver.block_exists(vault_id, storage_id))
+        self.assertEqual(driver.get_block_object_length(vault_id,
+                                                        storage_id), 10)
+
+        # Pages resume from the marker and come back in order
+        listed = driver.get_vault_block_list(vault_id, limit=7)
+        while len(listed) < 30:
+            page = driver.get_vault_block_list(vault_id, limit=8,
+                                               marker=listed[-1])
+            self.assertEqual(page[0], listed[-1])
+            listed.extend(page[1:])
+        self.assertEqual(listed, sorted(storage_ids))
+
+        # A marker that is not a block starts after where it would be
+        marker = sorted(storage_ids)[10][:5]
+        self.assertEqual(driver.get_vault_block_list(vault_id, 100, marker),
+                         [x for x in sorted(storage_ids) if x >= marker])
+
+        self.assertEqual(driver.get_vault_statistics(vault_id)['block-count'],
+                         30)
+
+        # Empty shards are left behind but do not keep the vault alive
+        for storage_id in storage_ids:
+            self.assertTrue(driver.delete_block(vault_id, storage_id))
+        self.assertEqual(driver.get_vault_block_list(vault_id, 100), [])
+        self.assertTrue(driver.delete_vault(vault_id))
+
+    def test_migrate_vault(self):
+        if self.__class__ != DiskStorageDriverTest:
+            self.skipTest('Test only applies to DiskStorageDriverTest')
+
+        flat_driver = self.create_driver()
+        flat_driver._shard_depth = 0
+        driver = self.create_driver()
+        driver._shard_depth = 3
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+        self.assertEqual(flat_driver.migrate_vault(vault_id), 0)
+
+        storage_ids = []
+        for i in range(20):
+            block_data = MockFile(10)
+            writer = flat_driver if i % 2 else driver
+            status, storage_id = writer.store_block(
+                vault_id, block_data.sha1(), block_data.read())
+            storage_ids.append(storage_id)
+
+        vault_path = driver._get_vault_path(vault_id)
+        self.assertEqual(len([name for name in os.listdir(vault_path)
+                              if name in storage_ids]), 10)
+
+        # Both layouts are served before and after the migration
+        for migrated in (False, True):
+            for storage_id in storage_ids:
+                self.assertTrue(driver.block_exists(vault_id, storage_id))
+                self.assertEqual(
+                    len(driver.get_block_obj(vault_id, storage_id).read()),
+                    10)
+
+            self.assertEqual(driver.get_vault_block_list(vault_id, 100),
+                             sorted(storage_ids))
+            marker = sorted(storage_ids)[5]
+            self.assertEqual(
+                driver.get_vault_block_list(vault_id, 3, marker),
+                sorted(storage_ids)[5:8])
+
+            if not migrated:
+                self.assertEqual(driver.migrate_vault(vault_id), 10)
+
+        self.assertFalse(any(name in storage_ids
+                             for name in os.listdir(vault_path)))
+        self.assertEqual(driver.migrate_vault(vault_id), 0)
+        self.assertEqual(driver.migrate_vault(self.create_vault_id()), 0)
+
+        for storage_id in storage_ids:
+            self.assertTrue(driver.delete_block(vault_id, storage_id))
+        self.assertTrue(driver.delete_vault(vault_id))
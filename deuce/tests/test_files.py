@@ -11,7 +11,10 @@ from six.moves.urllib.parse import urlparse, parse_qs
 
 from deuce import conf
 import deuce
+from deuce.drivers.metadatadriver import BlockWriteError
+from deuce.model import Vault
 from deuce.tests import ControllerTest
+from deuce.util.readahead import readahead
 from deuce.util.misc import set_qs, relative_uri
 
 
@@ -375,6 +378,95 @@ class TestFiles(ControllerTest):
         self.assertGreater(int(x_ref_count_assign_block),
                            int(x_ref_count_delete_file))
 
+    def test_get_file_content(self):
+        hdrs = {'content-type': 'application/x-deuce-block-list'}
+        hdrs.update(self._hdrs)
+
+        block_list, blocks_data = self.helper_create_blocks(num_blocks=10)
+        blocks_data = list(blocks_data)
+        self.helper_store_blocks(self.vault_id, blocks_data)
+
+        data = json.dumps([[block_list[cnt], cnt * 100]
+                           for cnt in range(0, 10)])
+        response = self.simulate_post(self._fileblocks_path, body=data,
+                                      headers=hdrs)
+        self.assertEqual(len(response[0].decode()), 2)
+
+        finalize_hdrs = hdrs.copy()
+        finalize_hdrs['x-file-length'] = '1000'
+        self.simulate_post(self._file_path, headers=finalize_hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        expected = b''.join(block_data for _, block_data, _ in blocks_data)
+
+        # Read ahead, within a budget smaller than two blocks, and one
+        # block at a time; never for a driver that streams its blocks
+        # better itself
+        for prefetch, depth, budget in ((True, 8, 1 << 20),
+                                        (True, 4, 150),
+                                        (True, 0, 0),
+                                        (False, 8, 1 << 20)):
+            with patch.object(conf.api_configuration, 'prefetch_blocks',
+                              depth), \
+                    patch.object(conf.api_configuration, 'prefetch_bytes',
+                                 budget), \
+                    patch.object(deuce.storage_driver, 'prefetch',
+                                 prefetch), \
+                    patch('deuce.model.vault.readahead',
+                          wraps=readahead) as read_ahead:
+                response = self.simulate_get(self._file_path, headers=hdrs)
+                self.assertEqual(self.srmock.status, falcon.HTTP_200)
+                self.assertEqual(b''.join(response), expected)
+                self.assertEqual(read_ahead.called, prefetch and depth > 0)
+
+        # Every download shares one pool
+        self.assertIs(Vault._get_prefetch_pool(), Vault._get_prefetch_pool())
+
+    def test_assign_blocks_partial_failure(self):
+        hdrs = {'content-type': 'application/x-deuce-block-list'}
+        hdrs.update(self._hdrs)
+
+        block_list, blocks_data = self.helper_create_blocks(num_blocks=5)
+        self.helper_store_blocks(self.vault_id, list(blocks_data))
+        bad_block_id = block_list[2]
+
+        data = json.dumps([[block_list[cnt], cnt * 100]
+                           for cnt in range(0, 5)])
+
+        assign_blocks = deuce.metadata_driver.assign_blocks
+
+        def failing_assign_blocks(vault_id, file_id, block_ids, offsets):
+            # The bulk write goes ahead for all but one block
+            assign_blocks(vault_id, file_id,
+                          *zip(*[(block_id, offset) for block_id, offset
+                                 in zip(block_ids, offsets)
+                                 if block_id != bad_block_id]))
+            raise BlockWriteError(deuce.context.project_id, vault_id,
+                                  {bad_block_id: 'mock'})
+
+        with patch.object(deuce.metadata_driver, 'assign_blocks',
+                          side_effect=failing_assign_blocks):
+            response = self.simulate_post(self._fileblocks_path, body=data,
+                                          headers=hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_500)
+        self.assertIn(json.dumps([bad_block_id]),
+                      json.loads(response[0].decode())['description'])
+
+        response = self.simulate_get(self._fileblocks_path,
+                                     headers=self._hdrs)
+        self.assertEqual([block_id for block_id, _ in
+                          json.loads(response[0].decode())],
+                         block_list[:2] + block_list[3:])
+
+        # Posting the list again assigns the block that failed
+        response = self.simulate_post(self._fileblocks_path, body=data,
+                                      headers=hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        response = self.simulate_get(self._fileblocks_path,
+                                     headers=self._hdrs)
+        self.assertEqual([block_id for block_id, _ in
+                          json.loads(response[0].decode())], block_list)
+
     def test_nonexistent_file_endpoints(self):
         file_path_format = '/v1.0/vaults/{0}/files/{1}'
 
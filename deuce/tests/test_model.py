@@ -1,4 +1,11 @@
+import hashlib
+import os
+
+from mock import patch
+
+import deuce
 from deuce.tests import V1Base
+from deuce.drivers.metadatadriver import BlockWriteError
 
 from deuce.model import Vault, File
 
@@ -57,3 +64,124 @@ class TestModel(V1Base):
         blocks_list = list(blocks_gen)
 
         assert len(blocks_list) == 0
+
+    def test_put_async_block_stream(self):
+        v = Vault.create(self.create_vault_id())
+
+        datas = [os.urandom(10) for _ in range(5)]
+        blocks = [(hashlib.sha1(data).hexdigest().encode(), data)
+                  for data in datas]
+
+        # Stored in batches; stops at the first batch that fails
+        with patch.object(deuce.storage_driver, 'store_async_block',
+                          side_effect=[(True, ['s0', 's1']),
+                                       (False, [])]) as store:
+            retval, retblocks = v.put_async_block_stream(iter(blocks),
+                                                         batch_size=2)
+
+        self.assertFalse(retval)
+        self.assertEqual(store.call_count, 2)
+        self.assertEqual(retblocks,
+                         [(blocks[0][0].decode(), 's0'),
+                          (blocks[1][0].decode(), 's1')])
+
+        retval, retblocks = v.put_async_block_stream(iter(blocks),
+                                                     batch_size=2)
+        self.assertTrue(retval)
+        self.assertEqual([block_id for block_id, _ in retblocks],
+                         [block_id.decode() for block_id, _ in blocks])
+
+    def test_put_async_block_partial_failure(self):
+        v = Vault.create(self.create_vault_id())
+
+        datas = [os.urandom(10) for _ in range(3)]
+        block_ids = [hashlib.sha1(data).hexdigest().encode()
+                     for data in datas]
+
+        # Only the blocks that landed are registered
+        with patch.object(deuce.storage_driver, 'store_async_block',
+                          return_value=(False, ['s0', None, 's2'])):
+            retval, retblocks = v.put_async_block(block_ids, datas)
+
+        self.assertFalse(retval)
+        self.assertEqual(retblocks, [(block_ids[0].decode(), 's0'),
+                                     (block_ids[2].decode(), 's2')])
+        self.assertTrue(v.has_block(block_ids[0].decode()))
+        self.assertFalse(v.has_block(block_ids[1].decode()))
+
+    def test_put_async_block_register_failure(self):
+        v = Vault.create(self.create_vault_id())
+
+        datas = [os.urandom(10) for _ in range(3)]
+        block_ids = [hashlib.sha1(data).hexdigest().encode()
+                     for data in datas]
+
+        # Blocks stored but not registered are reported as failed
+        error = BlockWriteError(deuce.context.project_id, v.id,
+                                {block_ids[1].decode(): 'mock'})
+        with patch.object(deuce.storage_driver, 'store_async_block',
+                          return_value=(True, ['s0', 's1', 's2'])), \
+                patch.object(deuce.metadata_driver, 'register_blocks',
+                             side_effect=error):
+            retval, retblocks = v.put_async_block(block_ids, datas)
+
+        self.assertFalse(retval)
+        self.assertEqual(retblocks, [(block_ids[0].decode(), 's0'),
+                                     (block_ids[2].decode(), 's2')])
+
+    def test_vault_cache(self):
+        vault_id = self.create_vault_id()
+        Vault.create(vault_id)
+
+        # Creating the vault made it known; storage is not consulted
+        with patch.object(deuce.storage_driver, 'vault_exists') as exists:
+            self.assertIsNotNone(Vault.get(vault_id))
+            self.assertFalse(exists.called)
+
+        Vault.cache.invalidate((deuce.context.project_id, vault_id))
+        hits = Vault.cache.hits
+
+        with patch.object(deuce.storage_driver, 'vault_exists',
+                          return_value=True) as exists:
+            self.assertIsNotNone(Vault.get(vault_id))
+            self.assertIsNotNone(Vault.get(vault_id))
+            self.assertEqual(exists.call_count, 1)
+        self.assertEqual(Vault.cache.hits, hits + 1)
+
+        # Another project's vault of the same name is not shared
+        deuce.context.project_id = self.create_project_id()
+        self.assertIsNone(Vault.get(vault_id))
+
+        # Deleting the vault forgets it
+        v = Vault.create(vault_id)
+        self.assertTrue(v.delete())
+        self.assertIsNone(Vault.get(vault_id))
+
+    def test_block_info_fetched_once(self):
+        v = Vault.create(self.create_vault_id())
+        data = os.urandom(10)
+        block_id = hashlib.sha1(data).hexdigest()
+        v.put_async_block([block_id.encode()], [data])
+
+        driver = deuce.metadata_driver
+        with patch.object(driver, 'get_block_info',
+                          wraps=driver.get_block_info) as get_info, \
+                patch.object(driver, 'get_block_storage_id') as storage_id, \
+                patch.object(driver, 'get_block_ref_count') as ref_count, \
+                patch.object(deuce.storage_driver,
+                             'get_block_object_length') as length:
+
+            block = v.get_block(block_id)
+            self.assertEqual(block.get_ref_count(), 0)
+            self.assertIsNotNone(block.get_ref_modified())
+            self.assertTrue(block.get_storage_id().startswith(block_id))
+            self.assertEqual(block.get_block_length(), 10)
+
+            self.assertEqual(get_info.call_count, 1)
+            self.assertFalse(storage_id.called)
+            self.assertFalse(ref_count.called)
+
+            # The size recorded in metadata saves a trip to storage
+            self.assertFalse(length.called)
+
+        block.get_obj().close()
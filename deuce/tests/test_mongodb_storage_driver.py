@@ -1,4 +1,9 @@
+import deuce
+from mock import patch
+from mongomock import Collection
+from deuce.drivers.metadatadriver import BlockWriteError
 from deuce.drivers.mongodb import MongoDbStorageDriver
+from deuce.drivers.mongodb import mongodbmetadatadriver
 from deuce.tests.test_sqlite_storage_driver import SqliteStorageDriverTest
 
 
@@ -12,3 +17,242 @@ class MongoDbStorageDriverTest(SqliteStorageDriverTest):
 
     def create_driver(self):
         return MongoDbStorageDriver()
+
+    def _set_ref_count(self, driver, vault_id, block_id, count):
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': block_id
+        }
+        if count is None:
+            driver._blocks.update(args, {'$unset': {'refcount': ''}})
+        else:
+            driver._blocks.update(args, {'$set': {'refcount': count}})
+
+    def test_block_ref_count_not_kept(self):
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_id = self.create_block_id()
+
+        driver.register_block(vault_id, block_id,
+                              self._genstorageid(block_id), 10)
+        driver.create_file(vault_id, file_id)
+        driver.assign_block(vault_id, file_id, block_id, 0)
+
+        # Blocks registered before counts were kept are counted
+        self._set_ref_count(driver, vault_id, block_id, None)
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_id), 1)
+        self.assertEqual(driver.get_block_info(vault_id, block_id)
+                         ['refcount'], 1)
+
+        # and keep being counted as they gain and lose references
+        for _ in range(2):
+            other_file_id = self.create_file_id()
+            driver.create_file(vault_id, other_file_id)
+            driver.assign_blocks(vault_id, other_file_id, [block_id], [0])
+        driver.delete_file(vault_id, other_file_id)
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_id), 2)
+
+        self.assertEqual(driver.recount_block_refs(vault_id), 1)
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_id), 2)
+        driver.delete_file(vault_id, file_id)
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_id), 1)
+
+    def test_register_blocks_ref_race(self):
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(3)]
+        storage_ids = [self._genstorageid(block_id)
+                       for block_id in block_ids]
+
+        def stored_count(block_id):
+            return driver._blocks.find_one({
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+                'blockid': block_id}).get('refcount')
+
+        driver.create_file(vault_id, file_id)
+
+        # The second block is referred to before it is registered, and
+        # the third while it is, after its references were counted
+        driver.assign_block(vault_id, file_id, block_ids[1], 0)
+
+        count_blocks_refs = driver._count_blocks_refs
+
+        def racing_count(vault_id, counted_ids):
+            refs = count_blocks_refs(vault_id, counted_ids)
+            driver.assign_block(vault_id, file_id, block_ids[2], 10)
+            return refs
+
+        with patch.object(driver, '_count_blocks_refs',
+                          side_effect=racing_count):
+            driver.register_blocks(vault_id, block_ids, storage_ids,
+                                   [10] * 3)
+
+        # Only the block no file referred to keeps count; the others are
+        # counted, so no reference is missed
+        self.assertEqual([stored_count(block_id) for block_id in block_ids],
+                         [0, None, None])
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids], [0, 1, 1])
+
+        driver.assign_block(vault_id, file_id, block_ids[0], 20)
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids], [1, 1, 1])
+
+        # until recount_block_refs stores their counts
+        self.assertEqual(driver.recount_block_refs(vault_id), 2)
+        self.assertEqual([stored_count(block_id) for block_id in block_ids],
+                         [1, 1, 1])
+
+    def test_create_indexes(self):
+        with patch.object(Collection, 'create_index',
+                          autospec=True) as create_index:
+            driver = self.create_driver()
+
+        created = set((collection.name, tuple(index))
+                      for (collection, index), _ in
+                      create_index.call_args_list)
+        self.assertEqual(created, set(
+            (name, tuple(index))
+            for name, indexes in mongodbmetadatadriver.INDEXES.items()
+            for index in indexes))
+
+        # Requests no longer check for the indexes
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(3)]
+
+        with patch.object(Collection, 'ensure_index',
+                          side_effect=AssertionError), \
+                patch.object(Collection, 'create_index',
+                             side_effect=AssertionError):
+            driver.create_vault(vault_id)
+            driver.create_vaults_generator()
+            driver.create_file(vault_id, file_id)
+            driver.register_blocks(vault_id, block_ids,
+                                   [self._genstorageid(block_id)
+                                    for block_id in block_ids], [10] * 3)
+            driver.assign_blocks(vault_id, file_id, block_ids, [0, 10, 20])
+            driver.finalize_file(vault_id, file_id, 30)
+            driver.get_file_data(vault_id, file_id)
+            list(driver.create_file_block_generator(vault_id, file_id))
+            driver.get_block_ref_count(vault_id, block_ids[0])
+            driver.delete_file(vault_id, file_id)
+            driver.unregister_block(vault_id, block_ids[0])
+
+    def test_bulk_writes(self):
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(10)]
+
+        driver.create_file(vault_id, file_id)
+
+        bulk_write = Collection.bulk_write
+        with patch.object(mongodbmetadatadriver, 'BULK_WRITE_SIZE', 4), \
+                patch.object(Collection, 'bulk_write', autospec=True,
+                             side_effect=bulk_write) as writes, \
+                patch.object(Collection, 'find_one',
+                             side_effect=AssertionError):
+            driver.assign_blocks(vault_id, file_id, block_ids,
+                                 range(0, 100, 10))
+            driver.register_blocks(vault_id, block_ids,
+                                   [self._genstorageid(block_id)
+                                    for block_id in block_ids], [10] * 10)
+
+        # Three batches assigning the blocks, five counting the
+        # references (two requests a block, of which one matches) and
+        # three registering the blocks
+        self.assertEqual([call[0][0].name for call in writes.call_args_list],
+                         ['fileblocks'] * 3 + ['blocks'] * 8)
+        self.assertTrue(all(len(call[0][1]) <= 4
+                            for call in writes.call_args_list))
+
+        self.assertEqual(driver.has_blocks(vault_id, block_ids), [])
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids], [1] * 10)
+        self.assertEqual(len(list(driver.create_file_block_generator(
+            vault_id, file_id))), 10)
+
+    def test_bulk_write_errors(self):
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(5)]
+        storage_ids = [self._genstorageid(block_id)
+                       for block_id in block_ids]
+        bad_block_id = block_ids[2]
+
+        update = Collection.update
+
+        def failing_update(self, spec, *args, **kwargs):
+            if spec.get('blockid') == bad_block_id:
+                raise ValueError('mock')
+            return update(self, spec, *args, **kwargs)
+
+        driver.create_file(vault_id, file_id)
+
+        # The other blocks are written and the one that failed reported
+        with patch.object(Collection, 'update', autospec=True,
+                          side_effect=failing_update):
+            with self.assertRaises(BlockWriteError) as ctx:
+                driver.register_blocks(vault_id, block_ids, storage_ids,
+                                       [10] * 5)
+            self.assertEqual(ctx.exception.errors, {bad_block_id: 'mock'})
+            self.assertEqual(ctx.exception.vault_id, vault_id)
+            self.assertEqual(driver.has_blocks(vault_id, block_ids),
+                             [bad_block_id])
+
+            with self.assertRaises(BlockWriteError) as ctx:
+                driver.assign_blocks(vault_id, file_id, block_ids,
+                                     range(0, 50, 10))
+            self.assertEqual(list(ctx.exception.errors), [bad_block_id])
+
+        self.assertEqual([block_id for block_id, _ in
+                          driver.create_file_block_generator(vault_id,
+                                                             file_id)],
+                         block_ids[:2] + block_ids[3:])
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids], [1, 1, 0, 1, 1])
+
+        # A file is deleted even if a count could not be decremented;
+        # the failure is only logged
+        bad_block_id = block_ids[0]
+        with patch.object(Collection, 'update', autospec=True,
+                          side_effect=failing_update), \
+                patch.object(mongodbmetadatadriver.logger,
+                             'error') as log_error:
+            driver.delete_file(vault_id, file_id)
+        self.assertFalse(driver.has_file(vault_id, file_id))
+        self.assertEqual(log_error.call_count, 1)
+        self.assertIn(bad_block_id, log_error.call_args[0][0])
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids], [1, 0, 0, 0, 0])
+
+    def test_finalize_file_block_sizes(self):
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(10)]
+
+        driver.create_file(vault_id, file_id)
+        driver.register_blocks(vault_id, block_ids,
+                               [self._genstorageid(block_id)
+                                for block_id in block_ids], [10] * 10)
+        driver.assign_blocks(vault_id, file_id, block_ids, range(0, 100, 10))
+
+        # The sizes are looked up a batch of blocks at a time
+        find = Collection.find
+        with patch.object(mongodbmetadatadriver, 'BULK_WRITE_SIZE', 4), \
+                patch.object(Collection, 'find', autospec=True,
+                             side_effect=find) as finds, \
+                patch.object(Collection, 'find_one',
+                             side_effect=AssertionError):
+            driver.finalize_file(vault_id, file_id, 100)
+
+        self.assertEqual([call[0][0].name for call in finds.call_args_list
+                          if call[0][0].name == 'blocks'], ['blocks'] * 3)
+        self.assertTrue(driver.is_finalized(vault_id, file_id))
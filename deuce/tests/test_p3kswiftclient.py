@@ -1,9 +1,13 @@
 import json
+import threading
 from deuce.util import client as p3k_swiftclient
+from deuce.util.event_loop import loop_thread
 from deuce.tests.util.mockfile import MockFile
+from deuce import conf
 from deuce.tests import V1Base
 from swiftclient.exceptions import ClientException
 import mock
+import aiohttp
 import asyncio
 
 
@@ -13,11 +17,16 @@ class Response(object):
         self.status = status
         self.content = content
         self.headers = {'etag': 'mock'}
+        self.released = False
         if content:
             fut = asyncio.Future(loop=None)
             fut.set_result(content)
             self.content.read = mock.Mock(return_value=fut)
 
+    @asyncio.coroutine
+    def release(self):
+        self.released = True
+
     def decode(self):
         return self.content.decode()
 
@@ -40,6 +49,24 @@ class Content(object):
         return (content for content in self.contents)
 
 
+class StreamContent(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data)
+        chunk, self.data = self.data[:size], self.data[size:]
+
+        fut = asyncio.Future(loop=None)
+        fut.set_result(chunk)
+        return fut
+
+    def at_eof(self):
+        return not self.data
+
+
 class Test_P3k_SwiftClient(V1Base):
 
     def setUp(self):
@@ -51,11 +78,36 @@ class Test_P3k_SwiftClient(V1Base):
         self.block_contents = [b'mock', b'mock']
         self.response_dict = dict()
 
+        patcher = mock.patch.object(aiohttp.ClientSession, 'request')
+        self.request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_request_timeout(self):
+        cancelled = threading.Event()
+
+        @asyncio.coroutine
+        def hang(*args, **kwargs):
+            try:
+                yield from asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        self.request.side_effect = hang
+
+        # A request that hangs fails like any other, and is cancelled
+        with mock.patch.object(conf.block_storage_driver.swift,
+                               'request_timeout', 0.05):
+            self.assertRaises(ClientException,
+                              p3k_swiftclient.head_container,
+                              self.storage_url, self.token, self.vault)
+        self.assertTrue(cancelled.wait(5))
+
     def test_put_container(self):
         res = Response(201)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         p3k_swiftclient.put_container(
             self.storage_url,
             self.token,
@@ -63,11 +115,21 @@ class Test_P3k_SwiftClient(V1Base):
             self.response_dict)
         self.assertEqual(self.response_dict['status'], 201)
 
+        # The connection goes back to the pooled session for the URL
+        self.assertTrue(res.released)
+        # ... which was created on the shared loop thread
+        loop = p3k_swiftclient.loop_thread.get_loop()
+        self.assertIn(loop, [key[1] for key in
+                             p3k_swiftclient.sessions._sessions])
+        self.assertIs(p3k_swiftclient.sessions.get(self.storage_url, loop),
+                      p3k_swiftclient.sessions.get(self.storage_url + '/x',
+                                                   loop))
+
     def test_head_container(self):
         res = Response(200)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         response = p3k_swiftclient.head_container(
             self.storage_url,
             self.token,
@@ -76,7 +138,7 @@ class Test_P3k_SwiftClient(V1Base):
         res_exception = Response(404)
         fut = asyncio.Future(loop=None)
         fut.set_result(res_exception)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         self.assertRaises(ClientException,
                           lambda: p3k_swiftclient.head_container(
                               self.storage_url,
@@ -93,7 +155,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(200, content)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         response = p3k_swiftclient.get_container(
             self.storage_url,
             self.token,
@@ -112,7 +174,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(200, content)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         response = p3k_swiftclient.get_container(
             self.storage_url,
             self.token,
@@ -126,7 +188,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(404, content)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         self.assertRaises(ClientException,
                           lambda: p3k_swiftclient.get_container(
                               self.storage_url,
@@ -137,7 +199,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(204)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         p3k_swiftclient.delete_container(
             self.storage_url,
             self.token,
@@ -149,7 +211,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(201)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         p3k_swiftclient.put_object(
             self.storage_url,
             self.token,
@@ -175,7 +237,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(201)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         p3k_swiftclient.put_async_object(
             self.storage_url,
             self.token,
@@ -199,7 +261,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(202)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         p3k_swiftclient.put_async_object(
             self.storage_url,
             self.token,
@@ -210,12 +272,116 @@ class Test_P3k_SwiftClient(V1Base):
             self.response_dict)
 
         self.assertEqual(self.response_dict['status'], 500)
+        self.assertEqual(self.response_dict['statuses'], [202, 202])
+
+    def _fake_sleep(self):
+        delays = []
+
+        @asyncio.coroutine
+        def sleep(delay):
+            delays.append(delay)
+
+        patcher = mock.patch('asyncio.sleep', sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return delays
+
+    def test_put_async_object_retries(self):
+        delays = self._fake_sleep()
+        replies = {name: [] for name in self.blocks}
+        replies['mock1'] = [Response(503), aiohttp.ClientOSError(),
+                            Response(201)]
+        replies['mock2'] = [Response(201)]
+
+        @asyncio.coroutine
+        def request(method, url, **kwargs):
+            reply = replies[url.rsplit('/', 1)[-1]].pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+        self.request.side_effect = request
+        p3k_swiftclient.put_async_object(
+            self.storage_url,
+            self.token,
+            self.vault,
+            self.blocks,
+            self.block_contents,
+            False,
+            self.response_dict)
+
+        self.assertEqual(self.response_dict['status'], 201)
+        self.assertEqual(self.response_dict['statuses'], [201, 201])
+        self.assertEqual(self.request.call_count, 4)
+
+        # Jittered, exponentially growing waits between the tries
+        backoff = p3k_swiftclient.conf.block_storage_driver.swift.\
+            retry_backoff
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0 <= delays[0] <= backoff)
+        self.assertTrue(0 <= delays[1] <= backoff * 2)
+
+    def test_put_async_object_retries_exhausted(self):
+        delays = self._fake_sleep()
+        retries = p3k_swiftclient.conf.block_storage_driver.swift.retries
+
+        @asyncio.coroutine
+        def request(method, url, **kwargs):
+            if url.endswith('mock1'):
+                raise aiohttp.DisconnectedError()
+            return Response(201)
+
+        self.request.side_effect = request
+        p3k_swiftclient.put_async_object(
+            self.storage_url,
+            self.token,
+            self.vault,
+            self.blocks,
+            self.block_contents,
+            False,
+            self.response_dict)
+
+        # Only the block that never made it is reported as failed
+        self.assertEqual(self.response_dict['status'], 500)
+        self.assertEqual(self.response_dict['statuses'], [None, 201])
+        self.assertEqual(self.request.call_count, retries + 2)
+        self.assertEqual(len(delays), retries)
+
+    def test_put_async_object_concurrency(self):
+        blocks = [self.create_block_id() for _ in range(40)]
+        contents = [b'mock'] * len(blocks)
+        in_flight = [0]
+        most = [0]
+
+        @asyncio.coroutine
+        def request(method, url, **kwargs):
+            in_flight[0] += 1
+            most[0] = max(most[0], in_flight[0])
+            yield from asyncio.sleep(0)
+            in_flight[0] -= 1
+            return Response(201)
+
+        self.request.side_effect = request
+        with mock.patch.object(p3k_swiftclient, 'sessions',
+                               p3k_swiftclient.SessionPool(0, 0, 300, 4)):
+            p3k_swiftclient.put_async_object(
+                self.storage_url,
+                self.token,
+                self.vault,
+                blocks,
+                contents,
+                False,
+                self.response_dict)
+
+        self.assertEqual(self.response_dict['status'], 201)
+        self.assertEqual(self.response_dict['statuses'], [201] * 40)
+        self.assertEqual(most[0], 4)
 
     def test_head_object(self):
         res = Response(204)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         response = p3k_swiftclient.head_object(
             self.storage_url,
             self.token,
@@ -225,7 +391,7 @@ class Test_P3k_SwiftClient(V1Base):
         res_exception = Response(404)
         fut = asyncio.Future(loop=None)
         fut.set_result(res_exception)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.request.return_value = fut
         self.assertRaises(ClientException,
                           lambda: p3k_swiftclient.head_object(
                               self.storage_url,
@@ -238,7 +404,7 @@ class Test_P3k_SwiftClient(V1Base):
         r = Response(200, file)
         fut1 = asyncio.Future(loop=None)
         fut1.set_result(r)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut1)
+        self.request.return_value = fut1
 
         response = p3k_swiftclient.get_object(
             self.storage_url,
@@ -248,12 +414,110 @@ class Test_P3k_SwiftClient(V1Base):
             self.response_dict)
         self.assertEqual(file, response[1])
         self.assertEqual(r.headers, response[0].headers)
+        self.assertTrue(r.released)
+
+        # A response that fails mid-read is closed, not pooled
+        r = Response(200, MockFile(10))
+        r.content.read = mock.Mock(side_effect=IOError('mock'))
+        r.close = mock.Mock()
+        fut1 = asyncio.Future(loop=None)
+        fut1.set_result(r)
+        self.request.return_value = fut1
+
+        self.assertRaises(IOError, p3k_swiftclient.get_object,
+                          self.storage_url, self.token, self.vault,
+                          self.block, self.response_dict)
+        self.assertTrue(r.close.called)
+        self.assertFalse(r.released)
+
+    def test_get_object_stream(self):
+        data = b'0123456789'
+        r = Response(200)
+        r.content = StreamContent(data)
+        r.close = mock.Mock()
+        fut = asyncio.Future(loop=None)
+        fut.set_result(r)
+        self.request.return_value = fut
+
+        stream = p3k_swiftclient.get_object_stream(
+            self.storage_url, self.token, self.vault, self.block)
+
+        # The session is in use, and not closed for being idle, until
+        # the stream is closed
+        def users():
+            return [entry[3] for entry in
+                    p3k_swiftclient.sessions._sessions.values()]
+
+        self.assertEqual(users(), [1])
+        self.assertEqual(stream.read(4), b'0123')
+        self.assertEqual(stream.read(), b'456789')
+        self.assertEqual(stream.read(4), b'')
+
+        # Read to the end, the connection goes back to the pool; the
+        # check is made on the loop the connection belongs to
+        at_eof = r.content.at_eof
+        checked_in = []
+
+        def loop_at_eof():
+            checked_in.append(threading.current_thread())
+            return at_eof()
+
+        r.content.at_eof = loop_at_eof
+        stream.close()
+        stream.close()
+        self.assertEqual(checked_in, [loop_thread._thread])
+        self.assertEqual(users(), [0])
+        self.assertTrue(r.released)
+        self.assertFalse(r.close.called)
+        self.assertRaises(ValueError, stream.read)
+
+        # Closed early, e.g. the client went away, it is dropped
+        r = Response(200)
+        r.content = StreamContent(data)
+        r.close = mock.Mock()
+        fut = asyncio.Future(loop=None)
+        fut.set_result(r)
+        self.request.return_value = fut
+
+        stream = p3k_swiftclient.get_object_stream(
+            self.storage_url, self.token, self.vault, self.block)
+        self.assertEqual(stream.read(4), b'0123')
+        stream.close()
+        self.assertFalse(r.released)
+        self.assertTrue(r.close.called)
+
+        # As it is when reading fails
+        r = Response(200)
+        r.content = StreamContent(data)
+        r.content.read = mock.Mock(side_effect=IOError('mock'))
+        r.close = mock.Mock()
+        fut = asyncio.Future(loop=None)
+        fut.set_result(r)
+        self.request.return_value = fut
+
+        stream = p3k_swiftclient.get_object_stream(
+            self.storage_url, self.token, self.vault, self.block)
+        self.assertRaises(IOError, stream.read, 4)
+        self.assertTrue(stream.closed)
+        self.assertTrue(r.close.called)
+
+        r = Response(404)
+        r.close = mock.Mock()
+        fut = asyncio.Future(loop=None)
+        fut.set_result(r)
+        self.request.return_value = fut
+
+        self.assertRaises(ClientException,
+                          p3k_swiftclient.get_object_stream,
+                          self.storage_url, self.token, self.vault,
+                          self.block)
+        self.assertTrue(r.close.called)
 
     def test_delete_object(self):
         r = Response(204)
         fut1 = asyncio.Future(loop=None)
         fut1.set_result(r)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut1)
+        self.request.return_value = fut1
 
         p3k_swiftclient.delete_object(
             self.storage_url,
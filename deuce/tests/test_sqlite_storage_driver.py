@@ -2,12 +2,20 @@ from deuce.tests import V1Base
 from deuce.drivers.metadatadriver import MetadataStorageDriver, GapError,\
     OverlapError, ConstraintError
 from deuce.drivers.sqlite import SqliteStorageDriver
+from deuce.drivers.sqlite import sqlitemetadatadriver
 from deuce.drivers import BlockStorageDriver
+import os
 import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
 
 import deuce
+from deuce import conf
 
-from mock import MagicMock
+from mock import MagicMock, patch
 
 
 class SqliteStorageDriverTest(V1Base):
@@ -152,6 +160,49 @@ class SqliteStorageDriverTest(V1Base):
             self._genstorageid(self.create_block_id(b'bogus')))
         self.assertIsNone(bogus_block_id)
 
+    def test_blockids_to_storageids(self):
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+
+        block_ids = [self.create_block_id() for _ in range(10)]
+        storage_ids = [self._genstorageid(block_id)
+                       for block_id in block_ids]
+
+        for block_id, storage_id in zip(block_ids, storage_ids):
+            driver.register_block(vault_id, block_id, storage_id, 1024)
+
+        # Unknown blocks and repeats come back in place
+        bogus_block_id = self.create_block_id(b'bogus')
+        lookup = block_ids[::-1] + [bogus_block_id, block_ids[0]]
+
+        # Small enough for sqlite to look them up in several queries
+        with patch('deuce.drivers.sqlite.sqlitemetadatadriver.'
+                   'SQL_MAX_IN_PARAMS', 3):
+            self.assertEqual(driver.get_block_storage_ids(vault_id, lookup),
+                             storage_ids[::-1] + [None, storage_ids[0]])
+        self.assertEqual(driver.get_block_storage_ids(vault_id, []), [])
+
+    def test_has_blocks_in_chunks(self):
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+
+        block_ids = [self.create_block_id() for _ in range(10)]
+        for block_id in block_ids:
+            driver.register_block(vault_id, block_id,
+                                  self._genstorageid(block_id), 1024)
+        driver.mark_block_as_bad(vault_id, block_ids[4])
+
+        bogus_block_id = self.create_block_id(b'bogus')
+        lookup = block_ids + [bogus_block_id, block_ids[4]]
+
+        with patch('deuce.drivers.sqlite.sqlitemetadatadriver.'
+                   'SQL_MAX_IN_PARAMS', 3):
+            self.assertEqual(driver.has_blocks(vault_id, lookup),
+                             [bogus_block_id])
+            self.assertEqual(driver.has_blocks(vault_id, lookup,
+                                               check_status=True),
+                             [block_ids[4], bogus_block_id, block_ids[4]])
+
     def test_block_crud(self):
         driver = self.create_driver()
 
@@ -420,6 +471,39 @@ class SqliteStorageDriverTest(V1Base):
             # reference count
             self.assertEqual(driver.get_block_ref_count(vault_id, block_id), 1)
 
+    def test_block_info(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        block_id = self.create_block_id()
+        storage_id = self._genstorageid(block_id)
+
+        self.assertIsNone(driver.get_block_info(vault_id, block_id))
+
+        driver.register_block(vault_id, block_id, storage_id, 1024)
+
+        info = driver.get_block_info(vault_id, block_id)
+        self.assertEqual(info['storageid'], storage_id)
+        self.assertEqual(info['blocksize'], 1024)
+        self.assertEqual(info['refcount'], 0)
+        self.assertEqual(info['reftime'],
+                         driver.get_block_ref_modified(vault_id, block_id))
+        self.assertFalse(info['isinvalid'])
+
+        # References and status are reflected
+        for _ in range(2):
+            file_id = self.create_file_id()
+            driver.create_file(vault_id, file_id)
+            driver.assign_block(vault_id, file_id, block_id, 0)
+
+        driver.mark_block_as_bad(vault_id, block_id)
+
+        info = driver.get_block_info(vault_id, block_id)
+        self.assertEqual(info['refcount'], 2)
+        self.assertEqual(info['refcount'],
+                         driver.get_block_ref_count(vault_id, block_id))
+        self.assertTrue(info['isinvalid'])
+
     def test_file_assignment_registration(self):
 
         driver = self.create_driver()
@@ -927,3 +1011,406 @@ class SqliteStorageDriverTest(V1Base):
 
         for vault_id in vaultids:
             driver.delete_vault(vault_id)
+
+    def test_concurrent_access(self):
+        if self.__class__ != SqliteStorageDriverTest:
+            self.skipTest('Test only applies to SqliteStorageDriverTest')
+
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+        errors = []
+
+        def register(offset):
+            try:
+                for n in range(offset, offset + 20):
+                    block_id = self.create_block_id(str(n).encode())
+                    driver.register_block(vault_id, block_id,
+                                          self._genstorageid(block_id), 1)
+                    assert driver.has_block(vault_id, block_id)
+            except Exception as ex:  # pragma: no cover
+                errors.append(ex)
+
+        threads = [threading.Thread(target=register, args=(n * 20,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            driver.get_vault_statistics(vault_id)['blocks']['count'], 80)
+
+    def test_register_blocks(self):
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+
+        block_ids = [self.create_block_id() for _ in range(5)]
+        storage_ids = [self._genstorageid(block_id)
+                       for block_id in block_ids]
+
+        driver.register_block(vault_id, block_ids[0], storage_ids[0], 10)
+        driver.register_blocks(vault_id, block_ids,
+                               [self._genstorageid(block_ids[0])] +
+                               storage_ids[1:], [10] * 5)
+
+        # Blocks already registered are left as they were
+        self.assertEqual(driver.get_block_storage_ids(vault_id, block_ids),
+                         storage_ids)
+        self.assertEqual(driver.has_blocks(vault_id, block_ids), [])
+
+    def test_transaction_rollback(self):
+        if self.__class__ != SqliteStorageDriverTest:
+            self.skipTest('Test only applies to SqliteStorageDriverTest')
+
+        driver = self.create_driver()
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(5)]
+        storage_ids = [self._genstorageid(block_id)
+                       for block_id in block_ids]
+
+        class FailingConnection(object):
+
+            """Fails the statement containing fail_on"""
+
+            def __init__(self, conn, fail_on):
+                self._conn = conn
+                self._fail_on = fail_on
+
+            def __getattr__(self, name):
+                return getattr(self._conn, name)
+
+            def _check(self, query):
+                if self._fail_on in query:
+                    raise sqlite3.OperationalError('mock')
+
+            def execute(self, query, *args):
+                self._check(query)
+                return self._conn.execute(query, *args)
+
+            def executemany(self, query, *args):
+                self._check(query)
+                return self._conn.executemany(query, *args)
+
+        def failing(fail_on):
+            return patch.object(driver._conn, '_conn',
+                                FailingConnection(driver._conn._conn,
+                                                  fail_on))
+
+        driver.create_file(vault_id, file_id)
+
+        # The last of the two statements fails; the first is undone
+        with failing('UPDATE blocks'):
+            self.assertRaises(sqlite3.OperationalError,
+                              driver.assign_blocks, vault_id, file_id,
+                              block_ids, range(0, 50, 10))
+        self.assertEqual(driver.create_file_block_generator(vault_id,
+                                                            file_id), [])
+
+        with failing('INSERT OR IGNORE INTO blocks'):
+            self.assertRaises(sqlite3.OperationalError,
+                              driver.register_blocks, vault_id, block_ids,
+                              storage_ids, [10] * 5)
+        self.assertEqual(driver.has_blocks(vault_id, block_ids), block_ids)
+
+        driver.register_blocks(vault_id, block_ids, storage_ids, [10] * 5)
+        driver.assign_blocks(vault_id, file_id, block_ids, range(0, 50, 10))
+
+        with failing('DELETE FROM fileblocks'):
+            self.assertRaises(sqlite3.OperationalError,
+                              driver.delete_file, vault_id, file_id)
+        self.assertTrue(driver.has_file(vault_id, file_id))
+        self.assertEqual(len(driver.create_file_block_generator(
+            vault_id, file_id)), 5)
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_ids[0]),
+                         1)
+
+        # Nothing was left pending on the connection
+        driver.delete_file(vault_id, file_id)
+        self.assertFalse(driver.has_file(vault_id, file_id))
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_ids[0]),
+                         0)
+
+        # Nested transactions commit or roll back with the outermost
+        driver.create_file(vault_id, file_id)
+        with self.assertRaises(KeyError):
+            with driver._conn.transaction():
+                driver.assign_blocks(vault_id, file_id, block_ids,
+                                     range(0, 50, 10))
+                raise KeyError('mock')
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_ids[0]),
+                         0)
+
+    def _file_driver(self, **options):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        options['path'] = os.path.join(root, 'deuce.db')
+        for name, value in options.items():
+            patcher = patch.object(conf.metadata_driver.sqlite, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        return self.create_driver(), options['path']
+
+    def test_file_database_wal(self):
+        if self.__class__ != SqliteStorageDriverTest:
+            self.skipTest('Test only applies to SqliteStorageDriverTest')
+
+        driver, _ = self._file_driver(journal_mode='wal',
+                                      synchronous='normal',
+                                      mmap_size=1 << 20)
+        vault_id = self.create_vault_id()
+        block_id = self.create_block_id()
+
+        self.assertEqual(next(driver._conn.execute('pragma journal_mode')),
+                         ('wal',))
+        self.assertEqual(next(driver._conn.execute('pragma synchronous')),
+                         (1,))
+
+        results = []
+
+        def read():
+            # Every thread has a connection of its own
+            results.append((driver._conn._conn,
+                            driver.has_block(vault_id, block_id)))
+
+        # A reader is not held up by a write in progress, and only sees
+        # it once committed
+        with driver._conn.transaction():
+            driver.register_block(vault_id, block_id,
+                                  self._genstorageid(block_id), 10)
+            thread = threading.Thread(target=read, args=())
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+        thread = threading.Thread(target=read, args=())
+        thread.start()
+        thread.join()
+
+        self.assertEqual([result[1] for result in results], [False, True])
+        self.assertIsNot(results[0][0], driver._conn._conn)
+
+    def test_file_database_busy(self):
+        if self.__class__ != SqliteStorageDriverTest:
+            self.skipTest('Test only applies to SqliteStorageDriverTest')
+
+        driver, path = self._file_driver(busy_timeout=0, busy_retries=5)
+        vault_id = self.create_vault_id()
+        block_id = self.create_block_id()
+
+        # Another process holds the write lock for a little while
+        other = sqlite3.connect(path, isolation_level=None,
+                                check_same_thread=False)
+        self.addCleanup(other.close)
+        other.execute('BEGIN IMMEDIATE')
+        timer = threading.Timer(0.05, other.execute, args=('COMMIT',))
+        timer.start()
+
+        driver.register_block(vault_id, block_id,
+                              self._genstorageid(block_id), 10)
+        timer.join()
+        self.assertTrue(driver.has_block(vault_id, block_id))
+
+        # Without retries the error comes straight back
+        other.execute('BEGIN IMMEDIATE')
+        self.addCleanup(other.execute, 'COMMIT')
+        with patch.object(deuce.conf.metadata_driver.sqlite,
+                          'busy_retries', 0):
+            self.assertRaises(sqlite3.OperationalError,
+                              driver.register_block, vault_id,
+                              self.create_block_id(), 'storage', 10)
+
+    def test_query_plans(self):
+        if self.__class__ != SqliteStorageDriverTest:
+            self.skipTest('Test only applies to SqliteStorageDriverTest')
+
+        driver = self.create_driver()
+
+        queries = [name for name in dir(sqlitemetadatadriver)
+                   if name.startswith('SQL_') and
+                   isinstance(getattr(sqlitemetadatadriver, name), str)]
+
+        # Hot queries and the index each must be answered from
+        indexes = {
+            'SQL_REGISTER_BLOCK': 'COVERING INDEX fileblocks_blockid',
+            'SQL_RECOUNT_BLOCK_REFS': 'COVERING INDEX fileblocks_blockid',
+            'SQL_GET_BLOCK_ID': 'INDEX blocks_storageid',
+            'SQL_CREATE_FILEBLOCK_LIST': 'COVERING INDEX fileblocks_offset',
+            'SQL_GET_ALL_FILE_BLOCKS': 'COVERING INDEX fileblocks_offset',
+            'SQL_GET_FILE_BLOCKS': 'COVERING INDEX fileblocks_offset',
+            'SQL_UPDATE_REF_TIME_BLOCKS_IN_FILE':
+                'COVERING INDEX fileblocks_offset',
+        }
+        self.assertTrue(set(indexes) <= set(queries))
+
+        for name in queries:
+            query = getattr(sqlitemetadatadriver, name).format(
+                ':blockid0, :blockid1')
+            args = {arg: 'mock' for arg in re.findall(r':(\w+)', query)}
+
+            plan = [row[-1] for row in driver._conn.execute(
+                'EXPLAIN QUERY PLAN ' + query, args)]
+
+            # Every table is searched through an index, at least down
+            # to the vault, and rows come out of it in the order asked
+            for step in plan:
+                message = '{0}: {1}'.format(name, step)
+                self.assertFalse(step.startswith('SCAN'), message)
+                self.assertNotIn('TEMP B-TREE', message)
+                if step.startswith('SEARCH'):
+                    self.assertIn('vaultid', step, message)
+
+            if name in indexes:
+                self.assertTrue(any(indexes[name] + ' ' in step
+                                    for step in plan),
+                                '{0}: {1}'.format(name, plan))
+
+    def test_unregister_block_other_vault(self):
+        driver = self.create_driver()
+        vault_ids = [self.create_vault_id() for _ in range(2)]
+        block_id = self.create_block_id()
+
+        for vault_id in vault_ids:
+            driver.register_block(vault_id, block_id,
+                                  self._genstorageid(block_id), 10)
+
+        driver.unregister_block(vault_ids[0], block_id)
+        self.assertFalse(driver.has_block(vault_ids[0], block_id))
+        self.assertTrue(driver.has_block(vault_ids[1], block_id))
+
+    def test_migrate_from_version_1(self):
+        if self.__class__ != SqliteStorageDriverTest:
+            self.skipTest('Test only applies to SqliteStorageDriverTest')
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'deuce.db')
+
+        vault_id = self.create_vault_id()
+        block_id = self.create_block_id()
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'fileid': self.create_file_id(),
+            'blockid': block_id,
+            'storageid': self._genstorageid(block_id),
+            'blocksize': 10
+        }
+
+        conn = sqlite3.connect(path)
+        for query in sqlitemetadatadriver.schemas[0]:
+            conn.execute(query)
+        conn.execute('pragma user_version=1')
+
+        # A block referenced twice, by the version 1 queries
+        conn.execute('''
+            INSERT INTO blocks
+            (projectid, vaultid, blockid, storageid, size, reftime)
+            VALUES (:projectid, :vaultid, :blockid, :storageid, :blocksize,
+            0)''', args)
+        for offset in (0, 10):
+            args['offset'] = offset
+            conn.execute('''
+                INSERT INTO fileblocks
+                (projectid, vaultid, fileid, blockid, offset)
+                VALUES (:projectid, :vaultid, :fileid, :blockid, :offset)
+            ''', args)
+        conn.commit()
+        conn.close()
+
+        with patch.object(conf.metadata_driver.sqlite, 'path', path):
+            driver = self.create_driver()
+
+        self.assertEqual(driver._get_user_version(),
+                         sqlitemetadatadriver.CURRENT_DB_VERSION)
+        indexes = set(row[0] for row in driver._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        self.assertTrue({'fileblocks_blockid', 'fileblocks_offset',
+                         'blocks_storageid'} <= indexes)
+
+        # Existing references were counted, and new ones are too
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_id), 2)
+        driver.delete_file(vault_id, args['fileid'])
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_id), 0)
+
+    def test_migrate_atomic(self):
+        if self.__class__ != SqliteStorageDriverTest:
+            self.skipTest('Test only applies to SqliteStorageDriverTest')
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        # The second version creates a table and then fails; neither its
+        # table nor its version may remain
+        schemas = [['CREATE TABLE first (id INTEGER)'],
+                   ['CREATE TABLE second (id INTEGER)',
+                    'CREATE TABLE first (id INTEGER)']]
+
+        for path in (':memory:', os.path.join(root, 'deuce.db')):
+            with patch.object(conf.metadata_driver.sqlite, 'path', path), \
+                    patch.object(sqlitemetadatadriver, 'schemas', schemas), \
+                    patch.object(sqlitemetadatadriver, 'CURRENT_DB_VERSION',
+                                 len(schemas)):
+                # Kept hold of to look at the database once it has failed
+                driver = SqliteStorageDriver.__new__(SqliteStorageDriver)
+                self.assertRaises(sqlite3.OperationalError,
+                                  driver.__init__)
+
+            self.assertEqual(driver._get_user_version(), 1)
+            tables = set(row[0] for row in driver._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))
+            self.assertEqual(tables, {'first'})
+
+    def _set_ref_count(self, driver, vault_id, block_id, count):
+        driver._conn.execute('''
+            UPDATE blocks SET refcount = :refcount
+            WHERE projectid = :projectid
+            AND vaultid = :vaultid
+            AND blockid = :blockid''', {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': block_id,
+            'refcount': count
+        })
+        driver._conn.commit()
+
+    def test_recount_block_refs(self):
+        driver = self.create_driver()
+        if not hasattr(driver, 'recount_block_refs'):
+            self.skipTest('The driver does not keep reference counts')
+
+        vault_id = self.create_vault_id()
+        file_ids = [self.create_file_id() for _ in range(2)]
+        block_ids = [self.create_block_id() for _ in range(3)]
+
+        driver.register_blocks(vault_id, block_ids,
+                               [self._genstorageid(block_id)
+                                for block_id in block_ids], [10] * 3)
+        for file_id in file_ids:
+            driver.create_file(vault_id, file_id)
+            driver.assign_blocks(vault_id, file_id, block_ids, [0, 10, 20])
+
+        # Assigning a block to the same offset again adds no reference
+        driver.assign_block(vault_id, file_ids[0], block_ids[0], 0)
+        driver.assign_blocks(vault_id, file_ids[0], block_ids[:2], [0, 10])
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids], [2, 2, 2])
+        self.assertEqual(driver.recount_block_refs(vault_id), 0)
+
+        # Counts that have drifted are put right
+        self._set_ref_count(driver, vault_id, block_ids[0], 7)
+        self._set_ref_count(driver, vault_id, block_ids[2], 0)
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_ids[0]),
+                         7)
+
+        self.assertEqual(driver.recount_block_refs(vault_id), 2)
+        self.assertEqual([driver.get_block_info(vault_id, block_id)
+                          ['refcount'] for block_id in block_ids], [2, 2, 2])
+
+        driver.delete_file(vault_id, file_ids[0])
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids], [1, 1, 1])
+        self.assertEqual(driver.recount_block_refs(vault_id), 0)
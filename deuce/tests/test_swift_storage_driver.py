@@ -123,6 +123,23 @@ class SwiftStorageDriverTest(DiskStorageDriverTest):
             self.assertFalse(retVal)
             self.assertEqual(retList, [])
 
+        def partial_put(url, token, container, names, contents, etag,
+                        response_dict):
+            response_dict['status'] = 500
+            response_dict['statuses'] = [201, None, 503]
+
+        with mock.patch(
+            'deuce.tests.db_mocking.swift_mocking.client.put_async_object',
+            side_effect=partial_put
+        ):
+            block_ids = [self.create_block_id() for _ in range(3)]
+            retVal, retList = driver.store_async_block(
+                vault_id, block_ids, [b'mock'] * 3)
+            self.assertFalse(retVal)
+            self.assertEqual(len(retList), 3)
+            self.assertTrue(retList[0].startswith(block_ids[0]))
+            self.assertEqual(retList[1:], [None, None])
+
         with mock.patch(
             'deuce.tests.db_mocking.swift_mocking.client.head_object'
         ) as head_object:
@@ -130,6 +147,10 @@ class SwiftStorageDriverTest(DiskStorageDriverTest):
 
             self.assertFalse(driver.block_exists(vault_id, block_id))
 
+            self.assertEqual(driver.get_block_object_length(vault_id,
+                                                            block_id),
+                             0)
+
         with mock.patch(
             'deuce.tests.db_mocking.swift_mocking.client.delete_object'
         ) as delete_object:
@@ -138,18 +159,9 @@ class SwiftStorageDriverTest(DiskStorageDriverTest):
             self.assertFalse(driver.delete_block(vault_id, block_id))
 
         with mock.patch(
-            'deuce.tests.db_mocking.swift_mocking.client.get_object'
-        ) as get_object:
-            get_object.side_effect = ClientException('mock')
-
-            self.assertIsNone(driver.get_block_obj(vault_id, block_id))
-
-            self.assertEqual(driver.get_block_object_length(vault_id,
-                                                            block_id),
-                             0)
-
-            get_object.side_effect = None
-            get_object.return_value = ({'x-header': 'mock'}, False)
+            'deuce.tests.db_mocking.swift_mocking.client.get_object_stream'
+        ) as get_object_stream:
+            get_object_stream.side_effect = ClientException('mock')
 
             self.assertIsNone(driver.get_block_obj(vault_id, block_id))
 
@@ -1,7 +1,22 @@
-from hashlib import md5
+from concurrent import futures
+from hashlib import md5, sha1
+import asyncio
+import functools
+import io
+import os
 from random import randrange
+import threading
+import time
 from unittest import TestCase
-from deuce.util import FileCat, set_qs, set_qs_on_url
+
+import mock
+
+from deuce.common import local
+from deuce.util import BlockStream, FileCat, LRUCache, SessionPool, \
+    set_qs, set_qs_on_url, iterfile
+from deuce.util import event_loop
+from deuce.util.event_loop import LoopThread, get_event_loop, run_in_loop
+from deuce.util.readahead import readahead
 from deuce.tests.util import MockFile
 
 try:  # pragma: no cover
@@ -116,3 +131,428 @@ class TestFileCat(TestCase):
 
             qs = parts.query
             output = parse.parse_qs(qs)
+
+
+class TestBlockStream(TestCase):
+
+    def test_chunks(self):
+        block = MockFile(1000)
+
+        stream = BlockStream(block, block.sha1(), 1000, chunk_size=300)
+        chunks = list(stream)
+
+        self.assertEqual([len(chunk) for chunk in chunks],
+                         [300, 300, 300, 100])
+        self.assertEqual(b''.join(chunks), block._content)
+        self.assertEqual(stream.bytes_read, 1000)
+
+    def test_reads_no_more_than_length(self):
+        block = MockFile(1000)
+        block_id = sha1(block._content[:10]).hexdigest()
+
+        stream = BlockStream(block, block_id, 10)
+        self.assertEqual(b''.join(stream), block._content[:10])
+        self.assertEqual(block._pos, 10)
+
+    def test_mismatches(self):
+        block = MockFile(100)
+
+        with self.assertRaises(BufferError):
+            list(BlockStream(block, block.sha1(), 200))
+
+        block.seek(0)
+        with self.assertRaises(ValueError):
+            list(BlockStream(block, 'f' * 40, 100))
+
+
+class TestIterFile(TestCase):
+
+    def test_iter_file(self):
+        data = os.urandom(1000)
+        block = io.BytesIO(data)
+
+        chunks = list(iterfile.iter_file(block, chunk_size=300))
+        self.assertEqual([len(chunk) for chunk in chunks],
+                         [300, 300, 300, 100])
+        self.assertEqual(b''.join(chunks), data)
+        self.assertTrue(block.closed)
+
+    def test_iter_file_closed_early(self):
+        block = io.BytesIO(os.urandom(1000))
+
+        chunks = iterfile.iter_file(block, chunk_size=300)
+        next(chunks)
+        chunks.close()
+        self.assertTrue(block.closed)
+
+    def test_iter_files(self):
+        datas = [os.urandom(500), os.urandom(10), b'']
+        blocks = [io.BytesIO(data) for data in datas]
+
+        chunks = list(iterfile.iter_files(iter(blocks), chunk_size=200))
+        self.assertEqual([len(chunk) for chunk in chunks],
+                         [200, 200, 100, 10])
+        self.assertEqual(b''.join(chunks), b''.join(datas))
+        self.assertTrue(all(block.closed for block in blocks))
+
+    def test_wrap_file(self):
+        data = os.urandom(10)
+        block = io.BytesIO(data)
+        wrapper = mock.Mock()
+
+        self.assertIs(iterfile.wrap_file({'wsgi.file_wrapper': wrapper},
+                                         block),
+                      wrapper.return_value)
+        wrapper.assert_called_once_with(block, iterfile.CHUNK_SIZE)
+
+        self.assertEqual(b''.join(iterfile.wrap_file({}, block)), data)
+
+
+class TestReadAhead(TestCase):
+
+    def test_in_order(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def job(value):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            # Later jobs finish first
+            time.sleep((10 - value) * 0.002)
+            with lock:
+                running[0] -= 1
+            return value
+
+        jobs = [(1, functools.partial(job, value)) for value in range(10)]
+        self.assertEqual(list(readahead(jobs, 3, 100)), list(range(10)))
+        self.assertTrue(1 < running[1] <= 3)
+
+    def test_budget(self):
+        started = []
+
+        def job(value):
+            started.append(value)
+            return value
+
+        sizes = [40, 40, 40, 200, 10]
+        jobs = [(size, functools.partial(job, value))
+                for value, size in enumerate(sizes)]
+
+        gen = readahead(jobs, 8, 100)
+        self.assertEqual(next(gen), 0)
+        # 0 and 1 are held; 2 does not fit alongside them
+        self.assertNotIn(2, started)
+
+        # The oversized job only starts once nothing else is waiting
+        self.assertEqual(next(gen), 1)
+        self.assertNotIn(3, started)
+        self.assertEqual(list(gen), [2, 3, 4])
+        self.assertEqual(started, [0, 1, 2, 3, 4])
+
+    def test_budget_reserved(self):
+        sizes = [60, 30, 50, 120, 10]
+        submitted = []
+
+        class Pool(object):
+
+            """Runs each job as it is submitted"""
+
+            def submit(self, func):
+                future = futures.Future()
+                future.set_result(func())
+                submitted.append(future.result())
+                return future
+
+        jobs = [(size, functools.partial(int, value))
+                for value, size in enumerate(sizes)]
+
+        # The results held, the one being consumed among them, never
+        # add up to more than the budget unless one is held alone
+        for value in readahead(jobs, 8, 100, Pool()):
+            held = sizes[value:len(submitted)]
+            self.assertTrue(sum(held) <= 100 or len(held) == 1, held)
+        self.assertEqual(submitted, list(range(5)))
+
+    def test_close_cancels(self):
+        started = []
+        jobs = [(1, functools.partial(started.append, value))
+                for value in range(100)]
+
+        gen = readahead(jobs, 2, 100)
+        next(gen)
+        gen.close()
+        self.assertTrue(len(started) <= 3)
+
+    def test_shared_pool(self):
+        with futures.ThreadPoolExecutor(max_workers=2) as pool:
+            jobs = [(1, functools.partial(int, value))
+                    for value in range(10)]
+            gen = readahead(jobs, 4, 100, pool)
+            self.assertEqual(next(gen), 0)
+            gen.close()
+
+            # The pool belongs to the caller and stays usable
+            self.assertEqual(list(readahead(jobs, 4, 100, pool)),
+                             list(range(10)))
+
+    def test_request_context(self):
+        local.request_context.project_id = 'mock'
+        self.addCleanup(local.request_context.__dict__.clear)
+
+        get = local.bind_request_context(
+            lambda: getattr(local.request_context, 'project_id', None))
+
+        with futures.ThreadPoolExecutor(max_workers=1) as pool:
+            self.assertEqual(pool.submit(get).result(), 'mock')
+            # Nothing is left behind in the worker thread
+            self.assertIsNone(pool.submit(
+                getattr, local.request_context, 'project_id', None).result())
+
+
+class TestSessionPool(TestCase):
+
+    def new_loop(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return loop
+
+    def test_session_per_endpoint_and_loop(self):
+        pool = SessionPool(4, 30, 60)
+        self.addCleanup(pool.close)
+        loop = self.new_loop()
+
+        session = pool.get('http://swift.example.com/v1/a/c/o', loop)
+        self.assertIs(pool.get('http://swift.example.com/v1/b', loop),
+                      session)
+        self.assertEqual(session.connector.limit, 4)
+
+        self.assertIsNot(pool.get('https://swift.example.com/v1', loop),
+                         session)
+        self.assertIsNot(pool.get('http://other.example.com/v1', loop),
+                         session)
+        self.assertIsNot(pool.get('http://swift.example.com/v1',
+                                  self.new_loop()),
+                         session)
+        self.assertEqual(len(pool), 4)
+
+    def test_semaphore(self):
+        pool = SessionPool(8, 30, 60, concurrency=2)
+        self.addCleanup(pool.close)
+        loop = self.new_loop()
+
+        semaphore = pool.semaphore('http://a.example.com/v1/a', loop)
+        self.assertIs(pool.semaphore('http://a.example.com/v1/b', loop),
+                      semaphore)
+        self.assertIsNot(pool.semaphore('http://b.example.com', loop),
+                         semaphore)
+        self.assertEqual(semaphore._value, 2)
+
+        # Falls back to the connection limit, if there is one
+        pool = SessionPool(8, 30, 60)
+        self.addCleanup(pool.close)
+        self.assertEqual(pool.semaphore('http://a.example.com',
+                                        loop)._value, 8)
+
+        pool = SessionPool(0, 30, 60)
+        self.addCleanup(pool.close)
+        self.assertIsNone(pool.semaphore('http://a.example.com', loop))
+
+    def test_idle_eviction(self):
+        now = [0]
+        pool = SessionPool(0, 30, 60, clock=lambda: now[0])
+        loop = self.new_loop()
+        other_loop = self.new_loop()
+
+        session = pool.get('http://a.example.com', loop)
+        other = pool.get('http://a.example.com', other_loop)
+        self.assertIsNone(session.connector.limit)
+
+        now[0] = 59
+        self.assertIs(pool.get('http://a.example.com', loop), session)
+
+        # Only sessions of the caller's loop are evicted
+        now[0] = 200
+        pool.get('http://b.example.com', loop)
+        self.assertTrue(session.closed)
+        self.assertFalse(other.closed)
+        self.assertIsNot(pool.get('http://a.example.com', loop), session)
+
+        pool.close()
+        self.assertTrue(other.closed)
+        self.assertEqual(len(pool), 0)
+
+    def test_in_use_not_evicted(self):
+        now = [0]
+        pool = SessionPool(0, 30, 60, clock=lambda: now[0])
+        self.addCleanup(pool.close)
+        loop = self.new_loop()
+
+        # e.g. a download that outlasts the idle timeout
+        session = pool.acquire('http://a.example.com/v1/a', loop)
+        now[0] = 200
+        pool.get('http://b.example.com', loop)
+        self.assertFalse(session.closed)
+
+        # Once it is over the session idles from then on
+        pool.release('http://a.example.com/v1/a', loop)
+        now[0] = 259
+        pool.get('http://b.example.com', loop)
+        self.assertFalse(session.closed)
+
+        now[0] = 260
+        pool.get('http://b.example.com', loop)
+        self.assertTrue(session.closed)
+
+    def test_close_after_fork(self):
+        pool = SessionPool(0, 30, 60)
+        session = pool.get('http://a.example.com', self.new_loop())
+        connector = session.connector
+
+        with mock.patch('os.getpid', return_value=-1):
+            pool.close()
+
+        # The parent's connections are left alone
+        self.assertTrue(session.closed)
+        self.assertFalse(connector.closed)
+        connector.close()
+
+
+class TestLRUCache(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_hits_and_misses(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b', 'default'), 'default')
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+        self.cache.clear()
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.now = 9
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+
+        # 'a' is now the most recently used
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_disabled(self):
+        for cache in (LRUCache(0, 10), LRUCache(10, 0)):
+            self.assertFalse(cache.enabled)
+            cache.set('a', 1)
+            self.assertIsNone(cache.get('a'))
+
+
+class TestEventLoop(TestCase):
+
+    def test_event_loop_in_thread(self):
+        @asyncio.coroutine
+        def coro(value):
+            return value, threading.current_thread()
+
+        wrapped = get_event_loop(coro)
+        results = []
+
+        thread = threading.Thread(target=lambda: results.append(wrapped(5)))
+        thread.start()
+        thread.join()
+
+        # Callers from every thread share the one loop thread
+        value, loop_thread = results[0]
+        self.assertEqual(value, 5)
+        self.assertIsNot(loop_thread, thread)
+        self.assertEqual(wrapped(6), (6, loop_thread))
+
+    def test_exception(self):
+        @get_event_loop
+        @asyncio.coroutine
+        def coro():
+            raise KeyError('mock')
+
+        self.assertRaises(KeyError, coro)
+
+    def test_timeout_cancels(self):
+        cancelled = threading.Event()
+
+        @run_in_loop(timeout=0.01)
+        @asyncio.coroutine
+        def coro():
+            try:
+                yield from asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        self.assertRaises(asyncio.TimeoutError, coro)
+        self.assertTrue(cancelled.wait(5))
+
+    def test_run_coroutine_threadsafe_fallback(self):
+        # Python before 3.4.4 has no asyncio.run_coroutine_threadsafe
+        with mock.patch.object(event_loop, 'run_coroutine_threadsafe',
+                               event_loop._run_coroutine_threadsafe):
+            loop_thread = event_loop.LoopThread()
+            self.addCleanup(loop_thread.stop)
+
+            @asyncio.coroutine
+            def coro(value):
+                yield from asyncio.sleep(0)
+                if value is None:
+                    raise KeyError('mock')
+                return value
+
+            self.assertEqual(loop_thread.run(coro(6)), 6)
+            self.assertRaises(KeyError, loop_thread.run, coro(None))
+
+            cancelled = threading.Event()
+
+            @asyncio.coroutine
+            def sleeper():
+                try:
+                    yield from asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+
+            self.assertRaises(futures.TimeoutError,
+                              loop_thread.run, sleeper(), 0.01)
+            self.assertTrue(cancelled.wait(5))
+
+    def test_restart_after_fork(self):
+        loop_thread = LoopThread()
+        self.addCleanup(loop_thread.stop)
+        loop = loop_thread.get_loop()
+        self.assertIs(loop_thread.get_loop(), loop)
+
+        # A forked child has no loop thread and starts its own
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            child_loop = loop_thread.get_loop()
+            self.assertIsNot(child_loop, loop)
+            self.assertTrue(child_loop.is_running())
+            loop_thread.stop()
+            self.assertFalse(child_loop.is_running())
+
+        loop.call_soon_threadsafe(loop.stop)
@@ -0,0 +1,359 @@
+import http.client
+import io
+import os
+import signal
+import socket
+import tempfile
+import threading
+from unittest import TestCase
+
+import mock
+
+import deuce
+from deuce.common import local
+from deuce.transport.wsgi import hooks
+from deuce.transport.wsgi import server
+from deuce.tests import V1Base
+
+
+def _app(environ, start_response):
+    path = environ['PATH_INFO']
+    body = environ['wsgi.input'].read()
+
+    if path == '/slow':
+        _app.release.wait(10)
+
+    if path == '/stream':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (chunk for chunk in [b'a', b'b'])
+
+    if path in ('/file', '/memory'):
+        if path == '/file':
+            fileobj = open(_app.file_path, 'rb')
+        else:
+            fileobj = io.BytesIO(_app.file_data)
+
+        start_response('200 OK', [
+            ('Content-Type', 'application/octet-stream'),
+            ('Content-Length', str(len(_app.file_data)))])
+        return environ['wsgi.file_wrapper'](fileobj, 1024)
+
+    if path == '/fail':
+        raise Exception('mocking application failure')
+
+    data = path.encode() + b':' + body
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(data)))])
+    return [data]
+
+_app.release = threading.Event()
+
+
+class TestRequestBody(TestCase):
+
+    def test_read_is_bounded(self):
+        body = server.RequestBody(io.BytesIO(b'hello world'), 5)
+        self.assertEqual(body.read(2), b'he')
+        self.assertEqual(body.read(), b'llo')
+        self.assertEqual(body.read(), b'')
+        self.assertEqual(body.remaining, 0)
+
+    def test_readline(self):
+        body = server.RequestBody(io.BytesIO(b'a\nb\nc\nnext'), 6)
+        self.assertEqual(body.readline(), b'a\n')
+        self.assertEqual(list(body), [b'b\n', b'c\n'])
+        self.assertEqual(body.readlines(), [])
+
+        body = server.RequestBody(io.BytesIO(b'a\nb\n'), 4)
+        self.assertEqual(body.readlines(), [b'a\n', b'b\n'])
+
+    def test_drain(self):
+        rfile = io.BytesIO(b'unreadnext')
+        body = server.RequestBody(rfile, 6)
+        self.assertTrue(body.drain())
+        self.assertEqual(rfile.read(), b'next')
+
+        # Too much left over to be worth reading
+        body = server.RequestBody(io.BytesIO(b'x' * 10), 10)
+        self.assertFalse(body.drain(limit=5))
+
+        # Client went away before sending the whole body
+        body = server.RequestBody(io.BytesIO(b'x'), 10)
+        self.assertFalse(body.drain())
+
+
+class TestThreadPoolWSGIServer(TestCase):
+
+    def start_server(self, **kwargs):
+        kwargs.setdefault('threads', 4)
+        httpd = server.ThreadPoolWSGIServer(
+            ('127.0.0.1', 0), server.KeepAliveRequestHandler, **kwargs)
+        httpd.set_app(_app)
+
+        thread = threading.Thread(target=httpd.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            _app.release.set()
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+        self.addCleanup(stop)
+        return httpd.server_address
+
+    def connect(self, address):
+        conn = http.client.HTTPConnection(*address, timeout=10)
+        self.addCleanup(conn.close)
+        return conn
+
+    def request(self, conn, method, path, body=None, headers=None):
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response, response.read()
+
+    def test_keep_alive(self):
+        address = self.start_server(keepalive_timeout=5)
+        conn = self.connect(address)
+
+        response, data = self.request(conn, 'PUT', '/one', body=b'abc')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(data, b'/one:abc')
+        self.assertIsNone(response.getheader('connection'))
+        sock = conn.sock
+
+        response, data = self.request(conn, 'GET', '/two')
+        self.assertEqual(data, b'/two:')
+
+        # Both requests were served over the same connection
+        self.assertIs(conn.sock, sock)
+
+    def test_unread_body_is_drained(self):
+        address = self.start_server()
+        conn = self.connect(address)
+
+        # The application never reads the body; the next request on the
+        # connection must still be parsed correctly
+        def lazy_app(environ, start_response):
+            start_response('204 No Content', [('Content-Length', '0')])
+            return []
+
+        with mock.patch.object(server.simple_server.WSGIServer, 'get_app',
+                               return_value=lazy_app):
+            response, data = self.request(conn, 'PUT', '/lazy',
+                                          body=b'x' * 100)
+            self.assertEqual(response.status, 204)
+
+            response, data = self.request(conn, 'PUT', '/lazy',
+                                          body=b'y' * 100)
+            self.assertEqual(response.status, 204)
+
+    def test_close_without_content_length(self):
+        address = self.start_server()
+        conn = self.connect(address)
+
+        response, data = self.request(conn, 'GET', '/stream')
+        self.assertEqual(data, b'ab')
+        self.assertEqual(response.getheader('connection'), 'close')
+
+    def test_close_when_requested(self):
+        address = self.start_server()
+        conn = self.connect(address)
+
+        response, data = self.request(conn, 'GET', '/one',
+                                      headers={'Connection': 'close'})
+        self.assertEqual(response.getheader('connection'), 'close')
+
+    def test_close_when_disabled(self):
+        address = self.start_server(keepalive=False)
+        conn = self.connect(address)
+
+        response, data = self.request(conn, 'GET', '/one')
+        self.assertEqual(data, b'/one:')
+        self.assertEqual(response.getheader('connection'), 'close')
+
+    def test_close_on_chunked_upload(self):
+        address = self.start_server()
+        conn = self.connect(address)
+
+        response, data = self.request(conn, 'PUT', '/one', body=b'',
+                                      headers={'Transfer-Encoding': 'gzip',
+                                               'Content-Length': 'bogus'})
+        self.assertEqual(response.getheader('connection'), 'close')
+
+    def test_http_1_0_keep_alive(self):
+        address = self.start_server()
+        conn = self.connect(address)
+        conn._http_vsn = 10
+        conn._http_vsn_str = 'HTTP/1.0'
+
+        response, data = self.request(conn, 'GET', '/one',
+                                      headers={'Connection': 'keep-alive'})
+        self.assertEqual(response.getheader('connection'), 'keep-alive')
+
+    def test_application_error(self):
+        address = self.start_server()
+        conn = self.connect(address)
+
+        with mock.patch.object(server.KeepAliveServerHandler,
+                               'log_exception'):
+            response, data = self.request(conn, 'GET', '/fail')
+
+        self.assertEqual(response.status, 500)
+        self.assertEqual(response.getheader('connection'), 'close')
+
+    def test_sendfile(self):
+        address = self.start_server(keepalive_timeout=5)
+        conn = self.connect(address)
+
+        _app.file_data = os.urandom(100 * 1024)
+        fd, _app.file_path = tempfile.mkstemp()
+        self.addCleanup(os.remove, _app.file_path)
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(_app.file_data)
+
+        real_sendfile = socket.socket.sendfile
+        with mock.patch.object(socket.socket, 'sendfile', autospec=True,
+                               side_effect=real_sendfile) as sendfile:
+            response, data = self.request(conn, 'GET', '/file')
+            self.assertEqual(response.status, 200)
+            self.assertEqual(data, _app.file_data)
+            self.assertEqual(sendfile.call_count, 1)
+
+            # Without a descriptor the file is iterated instead
+            response, data = self.request(conn, 'GET', '/memory')
+            self.assertEqual(response.status, 200)
+            self.assertEqual(data, _app.file_data)
+            self.assertEqual(sendfile.call_count, 1)
+
+        # The connection is still in step
+        response, data = self.request(conn, 'PUT', '/one', body=b'abc')
+        self.assertEqual(data, b'/one:abc')
+
+    def test_bad_requests(self):
+        address = self.start_server()
+
+        conn = self.connect(address)
+        response, data = self.request(conn, 'GET', '/' + 'x' * 70000)
+        self.assertEqual(response.status, 414)
+
+        conn = self.connect(address)
+        conn.connect()
+        conn.sock.sendall(b'GET /one HTTP/bogus\r\n\r\n')
+        # The version is unknown so the error goes out without a status
+        # line, after which the server hangs up
+        data = conn.sock.makefile('rb').read()
+        self.assertIn(b'Error code: 400', data)
+
+    def test_idle_connection_times_out(self):
+        address = self.start_server(keepalive_timeout=1)
+        conn = self.connect(address)
+
+        response, data = self.request(conn, 'GET', '/one')
+        self.assertEqual(response.status, 200)
+
+        # The server hangs up on the idle connection
+        conn.sock.settimeout(5)
+        self.assertEqual(conn.sock.recv(1), b'')
+
+    def test_slow_request_does_not_block_others(self):
+        _app.release.clear()
+        address = self.start_server(threads=2)
+
+        slow_conn = self.connect(address)
+        slow_conn.request('GET', '/slow')
+
+        fast_conn = self.connect(address)
+        response, data = self.request(fast_conn, 'GET', '/fast')
+        self.assertEqual(data, b'/fast:')
+
+        _app.release.set()
+        self.assertEqual(slow_conn.getresponse().read(), b'/slow:')
+
+    def test_worker_error(self):
+        httpd = server.ThreadPoolWSGIServer(
+            ('127.0.0.1', 0), server.KeepAliveRequestHandler, threads=1)
+        self.addCleanup(httpd.server_close)
+
+        request = mock.Mock()
+        with mock.patch.object(httpd, 'finish_request',
+                               side_effect=Exception('mock')):
+            httpd.process_request(request, ('127.0.0.1', 0))
+            httpd.server_close()
+
+        # The worker slot was given back despite the failure
+        self.assertTrue(httpd._slots.acquire(blocking=False))
+
+
+class TestWorkerPool(TestCase):
+
+    def test_serve_single_process(self):
+        httpd = mock.Mock()
+        server.serve(httpd)
+        httpd.serve_forever.assert_called_once_with()
+
+    def test_serve_prefork(self):
+        httpd = mock.Mock()
+        post_fork = mock.Mock()
+        with mock.patch.object(server.WorkerPool, 'run') as run:
+            server.serve(httpd, workers=3, post_fork=post_fork)
+            run.assert_called_once_with()
+        self.assertFalse(httpd.serve_forever.called)
+
+    def test_run(self):
+        httpd = mock.Mock()
+        pool = server.WorkerPool(httpd, 2)
+
+        pids = iter(range(100, 200))
+        waits = []
+
+        def fake_wait():
+            if not pool._running:
+                return (sorted(pool.children)[0], 0)
+            waits.append(1)
+            if len(waits) == 1:
+                # A worker died and should get replaced
+                return (100, 256)
+            if len(waits) == 2:
+                # Not one of ours
+                return (1, 0)
+            pool._stop(signal.SIGTERM, None)
+
+        with mock.patch('os.fork', side_effect=lambda: next(pids)), \
+                mock.patch('os.wait', side_effect=fake_wait), \
+                mock.patch('os.kill') as kill:
+            pool.run()
+
+        # 100 and 101 started, 100 replaced by 102
+        killed = sorted(call[0][0] for call in kill.call_args_list)
+        self.assertEqual(killed, [101, 102])
+        self.assertEqual(pool.children, set())
+        httpd.server_close.assert_called_once_with()
+
+        # Signal handlers are restored
+        self.assertNotEqual(signal.getsignal(signal.SIGTERM), pool._stop)
+
+
+class TestConcurrentContext(V1Base):
+
+    def test_context_is_per_thread(self):
+        seen = {}
+        ready = threading.Barrier(2)
+
+        def request(name):
+            hooks.DeuceContextHook(None, None, {})
+            deuce.context.project_id = name
+            ready.wait(5)
+            seen[name] = deuce.context.project_id
+
+        threads = [threading.Thread(target=request, args=(name,))
+                   for name in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(seen, {'a': 'a', 'b': 'b'})
+        self.assertIs(deuce.context, local.request_context)
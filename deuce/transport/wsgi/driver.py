@@ -1,11 +1,13 @@
 from deuce import conf
 
+import functools
 from wsgiref import simple_server
 
 import falcon
 
 from deuce.transport.wsgi import v1_0
 from deuce.transport.wsgi import hooks
+from deuce.transport.wsgi import server
 
 from deuce import model
 import deuce.util.log as logging
@@ -54,13 +56,28 @@ class Driver(object):
                 self.app.add_route(version_path + route, resource)
 
     def listen(self):
-        """Self-host using 'bind' and 'port' from deuce conf"""
-        msgtmpl = (u'Serving on host %(bind)s:%(port)s')
+        """Self-host using the [server] section of deuce conf"""
+        msgtmpl = (u'Serving on host %(bind)s:%(port)s with '
+                   u'%(workers)s worker(s) of %(threads)s thread(s)')
         logger = logging.getLogger(__name__)
         logger.info(msgtmpl,
-                    {'bind': conf.server.host, 'port': conf.server.port})
-
-        httpd = simple_server.make_server(conf.server.host,
-                                          conf.server.port,
-                                          self.app)
-        httpd.serve_forever()
+                    {'bind': conf.server.host, 'port': conf.server.port,
+                     'workers': conf.server.workers,
+                     'threads': conf.server.threads})
+
+        server_class = functools.partial(
+            server.ThreadPoolWSGIServer,
+            threads=conf.server.threads,
+            keepalive=conf.server.keepalive,
+            keepalive_timeout=conf.server.keepalive_timeout)
+
+        httpd = simple_server.make_server(
+            conf.server.host,
+            conf.server.port,
+            self.app,
+            server_class=server_class,
+            handler_class=server.KeepAliveRequestHandler)
+
+        # Each pre-forked worker needs its own driver connections
+        server.serve(httpd, workers=conf.server.workers,
+                     post_fork=model.init_model)
@@ -1,11 +1,14 @@
 import deuce
+from deuce.common import local
 
 
 def DeuceContextHook(req, resp, params):
     """
     Deuce Context Hook
     """
-    from threading import local as local_factory
-    deuce.context = local_factory()
+    deuce.context = local.request_context
+
+    # Start every request with a clean context for this thread
+    deuce.context.__dict__.clear()
 
     deuce.context.datacenter = deuce.conf.api_configuration.datacenter.lower()
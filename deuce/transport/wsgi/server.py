@@ -0,0 +1,407 @@
+"""
+Concurrent self-hosting for the Deuce WSGI application
+
+wsgiref's reference server handles one request at a time, so a single
+slow block upload stalls every other tenant. The pieces in this module
+build on top of it:
+
+    ThreadPoolWSGIServer - dispatches connections to a bounded pool of
+                           worker threads
+    KeepAliveRequestHandler - serves several requests over one
+                              HTTP/1.1 connection
+    WorkerPool - pre-forks worker processes that share the listening
+                 socket
+"""
+from concurrent import futures
+import errno
+import os
+import signal
+import socket
+import threading
+from wsgiref import simple_server
+
+from deuce.common import local
+import deuce.util.log as logging
+
+
+logger = logging.getLogger(__name__)
+
+# Largest request body we are willing to read and discard in order to
+# keep a connection alive when the application did not consume it.
+MAX_DRAIN_SIZE = 64 * 1024
+
+
+class RequestBody(object):
+
+    """wsgi.input for a single request on a persistent connection.
+
+    Reads are bounded by the request's Content-Length so that the
+    application can never consume the start of the next request.
+    """
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self._remaining = length
+
+    @property
+    def remaining(self):
+        return self._remaining
+
+    def _bound(self, size):
+        if size is None or size < 0 or size > self._remaining:
+            return self._remaining
+        return size
+
+    def read(self, size=None):
+        size = self._bound(size)
+        if size == 0:
+            return b''
+
+        data = self._rfile.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def readline(self, size=None):
+        size = self._bound(size)
+        if size == 0:
+            return b''
+
+        data = self._rfile.readline(size)
+        self._remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, limit=MAX_DRAIN_SIZE):
+        """Discards whatever the application left unread.
+
+        :returns: True if the connection is positioned at the start of
+                  the next request, False if it must be closed
+        """
+        if self._remaining > limit:
+            return False
+
+        while self._remaining > 0:
+            if not self.read(self._remaining):
+                return False
+        return True
+
+
+class KeepAliveServerHandler(simple_server.ServerHandler):
+
+    """Speaks HTTP/1.1 and decides, once the application's headers
+    are known, whether the connection can be reused."""
+
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        super(KeepAliveServerHandler, self).cleanup_headers()
+
+        request_handler = self.request_handler
+
+        # Without a Content-Length the client can only find the end of
+        # the response by us closing the connection.
+        if 'Content-Length' not in self.headers:
+            request_handler.close_connection = True
+
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+        elif request_handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+    def sendfile(self):
+        """Sends a wsgi.file_wrapper response backed by a real file
+        straight from the page cache to the socket, without copying it
+        through Python. Anything else (e.g. an in-memory block) falls
+        back to plain iteration."""
+        sock = self.request_handler.connection
+        filelike = self.result.filelike
+
+        if not hasattr(sock, 'sendfile'):  # pragma: no cover
+            return False
+
+        try:
+            filelike.fileno()
+        except (AttributeError, OSError, ValueError):
+            # io.UnsupportedOperation is both an OSError and ValueError
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+
+        count = self.headers.get('Content-Length')
+        count = int(count) if count is not None else None
+
+        sent = sock.sendfile(filelike, count=count)
+        self.bytes_sent += sent
+
+        # The file changed under us; the client is now out of step.
+        if count is not None and sent != count:
+            self.request_handler.close_connection = True
+
+        return True
+
+    def handle_error(self):
+        # Whatever was (or was not) sent, the stream can no longer be
+        # trusted to be in sync with the client.
+        self.request_handler.close_connection = True
+        super(KeepAliveServerHandler, self).handle_error()
+
+
+class KeepAliveRequestHandler(simple_server.WSGIRequestHandler):
+
+    """Serves requests until the client or the server asks for the
+    connection to be closed or it sits idle for too long."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = getattr(self.server, 'keepalive_timeout', None) or None
+        super(KeepAliveRequestHandler, self).setup()
+
+        # Headers and body go out in separate writes; don't let Nagle's
+        # algorithm hold the body back waiting on a delayed ACK.
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):  # pragma: no cover
+            pass
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def _content_length(self):
+        try:
+            return max(0, int(self.headers.get('content-length', 0)))
+        except ValueError:
+            return 0
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            # Idle keep-alive connection timed out or went away
+            self.close_connection = True
+            return
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+
+        if not self.parse_request():  # An error code has been sent
+            self.close_connection = True
+            return
+
+        if not getattr(self.server, 'keepalive', False):
+            self.close_connection = True
+
+        # Chunked uploads are not understood, so we cannot tell where
+        # such a request ends.
+        if self.headers.get('transfer-encoding'):
+            self.close_connection = True
+
+        body = RequestBody(self.rfile, self._content_length())
+
+        handler = KeepAliveServerHandler(
+            body, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        try:
+            handler.run(self.server.get_app())
+        finally:
+            # The response has been sent; don't let this thread hold on
+            # to the request's context until it serves another one.
+            local.request_context.__dict__.clear()
+
+        if not self.close_connection and not body.drain():
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.address_string(), format % args)
+
+
+class ThreadPoolWSGIServer(simple_server.WSGIServer):
+
+    """A WSGIServer that hands each accepted connection to one of a
+    bounded pool of worker threads.
+
+    Once every worker is busy the accept loop stops pulling
+    connections off the listen queue until one frees up.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, threads=1,
+                 keepalive=True, keepalive_timeout=None,
+                 bind_and_activate=True):
+        self.threads = max(1, int(threads))
+        self.keepalive = keepalive
+        self.keepalive_timeout = keepalive_timeout
+        self._slots = threading.BoundedSemaphore(self.threads)
+        self._pool = None
+        simple_server.WSGIServer.__init__(self, server_address,
+                                          RequestHandlerClass,
+                                          bind_and_activate)
+
+    def _get_pool(self):
+        # Created lazily so no thread exists before a pre-fork
+        if self._pool is None:
+            self._pool = futures.ThreadPoolExecutor(
+                max_workers=self.threads)
+        return self._pool
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self._get_pool().submit(self._process_request_worker,
+                                    request, client_address)
+        except Exception:  # pragma: no cover
+            self._slots.release()
+            self.shutdown_request(request)
+            raise
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def handle_error(self, request, client_address):
+        logger.exception('Error processing request from {0}'
+                         .format(client_address))
+
+    def server_close(self):
+        simple_server.WSGIServer.server_close(self)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+class _Shutdown(Exception):
+    pass
+
+
+class WorkerPool(object):
+
+    """Pre-forks worker processes that all accept connections from
+    the listening socket of the given server.
+
+    Worker processes that exit are replaced until the pool receives
+    SIGTERM or SIGINT, at which point every worker is terminated.
+    """
+
+    def __init__(self, httpd, workers, post_fork=None):
+        """
+        :param httpd: A bound and activated server
+        :param workers: The number of worker processes to maintain
+        :param post_fork: Called in each worker before it starts
+                          serving, e.g. to open fresh driver connections
+        """
+        self._httpd = httpd
+        self._workers = workers
+        self._post_fork = post_fork
+        self._children = set()
+        self._running = False
+
+    @property
+    def children(self):
+        return set(self._children)
+
+    def _stop(self, signum, frame):
+        raise _Shutdown()
+
+    def _spawn(self):
+        pid = os.fork()
+
+        if pid == 0:  # pragma: no cover
+            # Worker process; the code below never returns
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                if self._post_fork is not None:
+                    self._post_fork()
+                self._httpd.serve_forever()
+            except BaseException:
+                logger.exception('Worker {0} failed'.format(os.getpid()))
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        logger.info('Started worker {0}'.format(pid))
+        self._children.add(pid)
+        return pid
+
+    def _reap(self):
+        pid, status = os.wait()
+        if pid in self._children:
+            self._children.discard(pid)
+            log = logger.warning if self._running else logger.info
+            log('Worker {0} exited with status {1}'.format(pid, status))
+        return pid
+
+    def _terminate(self):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as ex:  # pragma: no cover
+                if ex.errno != errno.ESRCH:
+                    raise
+                self._children.discard(pid)
+
+        while self._children:
+            try:
+                self._reap()
+            except ChildProcessError:  # pragma: no cover
+                self._children.clear()
+
+    def run(self):
+        previous = {
+            signum: signal.signal(signum, self._stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+
+        self._running = True
+        try:
+            while self._running:
+                while len(self._children) < self._workers:
+                    self._spawn()
+                self._reap()
+
+        except _Shutdown:
+            logger.info('Shutting down {0} workers'
+                        .format(len(self._children)))
+
+        finally:
+            self._running = False
+            self._terminate()
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            self._httpd.server_close()
+
+
+def serve(httpd, workers=1, post_fork=None):
+    """Serves requests from httpd until interrupted, either in this
+    process or across a pool of pre-forked worker processes.
+    """
+    if workers > 1:
+        WorkerPool(httpd, workers, post_fork=post_fork).run()
+    else:
+        httpd.serve_forever()
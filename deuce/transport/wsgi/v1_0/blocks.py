@@ -6,6 +6,7 @@ import msgpack
 import deuce
 from deuce import conf
 from deuce.util import set_qs_on_url
+from deuce.util import iterfile
 from deuce.model import Vault
 from deuce.model import Block
 from deuce.model.exceptions import ConsistencyError
@@ -36,12 +37,13 @@ class ItemResource(object):
             logger.error('Vault [{0}] does not exist'.format(vault_id))
             raise errors.HTTPNotFound
 
-        # This is safe to construct before we check the status of the block
-        # b/c the constructor does not do anything other than save values
-        # to itself, no lookups, etc
+        # The metadata of the block is looked up once; the existence
+        # check and every header below share it
         block = Block(vault_id, block_id)
         try:
-            if not vault.has_block(block_id, check_storage=True):
+            info = block.get_info()
+            if info is None or not vault.has_block(
+                    block_id, check_storage=True, info=info):
                 logger.error('block [{0}] does not exist'.format(block_id))
                 raise errors.HTTPNotFound
             ref_cnt = block.get_ref_count()
@@ -123,7 +125,7 @@ class ItemResource(object):
             resp.set_header('X-Storage-ID', str(storage_id))
             resp.set_header('X-Block-ID', str(block_id))
 
-            resp.stream = block.get_obj()
+            resp.stream = iterfile.wrap_file(req.env, block.get_obj())
             resp.stream_len = block.get_block_length()
 
             resp.status = falcon.HTTP_200
@@ -159,16 +161,17 @@ class ItemResource(object):
 
         try:
             retval, storage_id = vault.put_block(
-                block_id, req.stream.read(), req.content_length)
+                block_id, req.stream, req.content_length)
             resp.set_header('X-Storage-ID', str(storage_id))
             resp.set_header('X-Block-ID', str(block_id))
 
-            block = vault.get_block(block_id)
-
             ref_cnt = 0
             ref_mod = 0
 
             if retval:
+                # Only the metadata is needed; the block itself is not
+                # opened in storage
+                block = Block(vault_id, block_id)
                 ref_cnt = block.get_ref_count()
                 ref_mod = block.get_ref_modified()
 
@@ -225,29 +228,25 @@ class CollectionResource(object):
     def on_post(self, req, resp, vault_id):
         vault = Vault.get(vault_id)
         try:
-            unpacked = msgpack.unpackb(req.stream.read())
-
-            if not isinstance(unpacked, dict):
-                raise TypeError
-
-            else:
-                block_ids = list(unpacked.keys())
-                block_datas = list(unpacked.values())
-                try:
-                    retval, retblocks = vault.put_async_block(
-                        block_ids,
-                        block_datas)
-                    if retval:
-                        resp.status = falcon.HTTP_200
-                        resp.body = json.dumps({block_id: storage_id
-                                               for block_id, storage_id
-                                               in retblocks})
-                    else:
-                        raise errors.HTTPInternalServerError('Block '
-                                                            'Post Failed')
-                    logger.info('blocks [{0}] added'.format(block_ids))
-                except ValueError:
-                    raise errors.HTTPPreconditionFailed('hash error')
+            # Blocks are stored a few at a time as they are decoded
+            # rather than after the whole body has been unpacked. A
+            # body found to be malformed, or holding a bad block, part
+            # way is rejected, but the batches before it remain stored.
+            blocks = _unpack_blocks(req.stream)
+            try:
+                retval, retblocks = vault.put_async_block_stream(blocks)
+                if retval:
+                    resp.status = falcon.HTTP_200
+                    resp.body = json.dumps({block_id: storage_id
+                                           for block_id, storage_id
+                                           in retblocks})
+                else:
+                    raise errors.HTTPInternalServerError('Block '
+                                                        'Post Failed')
+                logger.info('blocks [{0}] added'.format(
+                    [block_id for block_id, storage_id in retblocks]))
+            except ValueError:
+                raise errors.HTTPPreconditionFailed('hash error')
         except (TypeError, ValueError):
             logger.error('Request Body not well formed '
                          'for posting multiple blocks to {0}'.format(vault_id))
@@ -289,3 +288,38 @@ class CollectionResource(object):
 
         resp.body = json.dumps([response.metadata_block_id
                                 for response in responses])
+
+
+def _unpack_blocks(stream):
+    """Yields the (block_id, block_data) pairs of a msgpack'd map as they
+    are read from the stream
+
+    :raises TypeError: The stream does not hold a well formed map of
+                       block ids to block data
+    """
+    unpacker = msgpack.Unpacker(stream)
+
+    try:
+        count = unpacker.read_map_header()
+    except (msgpack.UnpackException, ValueError):
+        raise TypeError('Request body is not a map')
+
+    for _ in range(count):
+        try:
+            block_id = unpacker.unpack()
+            block_data = unpacker.unpack()
+        except (msgpack.UnpackException, ValueError):
+            raise TypeError('Request body is truncated or malformed')
+
+        if not isinstance(block_id, bytes) or \
+                not isinstance(block_data, bytes):
+            raise TypeError('Block ids and data must be binary')
+
+        yield block_id, block_data
+
+    try:
+        unpacker.unpack()
+    except msgpack.OutOfData:
+        return
+
+    raise TypeError('Extra data after the map of blocks')
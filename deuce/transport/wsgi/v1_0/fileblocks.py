@@ -4,6 +4,7 @@ from stoplight import validate
 
 from deuce.util import set_qs_on_url
 from deuce.model import Vault
+from deuce.drivers.metadatadriver import BlockWriteError
 from deuce import conf
 import deuce.util.log as logging
 from deuce.transport.validation import *
@@ -84,7 +85,15 @@ class CollectionResource(object):
         block_ids, offsets = zip(*payload)
 
         missing_blocks = deuce.metadata_driver.has_blocks(vault_id, block_ids)
-        deuce.metadata_driver.assign_blocks(vault_id, file_id, block_ids,
-                                            offsets)
+        try:
+            deuce.metadata_driver.assign_blocks(vault_id, file_id, block_ids,
+                                                offsets)
+        except BlockWriteError as ex:
+            # The other blocks were assigned; posting the same list again
+            # assigns the ones that failed
+            logger.error(str(ex))
+            raise errors.HTTPInternalServerError(
+                'Failed to assign blocks {0}'.format(
+                    json.dumps(sorted(ex.errors))))
 
         resp.body = json.dumps(missing_blocks)
@@ -3,6 +3,7 @@ import json
 from stoplight import validate
 
 from deuce.util import set_qs_on_url
+from deuce.util import iterfile
 from deuce.model import Vault
 from deuce import conf
 import deuce.util.log as logging
@@ -97,17 +98,23 @@ class ItemResource(object):
         block_gen = deuce.metadata_driver.create_file_block_generator(
             vault_id, file_id)
 
-        block_ids = [block[0] for block in sorted(block_gen,
-                                                  key=lambda block: block[1])]
+        blocks = sorted(block_gen, key=lambda block: block[1])
+        block_ids = [block[0] for block in blocks]
+        length = vault.get_file_length(file_id)
 
-        objs = vault.get_blocks_generator(block_ids)
+        # A finalized file has no gaps, so each block ends where the
+        # next one starts
+        offsets = [block[1] for block in blocks] + [length]
+        sizes = [end - start for start, end in zip(offsets, offsets[1:])]
 
-        # NOTE(TheSriram): falcon 0.2.0 might fix this problem,
-        # we should be able to set resp.stream to any file like
-        # object instead of an iterator.
-        resp.stream = (obj.read() for obj in objs)
+        # Where the storage driver benefits, the next few blocks are
+        # fetched while one is being sent; each goes out in bounded
+        # chunks.
+        objs = vault.get_blocks_generator(block_ids, sizes)
+
+        resp.stream = iterfile.iter_files(objs)
         resp.status = falcon.HTTP_200
-        resp.set_header('Content-Length', str(vault.get_file_length(file_id)))
+        resp.set_header('Content-Length', str(length))
         resp.content_type = 'application/octet-stream'
 
     @validate(vault_id=VaultPutRule, file_id=FilePostRuleNoneOk)
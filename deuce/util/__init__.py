@@ -3,5 +3,13 @@ from deuce.util.misc import set_qs
 from deuce.util.misc import set_qs_on_url
 from deuce.util import client
 from deuce.util import filecat
+from deuce.util import blockstream
+from deuce.util import lrucache
+from deuce.util import iterfile
+from deuce.util import sessionpool
+from deuce.util import readahead
 
 FileCat = filecat.FileCat
+BlockStream = blockstream.BlockStream
+LRUCache = lrucache.LRUCache
+SessionPool = sessionpool.SessionPool
@@ -0,0 +1,59 @@
+import hashlib
+
+
+class BlockStream(object):
+
+    """BlockStream: Reads a block upload from a file-like object in
+    chunks, hashing and counting the data as it goes by.
+
+    Iterating yields the chunks. Once the expected number of bytes has
+    been consumed the data is checked against the block id and the
+    declared length; a mismatch is raised from the iterator before it
+    stops, so a consumer that stores the chunks as they arrive never
+    gets to commit a bad block."""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fileobj, block_id, length, chunk_size=None):
+        """Constructs a new BlockStream object.
+        :param fileobj: A ready-to-read file-like object
+        :param block_id: The expected SHA-1 of the data (hex)
+        :param length: The expected length of the data
+        :param chunk_size: The largest chunk to read at a time
+        """
+        self._fileobj = fileobj
+        self._block_id = block_id
+        self._length = length
+        self._chunk_size = chunk_size or BlockStream.chunk_size
+        self._sha1 = hashlib.sha1()
+        self._bytes_read = 0
+
+    @property
+    def bytes_read(self):
+        return self._bytes_read
+
+    def __iter__(self):
+        while self._bytes_read < self._length:
+            chunk = self._fileobj.read(
+                min(self._chunk_size, self._length - self._bytes_read))
+
+            if not chunk:
+                break
+
+            self._sha1.update(chunk)
+            self._bytes_read += len(chunk)
+            yield chunk
+
+        self.verify()
+
+    def verify(self):
+        """Raises BufferError if fewer bytes than expected were read and
+        ValueError if the data does not hash to the block id"""
+        if self._bytes_read != self._length:
+            raise BufferError(
+                'Specified block length ({0}) does not match '
+                'actual block length ({1})'.format(
+                    self._length, self._bytes_read))
+
+        if self._sha1.hexdigest() != self._block_id:
+            raise ValueError('Invalid Hash Value in the block ID')
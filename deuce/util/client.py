@@ -1,22 +1,133 @@
 import aiohttp
 import asyncio
+import atexit
 import hashlib
+import functools
 import json
+import random
 from swiftclient.exceptions import ClientException
 
 from deuce import conf
-from deuce.util.event_loop import get_event_loop
+from deuce.util.event_loop import loop_thread
+from deuce.util.sessionpool import SessionPool
 
 # NOTE (TheSriram) : must include exception handling
 
+sessions = SessionPool(conf.block_storage_driver.swift.connection_limit,
+                       conf.block_storage_driver.swift.keepalive_timeout,
+                       conf.block_storage_driver.swift.idle_timeout,
+                       conf.block_storage_driver.swift.upload_concurrency)
+
+
+def in_loop(func):
+    """
+    Makes a coroutine function synchronous: every call into Swift runs
+    on the shared loop thread, and the caller gives up on it (and it is
+    cancelled) after request_timeout seconds. A call that times out
+    raises ClientException, as any other failed request does.
+    """
+    @functools.wraps(func)
+    def wrap(*args, **kwargs):
+        try:
+            return loop_thread.run(
+                func(*args, **kwargs),
+                conf.block_storage_driver.swift.request_timeout or None)
+        except asyncio.TimeoutError:
+            raise ClientException('Swift request timed out')
+    return wrap
+
+
+@atexit.register
+def _shutdown():
+    loop_thread.stop()
+    sessions.close()
+
+
+# Failures worth trying again: the connection or the server broke
+_retry_errors = (aiohttp.ClientError, aiohttp.DisconnectedError,
+                 OSError, asyncio.TimeoutError)
+
+
+@asyncio.coroutine
+def _send(method, url, headers, data=None):
+    """Sends a request on the pooled session of url. The session stays
+    in use, so it is not closed for being idle, until _done(url) is
+    called once the response has been dealt with."""
+    loop = asyncio.get_event_loop()
+    session = sessions.acquire(url, loop)
+    try:
+        response = yield from session.request(method, url,
+                                              headers=headers, data=data)
+    except BaseException:
+        sessions.release(url, loop)
+        raise
+    return response
+
+
+def _done(url):
+    sessions.release(url, asyncio.get_event_loop())
+
+
+@asyncio.coroutine
+def _read_body(response):
+    try:
+        body = yield from response.content.read()
+    except Exception:
+        # The connection is in an unknown state; don't pool it
+        response.close()
+        raise
+
+    yield from response.release()
+    return body
+
 
 def _noloop_request(method, url, headers, data=None):
-    response = yield from aiohttp.request(method=method, url=url,
-                                          headers=headers, data=data)
+    response = yield from _send(method, url, headers, data)
+    try:
+        # Nothing more is read; hand the connection back to the pool
+        yield from response.release()
+    finally:
+        _done(url)
     return response
 
 
-@get_event_loop
+@asyncio.coroutine
+def _retrying_request(method, url, headers, data=None):
+    """Makes a request, holding the semaphore of the storage URL while
+    it is in flight. A 5xx response or a broken connection is retried
+    after a jittered exponential backoff.
+
+    Returns the status of the last response, or None if the last try
+    got no response at all.
+    """
+    retries = conf.block_storage_driver.swift.retries
+    backoff = conf.block_storage_driver.swift.retry_backoff
+    semaphore = sessions.semaphore(url, asyncio.get_event_loop())
+
+    attempt = 0
+    while True:
+        status = None
+        try:
+            if semaphore is not None:
+                with (yield from semaphore):
+                    response = yield from _noloop_request(
+                        method, url, headers, data)
+            else:
+                response = yield from _noloop_request(
+                    method, url, headers, data)
+            status = response.status
+
+        except _retry_errors:
+            pass
+
+        if (status is not None and status < 500) or attempt >= retries:
+            return status
+
+        yield from asyncio.sleep(random.uniform(0, backoff * 2 ** attempt))
+        attempt += 1
+
+
+@in_loop
 def _async_request(method, url, headers, names, contents, etag):
     tasks = []
     for name, content in zip(names, contents):
@@ -34,38 +145,107 @@ def _async_request(method, url, headers, names, contents, etag):
             headers.update({'Content-Length': str(len(content))})
         tasks.append(
             asyncio.Task(
-                _noloop_request(
+                _retrying_request(
                     'PUT',
                     url +
                     str(name),
                     headers=headers,
                     data=content)))
-    total_responses = yield from asyncio.gather(*tasks)
-    return total_responses
+    total_statuses = yield from asyncio.gather(*tasks)
+    return total_statuses
 
 
-@get_event_loop
+@in_loop
 def _request(method, url, headers, data=None):
-    response = yield from aiohttp.request(method=method, url=url,
-                                          headers=headers, data=data)
+    response = yield from _noloop_request(method, url, headers, data)
     return response
 
 
-@get_event_loop
+@in_loop
 def _request_getobj(method, url, headers, data=None):
-    response = yield from aiohttp.request(method=method, url=url,
-                                          headers=headers, data=data)
-
-    block = yield from response.content.read()
+    response = yield from _send(method, url, headers, data)
+    try:
+        block = yield from _read_body(response)
+    finally:
+        _done(url)
     return (response, block)
 
 
-@get_event_loop
-def _request_getcontainer(method, url, headers, data=None):
-    response = yield from aiohttp.request(method=method, url=url,
-                                          headers=headers, data=data)
+@in_loop
+def _request_stream(method, url, headers, data=None):
+    response = yield from _send(method, url, headers, data)
+    return response
+
+
+@in_loop
+def _finish(response, url):
+    # Checked and done on the loop, which the connection belongs to: a
+    # fully read body gives it back to the pool, otherwise it is dropped
+    try:
+        if response.content.at_eof():
+            yield from response.release()
+        else:
+            response.close()
+    finally:
+        _done(url)
+
 
-    content = yield from response.content.read()
+@in_loop
+@asyncio.coroutine
+def _close(response, url):
+    # The connection belongs to the loop; drop it from there
+    try:
+        response.close()
+    finally:
+        _done(url)
+
+
+class ObjectStream(object):
+
+    """ObjectStream: A read-only file-like object over the body of an
+    object being downloaded. Data is read off the connection as it is
+    asked for instead of being buffered up front.
+
+    Closing the stream before the body has been read in full (e.g. the
+    client went away mid-download) drops the connection, as it can no
+    longer be reused."""
+
+    def __init__(self, response, url):
+        self._response = response
+        self._url = url
+        self.headers = response.headers
+        self.closed = False
+
+    @in_loop
+    def _read(self, size):
+        data = yield from self._response.content.read(size)
+        return data
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        try:
+            return self._read(size)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        _finish(self._response, self._url)
+
+
+@in_loop
+def _request_getcontainer(method, url, headers, data=None):
+    response = yield from _send(method, url, headers, data)
+    try:
+        content = yield from _read_body(response)
+    finally:
+        _done(url)
     return (response, content)
 
 
@@ -138,7 +318,7 @@ def put_async_object(
         url, token, container, names, contents, etag, response_dict):
     headers = {'X-Auth-Token': token}
 
-    responses = _async_request(
+    statuses = _async_request(
         'PUT',
         url +
         '/' +
@@ -149,7 +329,10 @@ def put_async_object(
         contents,
         etag)
 
-    if all([response.status == 201 for response in responses]):
+    # The status of each object, in order; None if none was received
+    response_dict['statuses'] = statuses
+
+    if all([status == 201 for status in statuses]):
         response_dict['status'] = 201
     else:
         response_dict['status'] = 500
@@ -204,3 +387,17 @@ def get_object(url, token, container, name, response_dict):
         headers=headers)
 
     return (resp_headers, response)
+
+
+def get_object_stream(url, token, container, name):
+    headers = {'X-Auth-Token': token}
+    url = url + '/' + container + '/' + str(name)
+    response = _request_stream('GET', url, headers=headers)
+
+    # The session stays in use until the stream is closed, however long
+    # the download takes
+    if response.status >= 200 and response.status < 300:
+        return ObjectStream(response, url)
+    else:
+        _close(response, url)
+        raise ClientException("Block GET failed")
@@ -1,13 +1,145 @@
 import asyncio
+import concurrent.futures
 import functools
+import os
+import threading
+
+
+def _run_coroutine_threadsafe(coro, loop):
+    """Submits coro to loop from another thread and returns a
+    concurrent.futures.Future for its result. Cancelling the future
+    cancels the coroutine.
+
+    asyncio.run_coroutine_threadsafe does this from Python 3.4.4 on;
+    this stands in for it on the versions before."""
+    future = concurrent.futures.Future()
+
+    def copy_result(task):
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        if future.cancelled():
+            coro.close()
+            return
+
+        try:
+            task = asyncio.Task(coro, loop=loop)
+        except Exception as ex:
+            future.set_exception(ex)
+            return
+
+        task.add_done_callback(copy_result)
+        future.add_done_callback(
+            lambda future: future.cancelled() and
+            loop.call_soon_threadsafe(task.cancel))
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+
+run_coroutine_threadsafe = getattr(asyncio, 'run_coroutine_threadsafe',
+                                   _run_coroutine_threadsafe)
+
+
+class LoopThread(object):
+
+    """LoopThread: Runs one asyncio event loop in a background thread
+    that any thread can hand coroutines to. Coroutines from many WSGI
+    workers thereby overlap their network I/O and share the connection
+    pools that belong to the loop.
+
+    The thread is started on first use, and again in a forked child,
+    which does not inherit it."""
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_loop(self):
+        """Returns the running loop, starting its thread if needed"""
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._start()
+            return self._loop
+
+    def _start(self):
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(started.set)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run, name='deuce-event-loop')
+        thread.daemon = True
+        thread.start()
+        started.wait()
+
+        self._loop, self._thread, self._pid = loop, thread, os.getpid()
+
+    def run(self, coro, timeout=None):
+        """Runs coro on the loop and waits for its result.
+
+        If the result does not arrive within timeout seconds,
+        asyncio.TimeoutError is raised. Either way, once the caller
+        stops waiting the coroutine is cancelled, so it doesn't carry
+        on using connections on behalf of a request that has gone.
+        """
+        loop = self.get_loop()
+        if threading.current_thread() is self._thread:
+            raise RuntimeError('Cannot wait on the event loop thread')
+
+        future = run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            # A class of its own from Python 3.8 to 3.10
+            raise asyncio.TimeoutError()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self):
+        """Stops the loop and waits for its thread to finish"""
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                return
+
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+
+loop_thread = LoopThread()
+
+
+def run_in_loop(timeout=None):
+    """
+    Returns a decorator that makes a coroutine function synchronous: a
+    call runs the coroutine on the shared loop thread and waits at most
+    timeout seconds for it to finish
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrap(*args, **kwargs):
+            return loop_thread.run(func(*args, **kwargs), timeout)
+        return wrap
+    return decorator
 
 
 def get_event_loop(func):
     """
-    Gets the event loop from asyncio implicitly through a decorator
+    Runs the decorated coroutine function on the shared loop thread,
+    waiting as long as it takes for the result
     """
-    @functools.wraps(func)
-    def wrap(*args, **kwargs):
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(func(*args, **kwargs))
-    return wrap
+    return run_in_loop()(func)
@@ -0,0 +1,40 @@
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_file(fileobj, chunk_size=CHUNK_SIZE):
+    """Yields the content of a file-like object in chunks of at most
+    chunk_size bytes, closing it when done or when the consumer stops
+    early (e.g. the client disconnected)"""
+    try:
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+def iter_files(fileobjs, chunk_size=CHUNK_SIZE):
+    """Yields the content of each file-like object in turn, in chunks
+    of at most chunk_size bytes. Each object is closed once read, as
+    is fileobjs itself if it is a generator."""
+    try:
+        for fileobj in fileobjs:
+            for chunk in iter_file(fileobj, chunk_size):
+                yield chunk
+    finally:
+        close = getattr(fileobjs, 'close', None)
+        if close is not None:
+            close()
+
+
+def wrap_file(env, fileobj, chunk_size=CHUNK_SIZE):
+    """Returns a WSGI iterable over fileobj
+
+    If the server offers wsgi.file_wrapper the file is handed to it,
+    which lets it send a file backed by a real descriptor without
+    copying the data through Python (e.g. with sendfile)."""
+    file_wrapper = env.get('wsgi.file_wrapper')
+
+    if file_wrapper is not None:
+        return file_wrapper(fileobj, chunk_size)
+
+    return iter_file(fileobj, chunk_size)
@@ -1,8 +1,10 @@
 import logging
 from logging.config import dictConfig
+import threading
 from deuce.common import local
 from deuce import config
 _loggers = {}
+_loggers_lock = threading.Lock()
 
 
 def setup():
@@ -14,16 +16,20 @@ def setup():
 class ContextAdapter(logging.LoggerAdapter):
 
     def process(self, msg, kwargs):
+        # NOTE: adapters are shared between threads, so the request id
+        # is only ever passed along with this call and never stored
+        # on the adapter itself.
         context = getattr(local.store, 'context', None)
         if context:
             kwargs['extra'] = {'request_id': context.request_id}
         else:
             kwargs['extra'] = {'request_id': 'Not in wsgi __call__'}
-        self.extra = kwargs['extra']
         return msg, kwargs
 
 
 def getLogger(name):
-    if name not in _loggers:
-        _loggers[name] = ContextAdapter(logging.getLogger(name), extra={})
-    return _loggers[name]
+    with _loggers_lock:
+        if name not in _loggers:
+            _loggers[name] = ContextAdapter(logging.getLogger(name),
+                                            extra={})
+        return _loggers[name]
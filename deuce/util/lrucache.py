@@ -0,0 +1,71 @@
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+
+    """LRUCache: A thread-safe mapping that holds at most maxsize
+    entries, each for at most ttl seconds. The least recently used
+    entry is evicted first when the cache is full.
+
+    Lookups are counted in the hits and misses attributes."""
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        """Constructs a new LRUCache object.
+        :param maxsize: The most entries to hold; 0 disables the cache
+        :param ttl: Seconds an entry stays valid; 0 disables the cache
+        :param clock: Returns the current time in seconds
+        """
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self._maxsize > 0 and self._ttl > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires <= self._clock():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, self._clock() + self._ttl)
+
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,62 @@
+import collections
+from concurrent import futures
+
+
+def readahead(jobs, depth, budget, pool=None):
+    """Runs jobs ahead of the consumer and yields their results in order
+
+    :param jobs: An iterable of (size, func) pairs, where func returns
+                 the result and size is the number of bytes it holds
+    :param depth: The most jobs that run or wait to be consumed, besides
+                  the one being consumed
+    :param budget: The most bytes the results held at once, the one
+                   being consumed included, may add up to. The size of
+                   a job is reserved before it is submitted and freed
+                   once its result has been consumed. A job that does
+                   not fit still runs once nothing else is held, so
+                   that there is always progress.
+    :param pool: The executor the jobs run in, which may be shared with
+                 other consumers; by default a pool of depth threads is
+                 made for them
+
+    If the consumer stops early (e.g. the client went away) jobs that
+    have not started are cancelled and the results of the others are
+    dropped.
+    """
+    depth = max(1, depth)
+    jobs = iter(jobs)
+    job = next(jobs, None)
+    pending = collections.deque()
+    used = 0
+
+    own_pool = pool is None
+    if own_pool:
+        pool = futures.ThreadPoolExecutor(max_workers=depth)
+
+    def fill():
+        nonlocal job, used
+        while job is not None and len(pending) < depth and \
+                (not used or used + job[0] <= budget):
+            size, func = job
+            pending.append((size, pool.submit(func)))
+            used += size
+            job = next(jobs, None)
+
+    try:
+        fill()
+        while pending:
+            size, future = pending.popleft()
+            result = future.result()
+
+            # The slot is free; fetch further while this one is sent
+            fill()
+            yield result
+
+            used -= size
+            fill()
+
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if own_pool:
+            pool.shutdown(wait=False)
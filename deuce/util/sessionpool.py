@@ -0,0 +1,118 @@
+import asyncio
+import os
+import threading
+import time
+import urllib.parse
+
+import aiohttp
+
+
+class SessionPool(object):
+
+    """SessionPool: Hands out one aiohttp ClientSession per storage
+    endpoint, so requests to it reuse kept-alive connections instead of
+    each setting up a new TCP (and TLS) connection.
+
+    A session belongs to the event loop it was created for and to the
+    process that created it; each gets its own. Sessions that have not
+    been used for idle_timeout seconds are closed, unless a request or
+    download taken out with acquire() is still using them.
+
+    Alongside each session is a semaphore that callers hold while they
+    have a request in flight to bound how many they make at once."""
+
+    def __init__(self, limit, keepalive_timeout, idle_timeout,
+                 concurrency=0, clock=time.monotonic):
+        """Constructs a new SessionPool object.
+        :param limit: The most connections to a host; 0 for no limit
+        :param keepalive_timeout: Seconds an idle connection is kept
+        :param idle_timeout: Seconds an unused session is kept
+        :param concurrency: The value of each semaphore; 0 for the
+                            connection limit, or no limit at all
+        :param clock: Returns the current time in seconds
+        """
+        self._limit = limit or None
+        self._keepalive_timeout = keepalive_timeout
+        self._idle_timeout = idle_timeout
+        self._concurrency = concurrency or limit
+        self._clock = clock
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def _key(url, loop):
+        parts = urllib.parse.urlsplit(url)
+        return (os.getpid(), loop, parts.scheme, parts.netloc)
+
+    def _entry(self, url, loop, users=0):
+        key = self._key(url, loop)
+        now = self._clock()
+
+        with self._lock:
+            self._evict(now, loop)
+
+            try:
+                entry = self._sessions[key]
+            except KeyError:
+                connector = aiohttp.TCPConnector(
+                    limit=self._limit,
+                    keepalive_timeout=self._keepalive_timeout,
+                    loop=loop)
+                session = aiohttp.ClientSession(connector=connector,
+                                                loop=loop)
+                semaphore = None
+                if self._concurrency:
+                    semaphore = asyncio.Semaphore(self._concurrency,
+                                                  loop=loop)
+                entry = [session, semaphore, now, 0]
+                self._sessions[key] = entry
+
+            entry[2] = now
+            entry[3] += users
+            return entry
+
+    def get(self, url, loop):
+        """Returns the session for the endpoint of url on loop"""
+        return self._entry(url, loop)[0]
+
+    def acquire(self, url, loop):
+        """Returns the session for the endpoint of url on loop, which is
+        in use, and never closed for being idle, until release() is
+        called with the same url and loop"""
+        return self._entry(url, loop, 1)[0]
+
+    def release(self, url, loop):
+        """Ends a use of a session begun with acquire()"""
+        with self._lock:
+            entry = self._sessions.get(self._key(url, loop))
+            if entry is not None:
+                entry[2] = self._clock()
+                entry[3] -= 1
+
+    def semaphore(self, url, loop):
+        """Returns the semaphore for the endpoint of url on loop, or None
+        if requests to it are not limited"""
+        return self._entry(url, loop)[1]
+
+    def _evict(self, now, loop):
+        # Only sessions of the calling thread's loop can be closed here
+        for key, (session, _, used, users) in list(self._sessions.items()):
+            if key[1] is loop and not users and \
+                    now - used >= self._idle_timeout:
+                del self._sessions[key]
+                session.close()
+
+    def close(self):
+        """Closes every session, e.g. on shutdown"""
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+
+        for key, (session, _, _, _) in sessions.items():
+            # A forked process must not close its parent's connections
+            if key[0] == os.getpid():
+                session.close()
+            else:
+                session.detach()
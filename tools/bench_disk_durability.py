@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Measures block writes/second of the disk driver at each durability level
+
+Stores blocks one at a time with store_block and in batches with
+store_async_block, for every durability setting, into a scratch
+directory that should live on the filesystem being evaluated. Batches
+are written by io_threads threads.
+
+    PYTHONPATH=. python tools/bench_disk_durability.py \
+        --path /srv/deuce-bench --blocks 2000 --batch-size 16 \
+        --io-threads 1 4 16
+
+Run it from the root of the repository so that ini/ is found.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+
+class _Context(object):
+    pass
+
+
+def run(durability, io_threads, blocks, block_size, batch_size, root):
+    import deuce
+    from deuce.drivers.disk import DiskStorageDriver
+
+    deuce.conf.block_storage_driver.options.path = root
+    deuce.conf.block_storage_driver.options.durability = durability
+    deuce.conf.block_storage_driver.options.io_threads = io_threads
+    driver = DiskStorageDriver()
+
+    datas = [os.urandom(block_size) for _ in range(batch_size)]
+    block_ids = [hashlib.sha1(data).hexdigest() for data in datas]
+
+    rates = []
+    for mode in ('single', 'batch'):
+        deuce.context = _Context()
+        deuce.context.project_id = '{0}_{1}_{2}'.format(durability,
+                                                        io_threads, mode)
+        driver.create_vault('bench')
+
+        start = time.time()
+        for _ in range(blocks // batch_size):
+            if mode == 'single':
+                for block_id, data in zip(block_ids, datas):
+                    assert driver.store_block('bench', block_id, data)[0]
+            else:
+                assert driver.store_async_block('bench', block_ids,
+                                                datas)[0]
+        rates.append(blocks // batch_size * batch_size /
+                     (time.time() - start))
+
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--path', default=None,
+                        help='Scratch directory; a temporary one by default')
+    parser.add_argument('--blocks', type=int, default=2000)
+    parser.add_argument('--block-size', type=int, default=64 * 1024)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--io-threads', type=int, nargs='+', default=[4])
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='deuce_bench_', dir=args.path)
+    try:
+        print('{0:>10} {1:>10} {2:>12} {3:>12}'.format(
+            'durability', 'io_threads', 'single/s', 'batched/s'))
+        for durability in ('none', 'data', 'directory'):
+            for io_threads in args.io_threads:
+                single, batched = run(durability, io_threads, args.blocks,
+                                      args.block_size, args.batch_size, root)
+                print('{0:>10} {1:>10} {2:>12.1f} {3:>12.1f}'.format(
+                    durability, io_threads, single, batched))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
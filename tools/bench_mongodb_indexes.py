@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Measures per-operation latency of the MongoDB metadata driver
+
+Times common driver operations in a scratch database, first the way
+the driver used to run them, checking for the collection's index
+before every query, then as it runs them now with the indexes created
+once at construction.
+
+    PYTHONPATH=. python tools/bench_mongodb_indexes.py --ops 1000
+
+The server of metadata_driver.mongodb.url is used; --mock runs against
+mongomock instead. Run it from the root of the repository so that ini/
+is found.
+"""
+import argparse
+import hashlib
+import os
+import time
+
+
+class _Context(object):
+    pass
+
+
+class _EnsuringCollection(object):
+
+    """Checks for an index before each query, as the driver used to"""
+
+    def __init__(self, collection, index):
+        self._collection = collection
+        self._index = index
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in ('find', 'find_one', 'insert', 'update', 'remove'):
+            return attr
+
+        def query(*args, **kwargs):
+            self._collection.ensure_index(self._index)
+            return attr(*args, **kwargs)
+        return query
+
+
+def _operations(driver, ops):
+    """Returns (name, func) pairs, each func running its operation ops
+    times"""
+    vault_id = 'bench'
+    file_id = 'bench_file'
+    block_ids = [hashlib.sha1(str(i).encode()).hexdigest()
+                 for i in range(ops)]
+    offsets = [i * 1024 for i in range(ops)]
+
+    def register():
+        for block_id in block_ids:
+            driver.register_block(vault_id, block_id, block_id, 1024)
+
+    def assign():
+        driver.create_file(vault_id, file_id)
+        for block_id, offset in zip(block_ids, offsets):
+            driver.assign_block(vault_id, file_id, block_id, offset)
+
+    def has_block():
+        for block_id in block_ids:
+            driver.has_block(vault_id, block_id)
+
+    def storage_id():
+        for block_id in block_ids:
+            driver.get_block_storage_id(vault_id, block_id)
+
+    def ref_count():
+        for block_id in block_ids:
+            driver.get_block_ref_count(vault_id, block_id)
+
+    def file_length():
+        for _ in range(ops):
+            driver.file_length(vault_id, file_id)
+
+    def file_blocks():
+        for offset in offsets:
+            list(driver.create_file_block_generator(vault_id, file_id,
+                                                    offset, 1))
+
+    def delete():
+        driver.delete_file(vault_id, file_id)
+        for block_id in block_ids:
+            driver.unregister_block(vault_id, block_id)
+
+    return [('register_block', register), ('assign_block', assign),
+            ('has_block', has_block), ('get_block_storage_id', storage_id),
+            ('get_block_ref_count', ref_count),
+            ('file_length', file_length),
+            ('create_file_block_generator', file_blocks),
+            ('delete', delete)]
+
+
+def run(ops, per_query):
+    from deuce.drivers.mongodb import MongoDbStorageDriver
+    from deuce.drivers.mongodb import mongodbmetadatadriver
+
+    driver = MongoDbStorageDriver()
+    try:
+        if per_query:
+            for name, indexes in mongodbmetadatadriver.INDEXES.items():
+                attr = '_' + name
+                setattr(driver, attr,
+                        _EnsuringCollection(getattr(driver, attr),
+                                            indexes[0]))
+
+        timings = []
+        for name, func in _operations(driver, ops):
+            start = time.time()
+            func()
+            timings.append((name, time.time() - start))
+        return timings
+
+    finally:
+        driver.client.drop_database(driver._dbfile)
+
+
+def main():
+    import deuce
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--ops', type=int, default=1000,
+                        help='Times each operation is run')
+    parser.add_argument('--mock', action='store_true',
+                        help='Use mongomock rather than a server')
+    args = parser.parse_args()
+
+    mongodb = deuce.conf.metadata_driver.mongodb
+    mongodb.path = 'deuce_bench_{0}'.format(os.getpid())
+    if args.mock:
+        mongodb.db_module = 'deuce.tests.db_mocking.mongodb_mocking'
+
+    deuce.context = _Context()
+    deuce.context.project_id = 'bench'
+
+    per_query = run(args.ops, True)
+    bootstrap = run(args.ops, False)
+
+    print('{0:>28} {1:>16} {2:>16}'.format(
+        'operation', 'per query (ms)', 'bootstrap (ms)'))
+    for (name, before), (_, after) in zip(per_query, bootstrap):
+        print('{0:>28} {1:>16.3f} {2:>16.3f}'.format(
+            name, before * 1000 / args.ops, after * 1000 / args.ops))
+
+
+if __name__ == '__main__':
+    main()
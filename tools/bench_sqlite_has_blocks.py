@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Measures how long the sqlite metadata driver takes to find missing blocks
+
+Registers the given numbers of blocks in a scratch database, then asks
+has_blocks about all of them plus as many unknown ones, both with the
+driver's chunked IN queries and with the former one query per block.
+
+    PYTHONPATH=. python tools/bench_sqlite_has_blocks.py \
+        --blocks 1000 10000 100000
+
+Run it from the root of the repository so that ini/ is found.
+"""
+import argparse
+import functools
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+
+class _Context(object):
+    pass
+
+
+def _per_block(driver, vault_id, block_ids):
+    import deuce
+    from deuce.drivers.sqlite import sqlitemetadatadriver as sqlite
+
+    missing = []
+    for block_id in block_ids:
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': block_id
+        }
+        res = list(driver._conn.execute(sqlite.SQL_GET_BLOCK_STATUS, args))
+        if not res:
+            missing.append(block_id)
+    return missing
+
+
+def run(blocks, root):
+    import deuce
+    from deuce.drivers.sqlite import SqliteStorageDriver
+
+    deuce.conf.metadata_driver.sqlite.path = os.path.join(
+        root, 'bench_{0}.db'.format(blocks))
+    deuce.context = _Context()
+    deuce.context.project_id = 'bench'
+    driver = SqliteStorageDriver()
+
+    block_ids = [hashlib.sha1(str(i).encode()).hexdigest()
+                 for i in range(blocks * 2)]
+    for block_id in block_ids[:blocks]:
+        driver.register_block('bench', block_id, block_id, 1024)
+
+    timings = []
+    for func in (functools.partial(_per_block, driver), driver.has_blocks):
+        start = time.time()
+        missing = func('bench', block_ids)
+        timings.append(time.time() - start)
+        assert missing == block_ids[blocks:]
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--path', default=None,
+                        help='Scratch directory; a temporary one by default')
+    parser.add_argument('--blocks', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='deuce_bench_', dir=args.path)
+    try:
+        print('{0:>10} {1:>14} {2:>14}'.format(
+            'blocks', 'per block (s)', 'chunked (s)'))
+        for blocks in args.blocks:
+            per_block, chunked = run(blocks, root)
+            print('{0:>10} {1:>14.3f} {2:>14.3f}'.format(
+                blocks, per_block, chunked))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Measures per-block latency of the Swift client with pooled connections
+
+Serves a minimal Swift stand-in over HTTP/1.1 on localhost, then times
+block PUTs and GETs made through deuce.util.client, which reuses
+kept-alive connections, against the same requests made the way the
+client used to: a new connection for every request.
+
+    PYTHONPATH=. python tools/bench_swift_client.py --requests 1000
+
+Run it from the root of the repository so that ini/ is found.
+"""
+import argparse
+import asyncio
+import http.server
+import os
+import socketserver
+import threading
+import time
+import warnings
+
+import aiohttp
+
+
+class _SwiftHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    block = b''
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Etag', 'bench')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._reply(201)
+
+    def do_GET(self):
+        self._reply(200, _SwiftHandler.block)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _unpooled(method, url, data=None):
+    # What every helper in deuce.util.client used to do
+    @asyncio.coroutine
+    def request():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            response = yield from aiohttp.request(method, url, data=data,
+                                                  headers={})
+        yield from response.read()
+
+    asyncio.get_event_loop().run_until_complete(request())
+
+
+def _time(requests, func):
+    start = time.time()
+    for _ in range(requests):
+        func()
+    return (time.time() - start) / requests * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--block-size', type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    from deuce.util import client
+
+    data = os.urandom(args.block_size)
+    _SwiftHandler.block = data
+
+    httpd = _Server(('127.0.0.1', 0), _SwiftHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{0}/v1/bench'.format(httpd.server_address[1])
+
+    def put():
+        client.put_object(url, 'token', 'vault', 'block', data,
+                          str(len(data)), None, {})
+
+    def get():
+        client.get_object(url, 'token', 'vault', 'block', {})
+
+    print('{0:>6} {1:>14} {2:>14}'.format('', 'new conn (ms)', 'pooled (ms)'))
+    for name, method, pooled, body in (('PUT', 'PUT', put, data),
+                                       ('GET', 'GET', get, None)):
+        unpooled = _time(args.requests, lambda: _unpooled(
+            method, url + '/vault/block', body))
+        print('{0:>6} {1:>14.3f} {2:>14.3f}'.format(
+            name, unpooled, _time(args.requests, pooled)))
+
+    client.sessions.close()
+    httpd.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Measures requests/second of the self-hosted Deuce server
+
+Starts the server with the disk block storage driver and a file backed
+sqlite database for each combination of worker processes and request
+threads, then hammers it with clients that each hold a keep-alive
+connection open and fetch a small block in a loop.
+
+    PYTHONPATH=. python tools/bench_wsgi_server.py \
+        --workers 1 2 4 --threads 1 8 32
+
+Run it from the root of the repository so that ini/ is found.
+"""
+import argparse
+import hashlib
+import http.client
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+PROJECT_ID = 'bench_project'
+VAULT_ID = 'bench_vault'
+HEADERS = {
+    'X-Project-ID': PROJECT_ID,
+    'X-Auth-Token': 'bench_token',
+    'Content-Type': 'application/octet-stream',
+}
+
+
+def _serve(port, workers, threads, root):
+    import deuce
+    from deuce.transport.wsgi.driver import Driver
+
+    deuce.conf.server.host = '127.0.0.1'
+    deuce.conf.server.port = port
+    deuce.conf.server.workers = workers
+    deuce.conf.server.threads = threads
+    deuce.conf.metadata_driver.driver = \
+        'deuce.drivers.sqlite.SqliteStorageDriver'
+    deuce.conf.metadata_driver.sqlite.path = os.path.join(root, 'meta.db')
+    deuce.conf.block_storage_driver.driver = \
+        'deuce.drivers.disk.DiskStorageDriver'
+    deuce.conf.block_storage_driver.options.path = os.path.join(root,
+                                                                'blocks')
+
+    Driver().listen()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Server did not come up on port {0}'.format(port))
+
+
+def _seed(port, block_size):
+    data = os.urandom(block_size)
+    block_id = hashlib.sha1(data).hexdigest()
+
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    for method, path, body in [
+            ('PUT', '/v1.0/vaults/{0}'.format(VAULT_ID), None),
+            ('PUT', '/v1.0/vaults/{0}/blocks/{1}'.format(VAULT_ID, block_id),
+             data)]:
+        conn.request(method, path, body=body, headers=HEADERS)
+        response = conn.getresponse()
+        response.read()
+        assert response.status in (200, 201), response.status
+    conn.close()
+
+    return '/v1.0/vaults/{0}/blocks/{1}'.format(VAULT_ID, block_id)
+
+
+def _client(port, path, stop, counts):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    done = 0
+    while not stop.is_set():
+        conn.request('GET', path, headers=HEADERS)
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError('GET failed: {0}'.format(response.status))
+        if response.getheader('connection') == 'close':
+            conn.close()
+        done += 1
+    conn.close()
+    counts.append(done)
+
+
+def run(workers, threads, clients, duration, block_size):
+    root = tempfile.mkdtemp(prefix='deuce_bench_')
+    port = _free_port()
+    proc = multiprocessing.Process(target=_serve,
+                                   args=(port, workers, threads, root))
+    proc.start()
+    try:
+        _wait_for(port)
+        path = _seed(port, block_size)
+
+        stop = threading.Event()
+        counts = []
+        pool = [threading.Thread(target=_client,
+                                 args=(port, path, stop, counts))
+                for _ in range(clients)]
+        start = time.time()
+        for thread in pool:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in pool:
+            thread.join()
+
+        return sum(counts) / (time.time() - start)
+
+    finally:
+        proc.terminate()
+        proc.join()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--block-size', type=int, default=4096)
+    args = parser.parse_args()
+
+    print('{0:>8} {1:>8} {2:>10}'.format('workers', 'threads', 'req/s'))
+    for workers in args.workers:
+        for threads in args.threads:
+            rate = run(workers, threads, args.clients, args.duration,
+                       args.block_size)
+            print('{0:>8} {1:>8} {2:>10.1f}'.format(workers, threads, rate))
+
+
+if __name__ == '__main__':
+    main()
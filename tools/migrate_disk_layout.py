@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Moves blocks of the disk block storage driver into sharded directories
+
+Vaults written while shard_depth was 0 keep every block in one
+directory. This walks every project and vault under the configured
+storage path and moves such blocks into the shards for the configured
+shard_depth. The server may keep running meanwhile: blocks are
+renamed into place one at a time and stay readable throughout.
+
+    PYTHONPATH=. python tools/migrate_disk_layout.py [--path PATH]
+
+Run it from the root of the repository so that ini/ is found.
+"""
+import argparse
+import os
+
+
+class _Context(object):
+    pass
+
+
+def main():
+    import deuce
+    from deuce.drivers.disk import DiskStorageDriver
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--path',
+                        default=deuce.conf.block_storage_driver.options.path)
+    parser.add_argument('--shard-depth', type=int, default=deuce.conf.
+                        block_storage_driver.options.shard_depth)
+    args = parser.parse_args()
+
+    deuce.conf.block_storage_driver.options.path = args.path
+    deuce.conf.block_storage_driver.options.shard_depth = args.shard_depth
+    driver = DiskStorageDriver()
+
+    deuce.context = _Context()
+    total = 0
+    for project_id in sorted(os.listdir(args.path)):
+        project_path = os.path.join(args.path, project_id)
+        if not os.path.isdir(project_path):
+            continue
+
+        deuce.context.project_id = project_id
+        for vault_id in sorted(os.listdir(project_path)):
+            if not os.path.isdir(os.path.join(project_path, vault_id)):
+                continue
+
+            moved = driver.migrate_vault(vault_id)
+            total += moved
+            print('{0}/{1}: moved {2} blocks'.format(project_id, vault_id,
+                                                     moved))
+
+    print('Moved {0} blocks'.format(total))
+
+
+if __name__ == '__main__':
+    main()
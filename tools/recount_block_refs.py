@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Recounts the references to the blocks of the configured metadata driver
+
+The sqlite and mongodb drivers keep the number of references to each
+block on the block itself. This counts the references in every vault of
+the given projects afresh and corrects any count that has drifted. The
+server may keep running meanwhile.
+
+    PYTHONPATH=. python tools/recount_block_refs.py PROJECT \
+        [PROJECT ...] [--vault VAULT ...]
+
+Run it from the root of the repository so that ini/ is found.
+"""
+import argparse
+
+
+class _Context(object):
+    pass
+
+
+def _vaults(driver):
+    """Yields the ID of every vault of the current project"""
+    marker = None
+    while True:
+        vault_ids = driver.create_vaults_generator(marker=marker)
+
+        # The marker itself is listed again
+        for vault_id in vault_ids:
+            if vault_id != marker:
+                yield vault_id
+
+        if not vault_ids or vault_ids[-1] == marker:
+            return
+        marker = vault_ids[-1]
+
+
+def main():
+    import deuce
+    from deuce.model import _load_driver
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('projects', nargs='+', metavar='PROJECT')
+    parser.add_argument('--vault', dest='vaults', action='append',
+                        help='Only recount this vault; may be repeated')
+    args = parser.parse_args()
+
+    driver = _load_driver(deuce.conf.metadata_driver.driver)
+    if not hasattr(driver, 'recount_block_refs'):
+        parser.error('{0} does not keep reference counts'.format(
+            deuce.conf.metadata_driver.driver))
+
+    deuce.context = _Context()
+    total = 0
+    for project_id in args.projects:
+        deuce.context.project_id = project_id
+        for vault_id in args.vaults or _vaults(driver):
+            fixed = driver.recount_block_refs(vault_id)
+            total += fixed
+            print('{0}/{1}: corrected {2} blocks'.format(project_id,
+                                                         vault_id, fixed))
+
+    print('Corrected {0} blocks'.format(total))
+
+
+if __name__ == '__main__':
+    main()